@@ -1,8 +1,13 @@
 from django.contrib import admin
+from django.db import transaction
+from django.utils.html import format_html_join
+from django.utils.safestring import mark_safe
 from .models import (Label, Space, Article, ArticleAttachment, ArticleParagraph, 
-                     ParagraphAttachment, ShareSettings, SecureShareLink, ShareLinkView,
+                     ParagraphAttachment, ShareSettings, SecureShareLink, ShareLinkViewRecord, share_link_view_partitions,
                      ArticleRating, ArticleComment, ParagraphLike, ArticleReadStatus, ReadLater,
-                     TagGroup, TagCategory, Tag)
+                     TagGroup, TagCategory, Tag, SearchQueryStat, SavedSearch,
+                     ArticleViewBreakdown)
+from . import analytics
 
 class ArticleAttachmentInline(admin.TabularInline):
     model = ArticleAttachment
@@ -116,31 +121,34 @@ class ShareSettingsAdmin(admin.ModelAdmin):
         return False
 
 
-class ShareLinkViewInline(admin.TabularInline):
-    model = ShareLinkView
-    extra = 0
-    readonly_fields = ('ip_address', 'user_agent', 'referrer', 'viewed_at')
-    fields = ('ip_address', 'viewed_at', 'referrer')
-    can_delete = False
-    
-    def has_add_permission(self, request, obj):
-        return False
-
-
 @admin.register(SecureShareLink)
 class SecureShareLinkAdmin(admin.ModelAdmin):
     list_display = ('article', 'token_preview', 'created_by', 'view_count', 'is_active', 'expires_at', 'created_at')
     list_filter = ('is_active', 'created_at', 'expires_at', 'article__space')
     search_fields = ('article__title', 'token', 'created_by__username')
-    readonly_fields = ('token', 'view_count', 'last_accessed', 'created_at')
-    fields = ('article', 'token', 'created_by', 'expires_at', 'is_active', 'view_count', 'last_accessed', 'created_at')
-    inlines = [ShareLinkViewInline]
+    readonly_fields = ('token', 'view_count', 'last_accessed', 'created_at', 'recent_views')
+    fields = ('article', 'token', 'created_by', 'expires_at', 'is_active', 'view_count', 'last_accessed', 'created_at',
+              'recent_views')
     actions = ['deactivate_links', 'cleanup_expired']
+    recent_views_limit = 50
     
     def token_preview(self, obj):
         return f"{obj.token[:8]}..." if obj.token else "N/A"
     token_preview.short_description = 'Token (Preview)'
     
+    def recent_views(self, obj):
+        # Views live in monthly partition tables, newest read first
+        if obj.pk is None:
+            return "-"
+        views = share_link_view_partitions.latest(self.recent_views_limit, share_link_id=obj.pk)
+        if not views:
+            return "No views recorded"
+        return format_html_join(
+            mark_safe('<br>'), '{} &middot; {} &middot; {}',
+            ((view.viewed_at, view.ip_address, view.referrer or '-') for view in views),
+        )
+    recent_views.short_description = 'Recent views'
+    
     def deactivate_links(self, request, queryset):
         updated = queryset.update(is_active=False)
         self.message_user(request, f'{updated} share links deactivated.')
@@ -152,8 +160,9 @@ class SecureShareLinkAdmin(admin.ModelAdmin):
     cleanup_expired.short_description = 'Clean up expired share links'
 
 
-@admin.register(ShareLinkView)
+@admin.register(ShareLinkViewRecord)
 class ShareLinkViewAdmin(admin.ModelAdmin):
+    # Reads every monthly partition through one database view
     list_display = ('share_link', 'ip_address', 'viewed_at')
     list_filter = ('viewed_at', 'share_link__article__space')
     search_fields = ('share_link__article__title', 'ip_address')
@@ -164,6 +173,9 @@ class ShareLinkViewAdmin(admin.ModelAdmin):
     
     def has_change_permission(self, request, obj=None):
         return False
+    
+    def has_delete_permission(self, request, obj=None):
+        return False
 
 
 # Rating and Comment Administration
@@ -174,6 +186,18 @@ class ArticleRatingAdmin(admin.ModelAdmin):
     search_fields = ('article__title', 'user__username')
     readonly_fields = ('created_at', 'updated_at')
     ordering = ['-created_at']
+    
+    def save_model(self, request, obj, form, change):
+        # Keep the articles' rating counters in step, as ArticleRating.rate does
+        with transaction.atomic():
+            previous = ArticleRating.objects.select_for_update().filter(pk=obj.pk).first() if change else None
+            super().save_model(request, obj, form, change)
+            if previous is not None and previous.article_id == obj.article_id:
+                Article.adjust_counters(obj.article_id, rating_sum=obj.rating - previous.rating)
+                return
+            if previous is not None:
+                Article.adjust_counters(previous.article_id, rating_sum=-previous.rating, rating_count=-1)
+            Article.adjust_counters(obj.article_id, rating_sum=obj.rating, rating_count=1)
 
 
 @admin.register(ArticleComment)
@@ -189,14 +213,27 @@ class ArticleCommentAdmin(admin.ModelAdmin):
         return obj.content[:50] + "..." if len(obj.content) > 50 else obj.content
     content_preview.short_description = 'Content Preview'
     
+    def save_model(self, request, obj, form, change):
+        # Approving, moving or re-parenting a comment moves it between article comment counters
+        with transaction.atomic():
+            previous = ArticleComment.objects.select_for_update().filter(pk=obj.pk).first() if change else None
+            super().save_model(request, obj, form, change)
+            counted_before = previous.article_id if previous is not None and previous.is_counted else None
+            counted_after = obj.article_id if obj.is_counted else None
+            if counted_before != counted_after:
+                if counted_before is not None:
+                    Article.adjust_counters(counted_before, approved_comment_count=-1)
+                if counted_after is not None:
+                    Article.adjust_counters(counted_after, approved_comment_count=1)
+    
     def approve_comments(self, request, queryset):
-        queryset.update(is_approved=True)
-        self.message_user(request, f'{queryset.count()} comments approved.')
+        changed = ArticleComment.set_approved(queryset, True)
+        self.message_user(request, f'{changed} comments approved.')
     approve_comments.short_description = 'Approve selected comments'
     
     def unapprove_comments(self, request, queryset):
-        queryset.update(is_approved=False)
-        self.message_user(request, f'{queryset.count()} comments unapproved.')
+        changed = ArticleComment.set_approved(queryset, False)
+        self.message_user(request, f'{changed} comments unapproved.')
     unapprove_comments.short_description = 'Unapprove selected comments'
 
 
@@ -207,6 +244,18 @@ class ParagraphLikeAdmin(admin.ModelAdmin):
     search_fields = ('paragraph__title', 'paragraph__article__title', 'user__username')
     readonly_fields = ('created_at', 'updated_at')
     ordering = ['-created_at']
+    
+    def save_model(self, request, obj, form, change):
+        # Keep the paragraphs' like counters in step, as ParagraphLike.react does
+        with transaction.atomic():
+            previous = ParagraphLike.objects.select_for_update().filter(pk=obj.pk).first() if change else None
+            super().save_model(request, obj, form, change)
+            counted_before = (previous.paragraph_id, ParagraphLike.counter(previous.is_like)) if previous else None
+            counted_after = (obj.paragraph_id, ParagraphLike.counter(obj.is_like))
+            if counted_before != counted_after:
+                if counted_before is not None:
+                    ArticleParagraph.adjust_counters(counted_before[0], **{counted_before[1]: -1})
+                ArticleParagraph.adjust_counters(counted_after[0], **{counted_after[1]: 1})
 
 
 @admin.register(ArticleReadStatus)
@@ -320,3 +369,59 @@ class TagAdmin(admin.ModelAdmin):
         return obj.category.group.name
     group_name.short_description = 'Group'
     group_name.admin_order_field = 'category__group__name'
+
+
+# Search Analytics
+@admin.register(SearchQueryStat)
+class SearchQueryStatAdmin(admin.ModelAdmin):
+    list_display = ('query', 'day', 'searches', 'zero_result_searches', 'clicks')
+    list_filter = ('day',)
+    search_fields = ('query',)
+    ordering = ['-day', '-searches']
+    date_hierarchy = 'day'
+    change_list_template = 'admin/kb/searchquerystat/change_list.html'
+    report_days = 30
+    
+    def has_add_permission(self, request):
+        # Rows are produced by the rollup_search_analytics command
+        return False
+    
+    def has_change_permission(self, request, obj=None):
+        return False
+    
+    def changelist_view(self, request, extra_context=None):
+        extra_context = extra_context or {}
+        extra_context.update({
+            'report_days': self.report_days,
+            'top_queries': analytics.top_queries(days=self.report_days),
+            'zero_result_queries': analytics.top_queries(days=self.report_days, zero_results=True),
+        })
+        return super().changelist_view(request, extra_context=extra_context)
+
+
+@admin.register(ArticleViewBreakdown)
+class ArticleViewBreakdownAdmin(admin.ModelAdmin):
+    list_display = ('article', 'day', 'kind', 'value', 'views')
+    list_filter = ('kind', 'day')
+    search_fields = ('article__title', 'value')
+    ordering = ['-day', '-views']
+    date_hierarchy = 'day'
+    
+    def has_add_permission(self, request):
+        # Rows are produced by the compact_article_views command
+        return False
+    
+    def has_change_permission(self, request, obj=None):
+        return False
+
+
+@admin.register(SavedSearch)
+class SavedSearchAdmin(admin.ModelAdmin):
+    list_display = ('query', 'name', 'user', 'match_count', 'created_at')
+    search_fields = ('query', 'name', 'user__username')
+    readonly_fields = ('created_at',)
+    ordering = ['-created_at']
+    
+    def match_count(self, obj):
+        return obj.matches.count()
+    match_count.short_description = 'Matches'
@@ -0,0 +1,113 @@
+"""
+Search analytics.
+
+Every search and search-result click is appended to an in-process
+``kb.buffers.BulkBuffer``; the request only pays for a list append under a
+lock. The buffer is written to the append-only ``SearchLog`` table with
+``bulk_create`` once it holds ``FLUSH_SIZE`` entries or every
+``FLUSH_INTERVAL`` seconds, on a background thread so no search waits on the
+INSERT, and once more when the process exits. It holds at most
+``MAX_BUFFERED`` entries; further events are counted as dropped.
+
+The ``rollup_search_analytics`` management command periodically folds the
+log into per-day ``SearchQueryStat`` rows (see ``rollup``), which back the
+top-queries and zero-result reports in the admin.
+"""
+from datetime import timedelta
+
+from django.db import transaction
+from django.db.models import Count, F, Max, Q, Sum
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+from . import buffers, search
+
+FLUSH_SIZE = 200
+FLUSH_INTERVAL = 30
+MAX_BUFFERED = 10000
+MAX_QUERY_LENGTH = 255
+
+
+def normalize_query(query):
+    return search.normalize_query(query)[:MAX_QUERY_LENGTH]
+
+
+buffer = buffers.BulkBuffer(
+    'kb.SearchLog', flush_size=FLUSH_SIZE, flush_interval=FLUSH_INTERVAL, max_buffered=MAX_BUFFERED
+)
+
+
+def record_search(query, result_count):
+    query = normalize_query(query)
+    if query:
+        buffer.append(buffer.model(event='search', query=query, result_count=result_count))
+
+
+def record_click(query, article_id):
+    query = normalize_query(query)
+    if query:
+        buffer.append(buffer.model(event='click', query=query, article_id=article_id))
+
+
+# Rollups
+
+def rollup():
+    """
+    Fold every logged event into per-day SearchQueryStat counters and delete
+    the folded log rows. Returns the number of log rows processed.
+    """
+    from .models import SearchLog, SearchQueryStat
+
+    last_id = SearchLog.objects.aggregate(last_id=Max('id'))['last_id']
+    if last_id is None:
+        return 0
+
+    with transaction.atomic():
+        log = SearchLog.objects.filter(id__lte=last_id)
+        groups = log.annotate(day=TruncDate('created_at')).values('day', 'query').annotate(
+            searches=Count('id', filter=Q(event=SearchLog.EVENT_SEARCH)),
+            zero_result_searches=Count('id', filter=Q(event=SearchLog.EVENT_SEARCH, result_count=0)),
+            clicks=Count('id', filter=Q(event=SearchLog.EVENT_CLICK)),
+        ).order_by()
+
+        for group in groups:
+            updated = SearchQueryStat.objects.filter(day=group['day'], query=group['query']).update(
+                searches=F('searches') + group['searches'],
+                zero_result_searches=F('zero_result_searches') + group['zero_result_searches'],
+                clicks=F('clicks') + group['clicks'],
+            )
+            if not updated:
+                SearchQueryStat.objects.create(
+                    day=group['day'],
+                    query=group['query'],
+                    searches=group['searches'],
+                    zero_result_searches=group['zero_result_searches'],
+                    clicks=group['clicks'],
+                )
+        processed, _ = log.delete()
+    return processed
+
+
+def top_queries(days=30, limit=20, zero_results=False):
+    """[{'query', 'searches', 'zero_result_searches', 'clicks'}, ...] over the last ``days`` days"""
+    from .models import SearchQueryStat
+
+    since = timezone.localdate() - timedelta(days=days - 1)
+    stats = SearchQueryStat.objects.filter(day__gte=since).values('query').annotate(
+        total_searches=Sum('searches'),
+        total_zero_results=Sum('zero_result_searches'),
+        total_clicks=Sum('clicks'),
+    ).order_by()
+    if zero_results:
+        stats = stats.filter(total_zero_results__gt=0).order_by('-total_zero_results', 'query')
+    else:
+        stats = stats.order_by('-total_searches', 'query')
+    return [
+        {
+            'query': row['query'],
+            'searches': row['total_searches'],
+            'zero_result_searches': row['total_zero_results'],
+            'clicks': row['total_clicks'],
+        }
+        for row in stats[:limit]
+    ]
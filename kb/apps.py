@@ -4,3 +4,9 @@ from django.apps import AppConfig
 class KbConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'kb'
+
+    def ready(self):
+        from . import deferred, semantic, signals  # noqa: F401
+
+        # Maps the semantic index files; nothing is read into memory here
+        semantic.index.open()
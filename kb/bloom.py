@@ -0,0 +1,102 @@
+"""
+Time-windowed Bloom filters for suppressing repeated events.
+
+A ``BloomFilter`` is a fixed-size bit array with ``hashes`` bit positions per
+item, derived from one blake2b digest by double hashing. It answers "seen
+before?" with no false negatives and a false-positive rate of about
+``error_rate`` once ``capacity`` items have been added.
+
+A ``RotatingBloomFilter`` keeps two generations. Items are added to the
+current one and looked up in both; every ``window`` seconds (or as soon as
+the current generation is full) the previous generation is dropped and the
+current one takes its place. Items found in the previous generation are
+carried into the current one, so an item is remembered for at least
+``window`` seconds after it was last seen (and at most twice that), in
+constant memory however many items pass through.
+
+Filters live in process memory; each worker process has its own.
+"""
+import hashlib
+import math
+import threading
+import time
+
+
+class BloomFilter:
+
+    def __init__(self, capacity, error_rate):
+        self.capacity = capacity
+        self.size = max(8, int(math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2))))
+        self.hashes = max(1, int(round(self.size / capacity * math.log(2))))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, item):
+        digest = hashlib.blake2b(str(item).encode('utf-8'), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], 'big')
+        second = int.from_bytes(digest[8:], 'big') | 1
+        return [(first + i * second) % self.size for i in range(self.hashes)]
+
+    def __contains__(self, item):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(item))
+
+    def add(self, item):
+        """Add an item; returns True if it was (probably) already present"""
+        present = True
+        for position in self._positions(item):
+            mask = 1 << (position & 7)
+            if not self.bits[position >> 3] & mask:
+                self.bits[position >> 3] |= mask
+                present = False
+        if not present:
+            self.count += 1
+        return present
+
+    @property
+    def is_full(self):
+        return self.count >= self.capacity
+
+
+class RotatingBloomFilter:
+
+    def __init__(self, window, capacity=100000, error_rate=0.001):
+        self.window = window
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self._lock = threading.Lock()
+        self._current = BloomFilter(capacity, error_rate)
+        self._previous = BloomFilter(capacity, error_rate)
+        self._rotated_at = time.monotonic()
+
+    def _rotate_if_due(self):
+        elapsed = time.monotonic() - self._rotated_at
+        if elapsed >= 2 * self.window:
+            # Idle for two windows: nothing in either generation is recent
+            self._previous = BloomFilter(self.capacity, self.error_rate)
+        elif self._current.is_full or elapsed >= self.window:
+            self._previous = self._current
+        else:
+            return
+        self._current = BloomFilter(self.capacity, self.error_rate)
+        self._rotated_at = time.monotonic()
+
+    def seen(self, item):
+        """
+        Record an item; returns True if it was (probably) already recorded
+        within the window, False the first time
+        """
+        if self.window <= 0:
+            return False
+        with self._lock:
+            self._rotate_if_due()
+            if item in self._previous:
+                # Carry it forward so it stays remembered for a full window
+                self._current.add(item)
+                return True
+            return self._current.add(item)
+
+    def clear(self):
+        with self._lock:
+            self._current = BloomFilter(self.capacity, self.error_rate)
+            self._previous = BloomFilter(self.capacity, self.error_rate)
+            self._rotated_at = time.monotonic()
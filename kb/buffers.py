@@ -0,0 +1,163 @@
+"""
+Buffered, batched writes for high-volume append-only rows.
+
+A ``BulkBuffer`` collects unsaved model instances in memory and writes them
+with ``bulk_create`` from a background thread, so the request that produced
+a row never waits on an INSERT (or on SQLite's write lock). A batch is
+written once ``flush_size`` rows are waiting or every ``flush_interval``
+seconds, whichever comes first.
+
+The buffer is bounded: when ``max_buffered`` rows are already waiting, new
+rows are dropped and counted in ``dropped`` rather than letting memory grow
+while the database is unavailable. Rows from a batch that fails to write are
+counted in ``failed``. Every buffer is flushed when the process exits.
+
+Rows are only durable once flushed; anything still buffered when a process
+is killed without running its exit handlers is lost. That trade-off suits
+analytics-style rows (views, search logs), not user data.
+"""
+import atexit
+import logging
+import os
+import threading
+from collections import deque
+
+from django.apps import apps
+from django.db import close_old_connections, connection, transaction
+
+logger = logging.getLogger(__name__)
+
+_buffers = []
+
+
+class BulkBuffer:
+
+    def __init__(self, model, flush_size=200, flush_interval=5, max_buffered=10000, batch_size=500,
+                 after_write=None, write=None):
+        # 'app_label.ModelName', resolved on first flush so this can be created at import time
+        self._model = model
+        # Called with each batch instead of bulk_create (e.g. to route rows to partitions)
+        self.write = write
+        # Called with each written batch, in the same transaction (e.g. to maintain rollups)
+        self.after_write = after_write
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.max_buffered = max_buffered
+        self.batch_size = batch_size
+        self.dropped = 0
+        self.written = 0
+        self.failed = 0
+        self._rows = deque()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._pid = None
+        _buffers.append(self)
+
+    @property
+    def model(self):
+        if isinstance(self._model, str):
+            self._model = apps.get_model(self._model)
+        return self._model
+
+    def __len__(self):
+        return len(self._rows)
+
+    def append(self, row):
+        """Queue an unsaved instance; returns False if the buffer is full and it was dropped"""
+        with self._lock:
+            if len(self._rows) >= self.max_buffered:
+                self.dropped += 1
+                return False
+            self._rows.append(row)
+            due = len(self._rows) >= self.flush_size
+        self._ensure_thread()
+        if due:
+            self._wakeup.set()
+        return True
+
+    def stats(self):
+        return {
+            'buffered': len(self._rows),
+            'written': self.written,
+            'dropped': self.dropped,
+            'failed': self.failed,
+        }
+
+    # Flushing
+
+    def _take(self):
+        with self._lock:
+            rows = list(self._rows)
+            self._rows.clear()
+        return rows
+
+    def flush(self):
+        """Write every queued row now; returns the number of rows written"""
+        with self._flush_lock:
+            rows = self._take()
+            if not rows:
+                return 0
+            try:
+                close_old_connections()
+                with transaction.atomic():
+                    if self.write is not None:
+                        self.write(rows)
+                    else:
+                        self.model.objects.bulk_create(rows, batch_size=self.batch_size)
+                    if self.after_write is not None:
+                        self.after_write(rows)
+            except Exception:
+                self.failed += len(rows)
+                raise
+            self.written += len(rows)
+            return len(rows)
+
+    def discard(self):
+        """Drop everything queued and reset the counters"""
+        self._take()
+        self.dropped = self.written = self.failed = 0
+
+    def _ensure_thread(self):
+        # After a fork (e.g. preloading app servers) the child has no flusher thread
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread is not None and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(
+                target=self._run, name=f'bulk-buffer-{self._model}', daemon=True
+            )
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Failed to flush buffered %s rows', self._model)
+            finally:
+                connection.close()
+
+
+def stats():
+    """{model label: buffer stats} for every buffer in this process"""
+    return {buffer.model._meta.label: buffer.stats() for buffer in _buffers}
+
+
+def flush_all():
+    """Flush every buffer in this process; returns the number of rows written"""
+    written = 0
+    for buffer in _buffers:
+        try:
+            written += buffer.flush()
+        except Exception:
+            logger.exception('Failed to flush buffered %s rows', buffer._model)
+    return written
+
+
+atexit.register(flush_all)
@@ -0,0 +1,52 @@
+"""
+Exact, bounded "seen recently?" sets for coalescing repeated writes.
+
+``RecentlySeen`` remembers when each key last caused a write and answers
+whether another write for it can be skipped because one happened less than
+``window`` seconds ago. It holds at most ``max_entries`` keys, evicting the
+least recently written first, so memory stays bounded however many users
+and articles pass through; an evicted key simply writes again next time.
+
+Unlike ``kb.bloom.RotatingBloomFilter`` it has no false positives, so it
+suits writes that must happen at least once (such as marking an article
+read), at the cost of memory per key. Sets live in process memory; each
+worker process has its own.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+
+class RecentlySeen:
+
+    def __init__(self, window, max_entries=50000):
+        self.window = window
+        self.max_entries = max_entries
+        self._seen = OrderedDict()
+        self._lock = threading.Lock()
+
+    def seen(self, key):
+        """
+        True if ``key`` was recorded less than ``window`` seconds ago;
+        otherwise record it now and return False
+        """
+        if self.window <= 0:
+            return False
+        now = time.monotonic()
+        with self._lock:
+            last = self._seen.get(key)
+            if last is not None and now - last < self.window:
+                return True
+            self._seen[key] = now
+            self._seen.move_to_end(key)
+            while len(self._seen) > self.max_entries:
+                self._seen.popitem(last=False)
+            return False
+
+    def forget(self, key):
+        with self._lock:
+            self._seen.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._seen.clear()
@@ -0,0 +1,113 @@
+"""
+Threaded article comments, loaded in one query.
+
+``CommentTree(article)`` fetches every approved comment of an article,
+with its user, in a single query and links replies to their parents in
+memory. Replies whose parent is not approved stay hidden, as they always
+have been.
+
+Top-level threads are shown newest first, ``PAGE_SIZE`` at a time, and
+paginated by cursor: ``page(cursor)`` returns the threads older than the
+cursor along with the cursor of the next page (None on the last page), so
+comments posted meanwhile never shift a page. A cursor is the
+``<microseconds>_<id>`` position of the last thread shown.
+
+Replies come oldest first. A thread is included ``REPLY_DEPTH`` levels
+deep, counting its top-level comment; deeper comments are left out, and
+the last comment included in a branch has ``more_replies`` set to the
+number of replies it has, which ``replies`` (behind the
+``api_comment_replies`` endpoint) loads on demand, again ``REPLY_DEPTH``
+levels deep.
+
+Prepared comments carry ``thread_replies`` (the replies to render) and
+``more_replies``, read by ``partials/comment.html``; ``as_json`` gives
+the same tree as plain data.
+"""
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from .models import ArticleComment
+
+PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+REPLY_DEPTH = 3
+
+_EPOCH = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+_MICROSECOND = timedelta(microseconds=1)
+
+
+def _position(comment):
+    """Where a comment sorts among threads: (microseconds since the epoch, id)"""
+    created_at = comment.created_at
+    if created_at.tzinfo is None:
+        created_at = created_at.replace(tzinfo=dt_timezone.utc)
+    return (created_at - _EPOCH) // _MICROSECOND, comment.id
+
+
+def encode_cursor(comment):
+    return '%d_%d' % _position(comment)
+
+
+def decode_cursor(cursor):
+    """The position a cursor stands for; ValueError if it is malformed"""
+    micros, _, comment_id = cursor.partition('_')
+    return int(micros), int(comment_id)
+
+
+class CommentTree:
+
+    def __init__(self, article):
+        self.article = article
+        comments = list(
+            ArticleComment.objects.filter(article=article, is_approved=True)
+            .select_related('user').order_by('created_at', 'id')
+        )
+        self.comments = {comment.id: comment for comment in comments}
+        self.children = {comment.id: [] for comment in comments}
+        self.threads = []
+        for comment in comments:
+            if comment.parent_id is None:
+                self.threads.append(comment)
+            elif comment.parent_id in self.children:
+                self.children[comment.parent_id].append(comment)
+        self.threads.reverse()
+
+    def _prepare(self, comments, depth):
+        for comment in comments:
+            children = self.children[comment.id]
+            if depth > 1:
+                comment.thread_replies = self._prepare(children, depth - 1)
+                comment.more_replies = 0
+            else:
+                comment.thread_replies = []
+                comment.more_replies = len(children)
+        return comments
+
+    def page(self, cursor=None, limit=PAGE_SIZE, depth=REPLY_DEPTH):
+        """
+        ``(threads, next_cursor)``: up to ``limit`` top-level comments older
+        than ``cursor``, newest first, with replies ``depth`` levels deep
+        """
+        threads = self.threads
+        if cursor:
+            position = decode_cursor(cursor)
+            threads = [thread for thread in threads if _position(thread) < position]
+        shown = threads[:limit]
+        next_cursor = encode_cursor(shown[-1]) if len(threads) > limit else None
+        return self._prepare(shown, depth), next_cursor
+
+    def replies(self, comment_id, depth=REPLY_DEPTH):
+        """Replies to a comment, oldest first, ``depth`` levels deep; KeyError if it is not shown"""
+        return self._prepare(self.children[comment_id], depth)
+
+
+def as_json(comment):
+    """A prepared comment and the replies included with it, as plain data"""
+    return {
+        'id': comment.id,
+        'parent_id': comment.parent_id,
+        'user': comment.user.username,
+        'content': comment.content,
+        'created_at': comment.created_at.isoformat(),
+        'replies': [as_json(reply) for reply in comment.thread_replies],
+        'more_replies': comment.more_replies,
+    }
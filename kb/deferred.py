@@ -0,0 +1,150 @@
+"""
+Bookkeeping work deferred until after the response has been sent.
+
+Views call ``defer(func, *args)`` for writes the reader does not need to
+wait for (view records, read status). The calls are collected per request
+and handed to a small pool of worker threads when Django's
+``request_finished`` signal fires, i.e. once the response has gone out, so
+the response time of a page only includes its reads.
+
+Each task runs on its own: an exception is logged and counted in
+``failed`` without affecting other tasks or the request that deferred it.
+The queue holds at most ``MAX_QUEUED`` tasks; when it is full, tasks run in
+the finishing request's thread instead (still after the response), so work
+is slowed down rather than lost. ``stats()`` reports the queue depth and
+its high-water mark. Calls made outside a request run immediately.
+
+Tasks still queued when the process exits are run before the exit handlers
+of ``kb.buffers`` flush the rows they may have queued.
+"""
+import atexit
+import logging
+import os
+import queue
+import threading
+
+from django.core.signals import request_finished, request_started
+from django.db import close_old_connections, connection
+
+from . import buffers  # noqa: F401 - its exit handler must be registered first
+
+logger = logging.getLogger(__name__)
+
+WORKERS = 2
+MAX_QUEUED = 1000
+
+_request = threading.local()
+
+
+class DeferredQueue:
+
+    def __init__(self, workers=WORKERS, max_queued=MAX_QUEUED):
+        self.workers = workers
+        self._queue = queue.Queue(maxsize=max_queued)
+        self._lock = threading.Lock()
+        self._threads = []
+        self._pid = None
+        self.completed = 0
+        self.failed = 0
+        self.ran_inline = 0
+        self.max_depth = 0
+
+    def submit(self, func, args=(), kwargs=None):
+        self._ensure_threads()
+        try:
+            self._queue.put_nowait((func, args, kwargs or {}))
+        except queue.Full:
+            self.ran_inline += 1
+            self._run(func, args, kwargs or {})
+            return
+        self.max_depth = max(self.max_depth, self._queue.qsize())
+
+    def stats(self):
+        return {
+            'queued': self._queue.qsize(),
+            'max_queued': self.max_depth,
+            'completed': self.completed,
+            'failed': self.failed,
+            'ran_inline': self.ran_inline,
+            'workers': self.workers,
+        }
+
+    def drain(self):
+        """Run every queued task in the calling thread; returns how many ran"""
+        count = 0
+        while True:
+            try:
+                func, args, kwargs = self._queue.get_nowait()
+            except queue.Empty:
+                return count
+            self._run(func, args, kwargs)
+            self._queue.task_done()
+            count += 1
+
+    def _run(self, func, args, kwargs):
+        try:
+            func(*args, **kwargs)
+        except Exception:
+            self.failed += 1
+            logger.exception('Deferred task %s failed', getattr(func, '__qualname__', func))
+        else:
+            self.completed += 1
+
+    def _ensure_threads(self):
+        # After a fork (e.g. preloading app servers) the child has no workers
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._threads = [
+                threading.Thread(target=self._work, name=f'deferred-{number}', daemon=True)
+                for number in range(self.workers)
+            ]
+            for thread in self._threads:
+                thread.start()
+
+    def _work(self):
+        while True:
+            func, args, kwargs = self._queue.get()
+            close_old_connections()
+            self._run(func, args, kwargs)
+            self._queue.task_done()
+            if self._queue.empty():
+                # Idle workers should not hold database connections open
+                connection.close()
+
+
+tasks = DeferredQueue()
+
+
+def defer(func, *args, **kwargs):
+    """Run ``func(*args, **kwargs)`` after the current response has been sent"""
+    pending = getattr(_request, 'pending', None)
+    if pending is None:
+        tasks._run(func, args, kwargs)
+        return
+    pending.append((func, args, kwargs))
+
+
+def stats():
+    return tasks.stats()
+
+
+def _start_request(**kwargs):
+    _request.pending = []
+
+
+def _finish_request(**kwargs):
+    pending = getattr(_request, 'pending', None)
+    _request.pending = None
+    for func, args, task_kwargs in pending or ():
+        tasks.submit(func, args, task_kwargs)
+
+
+request_started.connect(_start_request, dispatch_uid='kb.deferred.start_request')
+request_finished.connect(_finish_request, dispatch_uid='kb.deferred.finish_request')
+# Registered after kb.buffers (imported above), so it runs first: the
+# remaining tasks may still queue rows for the buffers to flush
+atexit.register(tasks.drain)
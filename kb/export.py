@@ -0,0 +1,298 @@
+"""
+Columnar export of view and engagement events for offline analysis.
+
+Each dataset (article views, ratings, paragraph likes, read status) is
+written as one directory per export run::
+
+    <out>/<dataset>/<run>/meta.json
+    <out>/<dataset>/<run>/<column>.npy
+
+Numbers are int64/int32/int8/bool arrays, timestamps ``datetime64[us]`` in
+UTC (NaT for none). String columns are dictionary-encoded: ``<column>.npy``
+holds int32 codes (-1 for none) into the list of distinct values stored
+under ``dictionaries`` in ``meta.json``. Missing foreign keys are -1.
+
+Tables are read in keyset-ordered chunks of ``CHUNK_SIZE`` rows and each
+chunk is appended to raw per-column files, which are turned into ``.npy``
+files at the end, so no table is ever held in memory; only the string
+dictionaries are.
+
+Exports are incremental. ``<out>/watermarks.json`` records, per source
+table, the last exported position: the id for append-only tables, or
+``(timestamp, id)`` of the last change for tables whose rows are updated
+(ratings, likes, read status). A run exports what changed since then, up
+to the state when the run started, and only then advances the watermark.
+An updated row appears again in a later run; analysts keep the latest
+copy of each id.
+
+Article views are read from every monthly partition. Their ids are unique
+across partitions and grow from month to month (see ``kb.partitions``), so
+the id is the key of a view and every watermark is one of those ids. Each
+partition keeps its own, so a view written late into an earlier month is
+still exported; views moved out of the legacy table keep their ids and the
+legacy table's watermark. ``meta.json`` describes each dataset's key under
+``key``.
+"""
+import json
+import os
+import shutil
+from datetime import timezone as dt_timezone
+
+import numpy as np
+from django.db.models import Max, Q
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from . import partitions
+
+CHUNK_SIZE = 10000
+WATERMARK_FILE = 'watermarks.json'
+META_FILE = 'meta.json'
+
+INT64 = 'int64'
+INT32 = 'int32'
+INT8 = 'int8'
+BOOL = 'bool'
+DATETIME = 'datetime64[us]'
+STRING = 'string'
+
+
+def _article_view_sources():
+    from .models import ArticleView, article_view_partitions
+
+    legacy = ArticleView._meta.db_table
+    sources = []
+    for queryset in article_view_partitions.querysets():
+        table = queryset.model._meta.db_table
+        if table == legacy:
+            sources.append((legacy, queryset))
+        else:
+            sources.append((legacy, queryset.filter(id__lt=partitions.ID_SPAN)))
+            sources.append((table, queryset.filter(id__gte=partitions.ID_SPAN)))
+    return sources
+
+
+def _model_source(label):
+    def sources():
+        from django.apps import apps
+
+        model = apps.get_model(label)
+        return [(model._meta.db_table, model.objects.all())]
+    return sources
+
+
+# Described in meta.json; every dataset is keyed by its id column
+KEYS = {
+    'article_views': 'id, unique across the monthly partitions: YYYYMM * 10^10 + n for views '
+                     'written since partitioning, smaller ids for older views',
+    'ratings': 'id; a rating changed since an earlier export appears again with the same id',
+    'paragraph_likes': 'id; a like changed since an earlier export appears again with the same id',
+    'read_status': 'id; a read status changed since an earlier export appears again with the same id',
+}
+
+# name: (sources, changed-at field or None for append-only, [(column, type)])
+DATASETS = {
+    'article_views': (_article_view_sources, None, [
+        ('id', INT64), ('article_id', INT64), ('user_id', INT64), ('viewed_at', DATETIME),
+        ('ip_address', STRING), ('user_agent', STRING), ('referrer', STRING), ('session_key', STRING),
+    ]),
+    'ratings': (_model_source('kb.ArticleRating'), 'updated_at', [
+        ('id', INT64), ('article_id', INT64), ('user_id', INT64), ('rating', INT8),
+        ('created_at', DATETIME), ('updated_at', DATETIME),
+    ]),
+    'paragraph_likes': (_model_source('kb.ParagraphLike'), 'updated_at', [
+        ('id', INT64), ('paragraph_id', INT64), ('user_id', INT64), ('is_like', BOOL),
+        ('created_at', DATETIME), ('updated_at', DATETIME),
+    ]),
+    'read_status': (_model_source('kb.ArticleReadStatus'), 'last_read_at', [
+        ('id', INT64), ('article_id', INT64), ('user_id', INT64), ('read_count', INT32),
+        ('first_read_at', DATETIME), ('last_read_at', DATETIME),
+    ]),
+}
+
+
+# Watermarks
+
+def _read_watermarks(out_dir):
+    path = os.path.join(out_dir, WATERMARK_FILE)
+    if not os.path.exists(path):
+        return {}
+    with open(path, encoding='utf-8') as handle:
+        return json.load(handle)
+
+
+def _write_watermarks(out_dir, watermarks):
+    path = os.path.join(out_dir, WATERMARK_FILE)
+    temporary = path + '.tmp'
+    with open(temporary, 'w', encoding='utf-8') as handle:
+        json.dump(watermarks, handle, indent=2, sort_keys=True)
+    os.replace(temporary, path)
+
+
+# Columns
+
+def _utc_naive(value):
+    if value is None:
+        return None
+    if timezone.is_aware(value):
+        value = value.astimezone(dt_timezone.utc).replace(tzinfo=None)
+    return value
+
+
+class _ColumnWriter:
+    """Appends chunks of one column to a raw file, then converts it to .npy"""
+
+    def __init__(self, directory, name, kind):
+        self.name = name
+        self.kind = kind
+        self.dtype = np.dtype(INT32 if kind == STRING else kind)
+        self.raw_path = os.path.join(directory, f'{name}.raw')
+        self.npy_path = os.path.join(directory, f'{name}.npy')
+        self.dictionary = {}
+        self.rows = 0
+
+    def append(self, values):
+        if self.kind == STRING:
+            codes = []
+            for value in values:
+                if value is None:
+                    codes.append(-1)
+                else:
+                    codes.append(self.dictionary.setdefault(value, len(self.dictionary)))
+            array = np.array(codes, dtype=self.dtype)
+        elif self.kind == DATETIME:
+            array = np.array([_utc_naive(value) or np.datetime64('NaT') for value in values], dtype=self.dtype)
+        elif self.kind == BOOL:
+            array = np.array(values, dtype=self.dtype)
+        else:
+            array = np.array([-1 if value is None else value for value in values], dtype=self.dtype)
+        with open(self.raw_path, 'ab') as handle:
+            handle.write(array.tobytes())
+        self.rows += len(array)
+
+    def finish(self):
+        target = np.lib.format.open_memmap(self.npy_path, mode='w+', dtype=self.dtype, shape=(self.rows,))
+        if self.rows:
+            source = np.memmap(self.raw_path, dtype=self.dtype, mode='r', shape=(self.rows,))
+            for start in range(0, self.rows, CHUNK_SIZE):
+                target[start:start + CHUNK_SIZE] = source[start:start + CHUNK_SIZE]
+            del source
+        target.flush()
+        del target
+        if os.path.exists(self.raw_path):
+            os.remove(self.raw_path)
+
+    def describe(self):
+        description = {'type': self.kind, 'dtype': self.dtype.str}
+        if self.kind == STRING:
+            description['dictionary_size'] = len(self.dictionary)
+        return description
+
+
+# Reading
+
+def _chunks(queryset, columns, changed_field, after, upto, chunk_size):
+    """
+    Yield ``(rows, position)`` for the rows of ``queryset`` between two
+    watermarks, in keyset order, one query per chunk
+    """
+    names = [name for name, _ in columns]
+    id_index = names.index('id')
+    if changed_field is None:
+        queryset = queryset.filter(id__lte=upto).order_by('id')
+    else:
+        queryset = queryset.filter(**{f'{changed_field}__lte': upto}).order_by(changed_field, 'id')
+        changed_index = names.index(changed_field)
+
+    position = after
+    while True:
+        page = queryset
+        if changed_field is None:
+            page = page.filter(id__gt=position or 0)
+        elif position is not None:
+            changed_at, last_id = position
+            page = page.filter(
+                Q(**{f'{changed_field}__gt': changed_at}) | Q(**{changed_field: changed_at, 'id__gt': last_id})
+            )
+        rows = list(page.values_list(*names)[:chunk_size])
+        if not rows:
+            return
+        last = rows[-1]
+        position = last[id_index] if changed_field is None else (last[changed_index], last[id_index])
+        yield rows, position
+
+
+def _encode_position(position):
+    if isinstance(position, tuple):
+        return [position[0].isoformat(), position[1]]
+    return position
+
+
+def _decode_position(value):
+    if isinstance(value, list):
+        return parse_datetime(value[0]), value[1]
+    return value
+
+
+def export_dataset(name, out_dir, full=False, chunk_size=CHUNK_SIZE):
+    """
+    Export rows of a dataset changed since its watermarks. Returns
+    ``(rows, run_dir)``; run_dir is None when there was nothing new.
+    """
+    sources, changed_field, columns = DATASETS[name]
+    watermarks = _read_watermarks(out_dir)
+    dataset_marks = {} if full else watermarks.get(name, {})
+    new_marks = dict(dataset_marks)
+
+    run = timezone.now().strftime('%Y%m%dT%H%M%S%fZ')
+    run_dir = os.path.join(out_dir, name, run)
+    os.makedirs(run_dir)
+    writers = [_ColumnWriter(run_dir, column, kind) for column, kind in columns]
+
+    rows_written = 0
+    try:
+        for watermark, queryset in sources():
+            # Everything up to the state at the start of this run
+            upto = timezone.now() if changed_field else queryset.aggregate(top=Max('id'))['top']
+            if upto is None:
+                continue
+            after = _decode_position(dataset_marks.get(watermark))
+            position = None
+            for rows, position in _chunks(queryset, columns, changed_field, after, upto, chunk_size):
+                for index, writer in enumerate(writers):
+                    writer.append([row[index] for row in rows])
+                rows_written += len(rows)
+            if position is not None:
+                if changed_field is None:
+                    # Sources sharing a watermark (legacy views) each end somewhere
+                    position = max(position, new_marks.get(watermark) or 0)
+                new_marks[watermark] = _encode_position(position)
+
+        if not rows_written:
+            shutil.rmtree(run_dir)
+            return 0, None
+
+        for writer in writers:
+            writer.finish()
+        meta = {
+            'dataset': name,
+            'rows': rows_written,
+            'exported_at': timezone.now().isoformat(),
+            'full': full,
+            'key': {'column': 'id', 'description': KEYS[name]},
+            'watermarks_from': dataset_marks,
+            'watermarks_to': new_marks,
+            'columns': {writer.name: writer.describe() for writer in writers},
+            'dictionaries': {
+                writer.name: list(writer.dictionary) for writer in writers if writer.kind == STRING
+            },
+        }
+        with open(os.path.join(run_dir, META_FILE), 'w', encoding='utf-8') as handle:
+            json.dump(meta, handle)
+    except BaseException:
+        shutil.rmtree(run_dir, ignore_errors=True)
+        raise
+
+    watermarks[name] = new_marks
+    _write_watermarks(out_dir, watermarks)
+    return rows_written, run_dir
@@ -0,0 +1,176 @@
+"""
+Facet counts for search results.
+
+Facets are computed from the candidate article ids of a search in a single
+pass: one query loads (space, status, author) for the candidates and one
+loads their tag hierarchy. From those rows we build per-facet posting sets
+({value: {article_id, ...}}), so every facet count is the size of a set.
+The candidates are every match of the search (up to its candidate limit),
+already narrowed by field clauses and selected facets inside the search
+query (see ``field_queryset``), not just the page of results shown. The
+cost depends on the number of candidates, never on the size of the
+article table. When a search matches more articles than its candidate
+limit, the counts are lower bounds and are shown as such ("12+").
+"""
+from urllib.parse import urlencode
+
+from .models import Article
+
+# (facet name, GET parameter type, label shown in the UI)
+FACETS = (
+    ('space', int, 'Space'),
+    ('status', str, 'Status'),
+    ('author', int, 'Author'),
+    ('tag_group', int, 'Tag Group'),
+    ('tag_category', int, 'Tag Category'),
+    ('tag', int, 'Tag'),
+)
+FACET_NAMES = tuple(name for name, _, _ in FACETS)
+# ORM lookups selecting articles by a set of facet values
+FACET_LOOKUPS = {
+    'space': 'space_id__in',
+    'status': 'status__in',
+    'author': 'author_id__in',
+    'tag_group': 'tags__category__group_id__in',
+    'tag_category': 'tags__category_id__in',
+    'tag': 'tags__id__in',
+}
+STATUS_LABELS = dict(Article.STATUS_CHOICES)
+
+
+def parse_filters(params):
+    """Read facet filters (?space=1&status=live...) from a QueryDict"""
+    filters = {}
+    for name, value_type, _ in FACETS:
+        raw = params.get(name)
+        if not raw:
+            continue
+        try:
+            filters[name] = value_type(raw)
+        except (TypeError, ValueError):
+            continue
+    return filters
+
+
+def field_queryset(include=None, exclude=None, filters=None):
+    """
+    Articles having any of the included values of every facet in ``include``
+    and none of the values in ``exclude`` ({facet: {values}}), and the value
+    of every facet filter picked in the UI ({facet: value}), for searches to
+    be restricted to inside the database
+    """
+    articles = Article.objects.order_by()
+    for facet, values in (include or {}).items():
+        articles = articles.filter(**{FACET_LOOKUPS[facet]: values})
+    for facet, values in (exclude or {}).items():
+        if values:
+            articles = articles.exclude(**{FACET_LOOKUPS[facet]: values})
+    for facet, value in (filters or {}).items():
+        articles = articles.filter(**{FACET_LOOKUPS[facet]: [value]})
+    return articles
+
+
+class FacetIndex:
+    """Per-facet posting sets for a fixed set of candidate article ids"""
+
+    def __init__(self, article_ids):
+        self.article_ids = set(article_ids)
+        self.postings = {name: {} for name in FACET_NAMES}
+        self.labels = {name: {} for name in FACET_NAMES}
+        if self.article_ids:
+            self._load()
+
+    def _add(self, facet, value, label, article_id):
+        if value is None:
+            return
+        self.postings[facet].setdefault(value, set()).add(article_id)
+        self.labels[facet][value] = label
+
+    def _load(self):
+        articles = Article.objects.filter(id__in=self.article_ids).values_list(
+            'id', 'space_id', 'space__name', 'status', 'author_id', 'author__username'
+        )
+        for article_id, space_id, space_name, status, author_id, author_name in articles:
+            self._add('space', space_id, space_name, article_id)
+            self._add('status', status, STATUS_LABELS.get(status, status), article_id)
+            self._add('author', author_id, author_name, article_id)
+
+        tags = Article.tags.through.objects.filter(article_id__in=self.article_ids).values_list(
+            'article_id',
+            'tag_id', 'tag__name',
+            'tag__category_id', 'tag__category__name',
+            'tag__category__group_id', 'tag__category__group__name',
+        )
+        for article_id, tag_id, tag_name, category_id, category_name, group_id, group_name in tags:
+            self._add('tag', tag_id, tag_name, article_id)
+            self._add('tag_category', category_id, category_name, article_id)
+            self._add('tag_group', group_id, group_name, article_id)
+
+    def select(self, include=None, exclude=None):
+        """
+        Article ids having any of the included values of every facet in
+        ``include`` and none of the values in ``exclude`` ({facet: {values}})
+        """
+        matched = set(self.article_ids)
+        for facet, values in (include or {}).items():
+            union = set()
+            for value in values:
+                union |= self.postings[facet].get(value, set())
+            matched &= union
+        for facet, values in (exclude or {}).items():
+            for value in values:
+                matched -= self.postings[facet].get(value, set())
+        return matched
+
+    def counts(self, matched):
+        """{facet: [(value, label, count), ...]} restricted to ``matched`` ids"""
+        result = {}
+        for facet in FACET_NAMES:
+            values = []
+            for value, ids in self.postings[facet].items():
+                count = len(ids & matched)
+                if count:
+                    values.append((value, self.labels[facet][value], count))
+            values.sort(key=lambda item: (-item[2], str(item[1]).lower()))
+            result[facet] = values
+        return result
+
+
+def compute_facets(article_ids):
+    """Count every facet value over all the candidate ids of a search"""
+    index = FacetIndex(article_ids)
+    return index.counts(index.article_ids)
+
+
+def facet_links(counts, filters, params):
+    """
+    Decorate facet counts for templates: each value gets a ``selected`` flag
+    and a query string that toggles it while keeping the other parameters.
+    """
+    links = []
+    for name, _, title in FACETS:
+        values = []
+        for value, label, count in counts.get(name, []):
+            selected = filters.get(name) == value
+            query = {key: params.get(key) for key in params if params.get(key)}
+            if selected:
+                query.pop(name, None)
+            else:
+                query[name] = value
+            values.append({
+                'value': value,
+                'label': label,
+                'count': count,
+                'selected': selected,
+                'querystring': urlencode(query),
+            })
+        if values:
+            links.append({'name': name, 'title': title, 'values': values})
+    return links
+
+
+def facets_as_json(counts):
+    return {
+        facet: [{'value': value, 'label': label, 'count': count} for value, label, count in values]
+        for facet, values in counts.items()
+    }
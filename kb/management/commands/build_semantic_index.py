@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+
+from kb import semantic
+
+
+class Command(BaseCommand):
+    help = 'Build or incrementally update the latent semantic index used for "more like this"'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--full', action='store_true',
+                            help='Rebuild vocabulary and projection from every paragraph')
+
+    def handle(self, *args, **options):
+        if not options['full']:
+            self.stdout.write('Updating semantic index...')
+            updated = semantic.update()
+            if updated is not None:
+                articles, paragraphs = updated
+                self.stdout.write(self.style.SUCCESS(
+                    f'Re-embedded {paragraphs} paragraphs from {articles} changed articles'
+                ))
+                return
+            self.stdout.write('Index was missing or needed compaction; rebuilt it in full.')
+            return
+
+        self.stdout.write('Building semantic index...')
+        paragraphs, dimensions = semantic.build()
+        self.stdout.write(self.style.SUCCESS(
+            f'Indexed {paragraphs} paragraphs in {dimensions} dimensions'
+        ))
@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand
+
+from kb import retention
+
+
+class Command(BaseCommand):
+    help = 'Fold raw article views older than the retention window into daily breakdowns and delete them'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=None,
+                            help=f'Keep raw views this many days (default: ARTICLE_VIEW_RETENTION_DAYS, '
+                                 f'{retention.DEFAULT_RETENTION_DAYS})')
+        parser.add_argument('--batch-size', type=int, default=retention.DELETE_BATCH_SIZE,
+                            help='Raw views deleted per transaction')
+        parser.add_argument('--pause', type=float, default=0,
+                            help='Seconds to wait between batches so other writers get the lock')
+        parser.add_argument('--vacuum', action='store_true',
+                            help='VACUUM afterwards to return the freed space to the file system (SQLite)')
+
+    def handle(self, *args, **options):
+        stats = retention.compact(
+            days=options['days'],
+            batch_size=options['batch_size'],
+            pause=options['pause'],
+            vacuum=options['vacuum'],
+        )
+        self.stdout.write(self.style.SUCCESS(
+            f"Compacted {stats['rows']} article views (~{stats['row_bytes']} bytes of raw data): "
+            f"{stats['partitions']} monthly partitions dropped, {stats['batches']} delete batches"
+        ))
+        if stats['freed_bytes'] is not None:
+            where = 'returned to the file system' if options['vacuum'] else 'freed for reuse'
+            self.stdout.write(f"{stats['freed_bytes']} database bytes {where}")
@@ -0,0 +1,31 @@
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from kb import export
+
+
+class Command(BaseCommand):
+    help = 'Export view and engagement events to columnar .npy files, incrementally from the last export'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--out', default=os.path.join(settings.BASE_DIR, 'exports'),
+                            help='Directory for the export runs and watermarks (default: ./exports)')
+        parser.add_argument('--dataset', action='append', choices=sorted(export.DATASETS),
+                            help='Dataset to export; repeat for several (default: all)')
+        parser.add_argument('--full', action='store_true',
+                            help='Ignore the watermarks and export every row')
+        parser.add_argument('--chunk-size', type=int, default=export.CHUNK_SIZE,
+                            help='Rows read per query')
+
+    def handle(self, *args, **options):
+        os.makedirs(options['out'], exist_ok=True)
+        for name in options['dataset'] or sorted(export.DATASETS):
+            rows, run_dir = export.export_dataset(
+                name, options['out'], full=options['full'], chunk_size=options['chunk_size']
+            )
+            if run_dir is None:
+                self.stdout.write(f'{name}: nothing new since the last export')
+            else:
+                self.stdout.write(self.style.SUCCESS(f'{name}: exported {rows} rows to {run_dir}'))
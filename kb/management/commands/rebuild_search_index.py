@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+
+from kb import percolator, search
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the full-text search index for articles and paragraphs'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='Number of rows inserted per batch')
+
+    def handle(self, *args, **options):
+        if not search.fts_available():
+            self.stdout.write(self.style.WARNING('Full-text index requires SQLite FTS5; nothing to rebuild.'))
+            return
+
+        self.stdout.write('Rebuilding search index...')
+        articles, paragraphs = search.rebuild_index(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(
+            f'Indexed {articles} articles and {paragraphs} paragraphs'
+        ))
+
+        saved_searches = percolator.rebuild()
+        self.stdout.write(self.style.SUCCESS(f'Re-indexed {saved_searches} saved searches'))
@@ -0,0 +1,64 @@
+from django.core.management.base import BaseCommand
+
+from kb.models import Article, ArticleParagraph
+
+BATCH_SIZE = 1000
+
+
+class Command(BaseCommand):
+    help = ("Verify the rating, comment and favorite counters of articles and the like counters of paragraphs "
+            "against their rows and repair any drift")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--check', action='store_true',
+                            help='Only report drifted counters, change nothing')
+        parser.add_argument('--all', action='store_true',
+                            help='Recompute every row instead of only the drifted ones')
+        parser.add_argument('--batch-size', type=int, default=BATCH_SIZE,
+                            help='Rows verified per query')
+
+    def handle(self, *args, **options):
+        for model in (Article, ArticleParagraph):
+            self.repair(model, options)
+
+    def repair(self, model, options):
+        counters = model.ENGAGEMENT_COUNTERS
+        columns = ['pk', 'title', *counters, *(f'counted_{name}' for name in counters)]
+        label = model._meta.verbose_name
+        checked = drifted = repaired = 0
+        last_id = 0
+        while True:
+            rows = list(
+                model.objects.filter(pk__gt=last_id).order_by('pk')
+                .with_counted_engagement().values_list(*columns)[:options['batch_size']]
+            )
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            checked += len(rows)
+
+            drifted_ids = []
+            for row in rows:
+                stored = row[2:2 + len(counters)]
+                counted = row[2 + len(counters):]
+                if stored != counted:
+                    drifted_ids.append(row[0])
+                    changes = ', '.join(
+                        f'{name} {was} -> {now}' for name, was, now in zip(counters, stored, counted) if was != now
+                    )
+                    self.stdout.write(f'{label.capitalize()} {row[0]} "{row[1]}": {changes}')
+            drifted += len(drifted_ids)
+
+            if options['check']:
+                continue
+            batch_ids = [row[0] for row in rows] if options['all'] else drifted_ids
+            if batch_ids:
+                # Recounted in the UPDATE itself, so writes since the check are not lost
+                repaired += model.objects.filter(pk__in=batch_ids).recount_engagement()
+
+        summary = f'Checked {checked} {label}s, {drifted} with drifted counters'
+        if options['check']:
+            style = self.style.WARNING if drifted else self.style.SUCCESS
+            self.stdout.write(style(summary))
+        else:
+            self.stdout.write(self.style.SUCCESS(f'{summary}, {repaired} recounted'))
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+
+from kb import analytics
+
+
+class Command(BaseCommand):
+    help = 'Fold the search log into daily per-query statistics'
+
+    def handle(self, *args, **options):
+        # Entries still buffered in this process would otherwise wait for the next run
+        analytics.buffer.flush()
+        processed = analytics.rollup()
+        self.stdout.write(self.style.SUCCESS(f'Rolled up {processed} search log entries'))
@@ -0,0 +1,51 @@
+from datetime import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+
+from kb.models import article_view_partitions, share_link_view_partitions
+
+PARTITIONED = {
+    'article': article_view_partitions,
+    'share': share_link_view_partitions,
+}
+
+
+class Command(BaseCommand):
+    help = 'List, expire or fill the monthly partitions of article and share link views'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--only', choices=sorted(PARTITIONED),
+                            help='Limit to article views or share link views')
+        parser.add_argument('--drop-before', metavar='YYYY-MM',
+                            help='Drop every partition for a month before this one. Article views '
+                                 'dropped this way skip the referrer and user-agent breakdowns '
+                                 'kept by compact_article_views')
+        parser.add_argument('--absorb-legacy', action='store_true',
+                            help='Move rows written before partitioning into their monthly partitions')
+
+    def handle(self, *args, **options):
+        selected = {options['only']: PARTITIONED[options['only']]} if options['only'] else PARTITIONED
+
+        if options['drop_before']:
+            try:
+                before = datetime.strptime(options['drop_before'], '%Y-%m').date()
+            except ValueError:
+                raise CommandError('--drop-before expects a month as YYYY-MM')
+            for name, view_partitions in selected.items():
+                for month in view_partitions.months():
+                    if month >= before:
+                        break
+                    rows = view_partitions.drop(month)
+                    self.stdout.write(f'Dropped {name} views {month:%Y-%m} ({rows} rows)')
+
+        if options['absorb_legacy']:
+            for name, view_partitions in selected.items():
+                moved = view_partitions.absorb_legacy()
+                self.stdout.write(self.style.SUCCESS(f'Moved {moved} legacy {name} views into monthly partitions'))
+
+        for name, view_partitions in selected.items():
+            legacy = view_partitions.model.legacy.count()
+            self.stdout.write(f'{name} views: {legacy} rows in the legacy table')
+            for month in view_partitions.months():
+                rows = view_partitions.model_for(month).objects.count()
+                self.stdout.write(f'  {view_partitions.table_name(month)}: {rows} rows')
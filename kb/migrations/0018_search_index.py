@@ -0,0 +1,69 @@
+# Creates the SQLite FTS5 tables used by kb.search
+
+import html
+import re
+
+from django.db import migrations
+from django.utils.html import strip_tags
+
+
+def _html_to_text(value):
+    if not value:
+        return ''
+    return re.sub(r'\s+', ' ', html.unescape(strip_tags(value))).strip()
+
+
+def create_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+
+    Article = apps.get_model('kb', 'Article')
+    ArticleParagraph = apps.get_model('kb', 'ArticleParagraph')
+
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS kb_article_fts USING fts5("
+            "title, summary, tokenize = 'porter unicode61 remove_diacritics 2')"
+        )
+        cursor.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS kb_paragraph_fts USING fts5("
+            "title, content, article_id UNINDEXED, "
+            "tokenize = 'porter unicode61 remove_diacritics 2')"
+        )
+
+        cursor.executemany(
+            "INSERT INTO kb_article_fts (rowid, title, summary) VALUES (%s, %s, %s)",
+            [
+                (pk, title, _html_to_text(summary))
+                for pk, title, summary in Article.objects.values_list('pk', 'title', 'summary')
+            ],
+        )
+        cursor.executemany(
+            "INSERT INTO kb_paragraph_fts (rowid, title, content, article_id) VALUES (%s, %s, %s, %s)",
+            [
+                (pk, title, _html_to_text(content), article_id)
+                for pk, title, content, article_id in ArticleParagraph.objects.values_list(
+                    'pk', 'title', 'content', 'article_id'
+                )
+            ],
+        )
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute("DROP TABLE IF EXISTS kb_paragraph_fts")
+        cursor.execute("DROP TABLE IF EXISTS kb_article_fts")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kb', '0017_tagcategory_taggroup_article_legacy_tags_and_more'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
@@ -0,0 +1,81 @@
+# Creates the trigram-indexed search vocabulary used for "did you mean"
+
+import html
+import re
+from collections import Counter
+
+from django.db import migrations
+from django.utils.html import strip_tags
+
+
+def _terms(*texts):
+    terms = set()
+    for text in texts:
+        text = html.unescape(strip_tags(text or '')).lower()
+        for token in re.findall(r'\w+', text):
+            if 3 <= len(token) <= 40 and not token.isdigit():
+                terms.add(token)
+    return terms
+
+
+def create_search_vocabulary(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+
+    Article = apps.get_model('kb', 'Article')
+    ArticleParagraph = apps.get_model('kb', 'ArticleParagraph')
+    Tag = apps.get_model('kb', 'Tag')
+    TagCategory = apps.get_model('kb', 'TagCategory')
+
+    vocabulary = Counter()
+    for title, summary in Article.objects.values_list('title', 'summary'):
+        vocabulary.update(_terms(title, summary))
+    for title, content in ArticleParagraph.objects.values_list('title', 'content'):
+        vocabulary.update(_terms(title, content))
+    for name in Tag.objects.values_list('name', flat=True):
+        vocabulary.update(_terms(name))
+    for name in TagCategory.objects.values_list('name', flat=True):
+        vocabulary.update(_terms(name))
+
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(
+            "CREATE TABLE IF NOT EXISTS kb_search_terms ("
+            "id INTEGER PRIMARY KEY, term TEXT NOT NULL UNIQUE, frequency INTEGER NOT NULL DEFAULT 0)"
+        )
+        cursor.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS kb_search_terms_trigram USING fts5("
+            "term, content = 'kb_search_terms', content_rowid = 'id', tokenize = 'trigram')"
+        )
+        cursor.execute(
+            "CREATE TRIGGER IF NOT EXISTS kb_search_terms_ai AFTER INSERT ON kb_search_terms BEGIN "
+            "INSERT INTO kb_search_terms_trigram (rowid, term) VALUES (new.id, new.term); END"
+        )
+        cursor.execute(
+            "CREATE TRIGGER IF NOT EXISTS kb_search_terms_ad AFTER DELETE ON kb_search_terms BEGIN "
+            "INSERT INTO kb_search_terms_trigram (kb_search_terms_trigram, rowid, term) "
+            "VALUES ('delete', old.id, old.term); END"
+        )
+        cursor.executemany(
+            "INSERT INTO kb_search_terms (term, frequency) VALUES (%s, %s)",
+            list(vocabulary.items()),
+        )
+
+
+def drop_search_vocabulary(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute("DROP TABLE IF EXISTS kb_search_terms_trigram")
+        cursor.execute("DROP TABLE IF EXISTS kb_search_terms")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kb', '0018_search_index'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_vocabulary, drop_search_vocabulary),
+    ]
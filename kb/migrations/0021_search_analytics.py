@@ -0,0 +1,43 @@
+# Generated by Django 5.2.18 on 2026-10-18 17:15
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kb', '0020_contentversion'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SearchLog',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('event', models.CharField(choices=[('search', 'Search'), ('click', 'Click')], default='search', max_length=10)),
+                ('query', models.CharField(max_length=255)),
+                ('result_count', models.PositiveIntegerField(default=0)),
+                ('article_id', models.BigIntegerField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='SearchQueryStat',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('query', models.CharField(max_length=255)),
+                ('searches', models.PositiveIntegerField(default=0)),
+                ('zero_result_searches', models.PositiveIntegerField(default=0)),
+                ('clicks', models.PositiveIntegerField(default=0)),
+            ],
+            options={
+                'verbose_name': 'Search Query Statistic',
+                'verbose_name_plural': 'Search Query Statistics',
+                'ordering': ['-day', '-searches'],
+                'indexes': [models.Index(fields=['day', '-searches'], name='kb_searchqu_day_f6a9c2_idx'), models.Index(fields=['day', '-zero_result_searches'], name='kb_searchqu_day_10df91_idx')],
+                'unique_together': {('day', 'query')},
+            },
+        ),
+    ]
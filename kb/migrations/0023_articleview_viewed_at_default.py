@@ -0,0 +1,19 @@
+# Generated by Django 5.2.18 on 2026-10-18 17:21
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kb', '0022_saved_searches'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='articleview',
+            name='viewed_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+    ]
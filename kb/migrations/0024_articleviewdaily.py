@@ -0,0 +1,49 @@
+# Generated by Django 5.2.18 on 2026-10-18 17:22
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Count, Q
+from django.db.models.functions import TruncDate
+
+
+def backfill_daily_views(apps, schema_editor):
+    ArticleView = apps.get_model('kb', 'ArticleView')
+    ArticleViewDaily = apps.get_model('kb', 'ArticleViewDaily')
+
+    rows = ArticleView.objects.annotate(day=TruncDate('viewed_at')).values('article_id', 'day').annotate(
+        views=Count('id'),
+        authenticated_views=Count('id', filter=Q(user__isnull=False)),
+        anonymous_views=Count('id', filter=Q(user__isnull=True)),
+    ).order_by()
+    ArticleViewDaily.objects.bulk_create(
+        [ArticleViewDaily(**row) for row in rows.iterator()],
+        batch_size=500,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kb', '0023_articleview_viewed_at_default'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArticleViewDaily',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('views', models.PositiveIntegerField(default=0)),
+                ('authenticated_views', models.PositiveIntegerField(default=0)),
+                ('anonymous_views', models.PositiveIntegerField(default=0)),
+                ('article', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='daily_views', to='kb.article')),
+            ],
+            options={
+                'verbose_name': 'Daily Article Views',
+                'verbose_name_plural': 'Daily Article Views',
+                'ordering': ['-day'],
+                'unique_together': {('article', 'day')},
+            },
+        ),
+        migrations.RunPython(backfill_daily_views, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,64 @@
+# Generated by Django 5.2.18 on 2026-10-18 17:23
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.utils import timezone
+
+from kb.hyperloglog import HyperLogLog
+
+
+def backfill_sketches(apps, schema_editor):
+    ArticleView = apps.get_model('kb', 'ArticleView')
+    ArticleViewDaily = apps.get_model('kb', 'ArticleViewDaily')
+    ArticleViewSketch = apps.get_model('kb', 'ArticleViewSketch')
+
+    daily = {}
+    overall = {}
+    views = ArticleView.objects.values_list('article_id', 'viewed_at', 'user_id', 'ip_address')
+    for article_id, viewed_at, user_id, ip_address in views.iterator():
+        key = f"user:{user_id}" if user_id else f"ip:{ip_address}"
+        day = timezone.localdate(viewed_at) if timezone.is_aware(viewed_at) else viewed_at.date()
+        daily.setdefault((article_id, day), HyperLogLog()).add(key)
+        overall.setdefault(article_id, HyperLogLog()).add(key)
+
+    for (article_id, day), sketch in daily.items():
+        ArticleViewDaily.objects.filter(article_id=article_id, day=day).update(
+            unique_sketch=sketch.to_bytes(), unique_views=sketch.count()
+        )
+    ArticleViewSketch.objects.bulk_create(
+        [
+            ArticleViewSketch(article_id=article_id, sketch=sketch.to_bytes(), unique_views=sketch.count())
+            for article_id, sketch in overall.items()
+        ],
+        batch_size=500,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kb', '0024_articleviewdaily'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArticleViewSketch',
+            fields=[
+                ('article', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='view_sketch', serialize=False, to='kb.article')),
+                ('sketch', models.BinaryField(default=b'')),
+                ('unique_views', models.PositiveIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='articleviewdaily',
+            name='unique_sketch',
+            field=models.BinaryField(default=b''),
+        ),
+        migrations.AddField(
+            model_name='articleviewdaily',
+            name='unique_views',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_sketches, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,42 @@
+# Generated by Django 5.2.18 on 2026-10-18 17:25
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kb', '0025_unique_view_sketches'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArticleViewBreakdown',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('kind', models.CharField(choices=[('referrer', 'Referrer'), ('user_agent', 'User agent')], max_length=20)),
+                ('value', models.CharField(max_length=255)),
+                ('views', models.PositiveIntegerField(default=0)),
+            ],
+            options={
+                'ordering': ['-day', '-views'],
+            },
+        ),
+        migrations.AddIndex(
+            model_name='articleview',
+            index=models.Index(fields=['viewed_at'], name='kb_articlev_viewed__e5d5eb_idx'),
+        ),
+        migrations.AddField(
+            model_name='articleviewbreakdown',
+            name='article',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='view_breakdowns', to='kb.article'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='articleviewbreakdown',
+            unique_together={('article', 'day', 'kind', 'value')},
+        ),
+    ]
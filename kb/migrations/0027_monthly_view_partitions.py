@@ -0,0 +1,89 @@
+# Generated by Django 5.2.18 on 2026-10-18 17:28
+
+import re
+
+import django.db.models.deletion
+import django.db.models.manager
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+
+
+def create_share_link_view_union(apps, schema_editor):
+    """Read every share link view through one database view, over the legacy table and any partitions"""
+    connection = schema_editor.connection
+    quote = connection.ops.quote_name
+    ShareLinkView = apps.get_model('kb', 'ShareLinkView')
+    columns = ', '.join(quote(field.column) for field in ShareLinkView._meta.concrete_fields)
+    tables = ['kb_sharelinkview'] + sorted(
+        table for table in connection.introspection.table_names() if re.match(r'^kb_sharelinkview_\d{6}$', table)
+    )
+    with connection.cursor() as cursor:
+        cursor.execute('CREATE VIEW kb_sharelinkview_all AS ' + ' UNION ALL '.join(
+            f'SELECT {columns} FROM {quote(table)}' for table in tables
+        ))
+
+
+def drop_share_link_view_union(apps, schema_editor):
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute('DROP VIEW IF EXISTS kb_sharelinkview_all')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kb', '0026_article_view_retention'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='sharelinkview',
+            name='viewed_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.CreateModel(
+            name='ShareLinkViewRecord',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('ip_address', models.GenericIPAddressField()),
+                ('user_agent', models.TextField()),
+                ('referrer', models.URLField(blank=True, null=True)),
+                ('viewed_at', models.DateTimeField()),
+            ],
+            options={
+                'verbose_name': 'share link view',
+                'db_table': 'kb_sharelinkview_all',
+                'ordering': ['-viewed_at'],
+                'managed': False,
+            },
+        ),
+        migrations.AlterModelManagers(
+            name='articleview',
+            managers=[
+                ('legacy', django.db.models.manager.Manager()),
+            ],
+        ),
+        migrations.AlterModelManagers(
+            name='sharelinkview',
+            managers=[
+                ('legacy', django.db.models.manager.Manager()),
+            ],
+        ),
+        migrations.AlterField(
+            model_name='articleview',
+            name='article',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='kb.article'),
+        ),
+        migrations.AlterField(
+            model_name='articleview',
+            name='user',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AlterField(
+            model_name='sharelinkview',
+            name='share_link',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='kb.securesharelink'),
+        ),
+        migrations.RunPython(create_share_link_view_union, drop_share_link_view_union),
+    ]
@@ -0,0 +1,56 @@
+# Generated by Django 5.2.18 on 2026-10-18 17:38
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+
+
+def count_engagement(apps, schema_editor):
+    Article = apps.get_model('kb', 'Article')
+    ArticleRating = apps.get_model('kb', 'ArticleRating')
+    ArticleComment = apps.get_model('kb', 'ArticleComment')
+    ArticleFavorite = apps.get_model('kb', 'ArticleFavorite')
+
+    def total(queryset, aggregate):
+        per_article = queryset.filter(article=OuterRef('pk')).order_by().values('article')
+        return Coalesce(Subquery(per_article.annotate(total=aggregate).values('total')), 0)
+
+    Article.objects.update(
+        rating_sum=total(ArticleRating.objects, Sum('rating')),
+        rating_count=total(ArticleRating.objects, Count('id')),
+        approved_comment_count=total(
+            ArticleComment.objects.filter(is_approved=True, parent__isnull=True), Count('id')
+        ),
+        favorites_count=total(ArticleFavorite.objects, Count('id')),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kb', '0027_monthly_view_partitions'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='article',
+            name='approved_comment_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='article',
+            name='favorites_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='article',
+            name='rating_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='article',
+            name='rating_sum',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(count_engagement, migrations.RunPython.noop),
+    ]
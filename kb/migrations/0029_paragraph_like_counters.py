@@ -0,0 +1,37 @@
+# Generated by Django 5.2.18 on 2026-10-18 17:40
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def count_likes(apps, schema_editor):
+    ArticleParagraph = apps.get_model('kb', 'ArticleParagraph')
+    ParagraphLike = apps.get_model('kb', 'ParagraphLike')
+
+    def total(is_like):
+        per_paragraph = ParagraphLike.objects.filter(paragraph=OuterRef('pk'), is_like=is_like).order_by()
+        return Coalesce(Subquery(per_paragraph.values('paragraph').annotate(total=Count('id')).values('total')), 0)
+
+    ArticleParagraph.objects.update(likes_count=total(True), dislikes_count=total(False))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kb', '0028_article_engagement_counters'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='articleparagraph',
+            name='dislikes_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='articleparagraph',
+            name='likes_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(count_likes, migrations.RunPython.noop),
+    ]
@@ -1,7 +1,12 @@
-from django.db import models
+from django.conf import settings
+from django.db import IntegrityError, connection, models, transaction
+from django.db.models import Count, F, OuterRef, Prefetch, Subquery, Sum
+from django.db.models.functions import Coalesce, Greatest
 from django.utils import timezone
 from django.contrib.auth.models import User
 from tinymce.models import HTMLField
+from . import bloom, buffers, coalesce, partitions
+from .hyperloglog import HyperLogLog, merged as merged_sketches
 import secrets
 import hashlib
 from datetime import timedelta
@@ -137,6 +142,65 @@ class Space(models.Model):
     class Meta:
         verbose_name_plural = "Spaces"
 
+def _fields_to_save(instance, counters, kwargs):
+    """
+    update_fields for a save() of ``instance``: when an existing row is saved
+    in full, every loaded field except the counters, which would otherwise be
+    written back as they were read and undo F() updates made since
+    """
+    if instance._state.adding or kwargs.get('force_insert') or kwargs.get('update_fields') is not None:
+        return kwargs.get('update_fields')
+    skipped = set(counters) | instance.get_deferred_fields()
+    return [field.name for field in instance._meta.concrete_fields
+            if not field.primary_key and field.attname not in skipped]
+
+
+def _total(queryset, field, aggregate):
+    """``aggregate`` over the rows of ``queryset`` whose ``field`` is the outer row, as a subquery"""
+    per_row = queryset.filter(**{field: OuterRef('pk')}).order_by().values(field)
+    return Coalesce(Subquery(per_row.annotate(total=aggregate).values('total')), 0)
+
+
+def _counted_engagement():
+    """Article's engagement counters as subqueries over the rows they count"""
+    def total(queryset, aggregate):
+        return _total(queryset, 'article', aggregate)
+
+    return {
+        'rating_sum': total(ArticleRating.objects, Sum('rating')),
+        'rating_count': total(ArticleRating.objects, Count('id')),
+        'approved_comment_count': total(
+            ArticleComment.objects.filter(is_approved=True, parent__isnull=True), Count('id')
+        ),
+        'favorites_count': total(ArticleFavorite.objects, Count('id')),
+    }
+
+
+class ArticleQuerySet(models.QuerySet):
+
+    def with_stats(self):
+        """
+        Annotate view_count and unique_view_count with correlated subqueries,
+        so a listing gets every article's counters in the same query that
+        loads the articles (favorites_count is a column of its own)
+        """
+        daily_views = ArticleViewDaily.objects.filter(article=OuterRef('pk')).order_by().values('article')
+        return self.annotate(
+            view_count=Coalesce(Subquery(daily_views.annotate(total=Sum('views')).values('total')), 0),
+            unique_view_count=Coalesce(Subquery(
+                ArticleViewSketch.objects.filter(article=OuterRef('pk')).values('unique_views')[:1]
+            ), 0),
+        )
+
+    def with_counted_engagement(self):
+        """Annotate counted_<counter> with each engagement counter recomputed from its rows"""
+        return self.annotate(**{f'counted_{name}': value for name, value in _counted_engagement().items()})
+
+    def recount_engagement(self):
+        """Recompute the engagement counters of these articles in one UPDATE; returns how many"""
+        return self.update(**_counted_engagement())
+
+
 class Article(models.Model):
     STATUS_CHOICES = [
         ('draft', 'Draft'),
@@ -153,25 +217,58 @@ class Article(models.Model):
     legacy_tags = models.JSONField(default=list, help_text="Legacy tags for backward compatibility")
     created_at = models.DateField(default=timezone.now)
     updated_at = models.DateField(default=timezone.now)
+    # Engagement counters, kept in step with F() updates where ratings,
+    # comments and favorites are written, and by post_delete receivers in
+    # kb.signals wherever they are removed; repair_engagement_counters
+    # recomputes them
+    rating_sum = models.PositiveIntegerField(default=0)
+    rating_count = models.PositiveIntegerField(default=0)
+    approved_comment_count = models.PositiveIntegerField(default=0)
+    favorites_count = models.PositiveIntegerField(default=0)
+    
+    objects = ArticleQuerySet.as_manager()
+    
+    ENGAGEMENT_COUNTERS = ('rating_sum', 'rating_count', 'approved_comment_count', 'favorites_count')
     
     def __str__(self):
         return self.title
     
+    def save(self, *args, **kwargs):
+        # Counters only change through adjust_counters, never from a form or the admin
+        if not args:
+            kwargs['update_fields'] = _fields_to_save(self, self.ENGAGEMENT_COUNTERS, kwargs)
+        super().save(*args, **kwargs)
+    
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # The stored status, so kb.signals can tell when an article goes live
+        if 'status' in field_names:
+            instance._loaded_status = values[field_names.index('status')]
+        return instance
+    
+    @property
+    def went_live(self):
+        """Whether the status saved last made this article live (it was new, or not live when loaded)"""
+        return self.status == 'live' and getattr(self, '_loaded_status', None) != 'live'
+    
     @property
     def content(self):
         """Backward compatibility property that combines all paragraph content"""
         return "".join([paragraph.content for paragraph in self.paragraphs.all().order_by('order')])
     
+    @classmethod
+    def adjust_counters(cls, article_id, **deltas):
+        """Add to an article's engagement counters in one UPDATE, e.g. adjust_counters(id, favorites_count=1)"""
+        changes = {name: Greatest(F(name) + delta, 0) for name, delta in deltas.items() if delta}
+        if changes:
+            cls.objects.filter(pk=article_id).update(**changes)
+    
     def average_rating(self):
-        """Calculate average rating for this article"""
-        ratings = self.ratings.all()
-        if not ratings:
+        """Average rating for this article, from its rating counters"""
+        if not self.rating_count:
             return 0
-        return sum(r.rating for r in ratings) / len(ratings)
-    
-    def rating_count(self):
-        """Get total number of ratings"""
-        return self.ratings.count()
+        return self.rating_sum / self.rating_count
     
     def get_user_rating(self, user):
         """Get rating by specific user"""
@@ -183,8 +280,8 @@ class Article(models.Model):
             return None
     
     def comment_count(self):
-        """Get total number of approved comments"""
-        return self.comments.filter(is_approved=True, parent__isnull=True).count()
+        """Number of approved top-level comments"""
+        return self.approved_comment_count
     
     def is_read_by_user(self, user):
         """Check if article has been read by a specific user"""
@@ -209,7 +306,7 @@ class Article(models.Model):
     
     def get_favorites_count(self):
         """Get total number of users who favorited this article"""
-        return self.favorites.count()
+        return self.favorites_count
     
     def is_read_later_by_user(self, user):
         """Check if this article has been saved for later reading by the given user"""
@@ -218,15 +315,18 @@ class Article(models.Model):
         return self.read_later.filter(user=user).exists()
     
     def get_view_count(self):
-        """Get total number of views for this article"""
-        return self.views.count()
-    
-    def get_unique_view_count(self):
-        """Get unique views (by user/IP) for this article"""
-        # Count unique users + unique anonymous IPs
-        user_views = self.views.filter(user__isnull=False).values('user').distinct().count()
-        anonymous_views = self.views.filter(user__isnull=True).values('ip_address').distinct().count()
-        return user_views + anonymous_views
+        """Get total number of views for this article, summed from the daily rollups"""
+        return self.daily_views.aggregate(total=Sum('views'))['total'] or 0
+    
+    def get_unique_view_count(self, start=None, end=None):
+        """
+        Estimated unique views (by user/IP) for this article, from HyperLogLog
+        sketches (~1.6% error). All-time counts read one row; a date range
+        merges that range's daily sketches.
+        """
+        if start is None and end is None:
+            return ArticleViewSketch.objects.filter(article=self).values_list('unique_views', flat=True).first() or 0
+        return ArticleViewDaily.unique_views_between(self.id, start, end)
     
     def record_view(self, request):
         """Record a view for this article"""
@@ -244,15 +344,49 @@ class Article(models.Model):
         # For anonymous users, use session key
         session_key = request.session.session_key or ''
         
-        # Create view record
-        ArticleView.objects.create(
+        # Refreshes and crawler re-fetches within the window are the same visit
+        user_id = request.user.id if request.user.is_authenticated else None
+        visitor = f"user:{user_id}" if user_id else f"ip:{ip}|{user_agent}"
+        if article_view_filter.seen(f"{self.id}|{visitor}"):
+            return
+        
+        # Queue the view record; it is written in a batch by a background thread
+        article_view_buffer.append(ArticleView(
             article=self,
             user=request.user if request.user.is_authenticated else None,
             ip_address=ip,
             user_agent=user_agent,
             referrer=referrer,
-            session_key=session_key
-        )
+            session_key=session_key,
+            viewed_at=timezone.now()
+        ))
+
+
+def _counted_likes():
+    """ArticleParagraph's like counters as subqueries over the likes they count"""
+    return {
+        'likes_count': _total(ParagraphLike.objects.filter(is_like=True), 'paragraph', Count('id')),
+        'dislikes_count': _total(ParagraphLike.objects.filter(is_like=False), 'paragraph', Count('id')),
+    }
+
+
+class ArticleParagraphQuerySet(models.QuerySet):
+
+    def with_user_likes(self, user):
+        """
+        Prefetch ``user``'s like or dislike of each paragraph, one query for
+        all of them, so user_like needs no query per paragraph
+        """
+        likes = ParagraphLike.objects.filter(user=user) if user.is_authenticated else ParagraphLike.objects.none()
+        return self.prefetch_related(Prefetch('likes', queryset=likes, to_attr='user_likes'))
+
+    def with_counted_engagement(self):
+        """Annotate counted_<counter> with each like counter recomputed from the likes"""
+        return self.annotate(**{f'counted_{name}': value for name, value in _counted_likes().items()})
+
+    def recount_engagement(self):
+        """Recompute the like counters of these paragraphs in one UPDATE; returns how many"""
+        return self.update(**_counted_likes())
 
 
 class ArticleParagraph(models.Model):
@@ -262,6 +396,14 @@ class ArticleParagraph(models.Model):
     order = models.PositiveIntegerField(default=0)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
+    # Like counters, kept in step by ParagraphLike.react and by a post_delete
+    # receiver in kb.signals; repair_engagement_counters recomputes them
+    likes_count = models.PositiveIntegerField(default=0)
+    dislikes_count = models.PositiveIntegerField(default=0)
+    
+    objects = ArticleParagraphQuerySet.as_manager()
+    
+    ENGAGEMENT_COUNTERS = ('likes_count', 'dislikes_count')
     
     class Meta:
         ordering = ['order']
@@ -269,13 +411,32 @@ class ArticleParagraph(models.Model):
     def __str__(self):
         return f"{self.article.title} - {self.title}"
     
+    def save(self, *args, **kwargs):
+        # Like counters only change through adjust_counters (see Article.save)
+        if not args:
+            kwargs['update_fields'] = _fields_to_save(self, self.ENGAGEMENT_COUNTERS, kwargs)
+        super().save(*args, **kwargs)
+    
+    @classmethod
+    def adjust_counters(cls, paragraph_id, **deltas):
+        """Add to a paragraph's like counters in one UPDATE, e.g. adjust_counters(id, likes_count=1)"""
+        changes = {name: Greatest(F(name) + delta, 0) for name, delta in deltas.items() if delta}
+        if changes:
+            cls.objects.filter(pk=paragraph_id).update(**changes)
+    
     def like_count(self):
         """Get number of likes for this paragraph"""
-        return self.likes.filter(is_like=True).count()
+        return self.likes_count
     
     def dislike_count(self):
         """Get number of dislikes for this paragraph"""
-        return self.likes.filter(is_like=False).count()
+        return self.dislikes_count
+    
+    @property
+    def user_like(self):
+        """The prefetched user's like status (see with_user_likes): True, False or None"""
+        likes = getattr(self, 'user_likes', None)
+        return likes[0].is_like if likes else None
     
     def get_user_like_status(self, user):
         """Get user's like status for this paragraph (True=like, False=dislike, None=no action)"""
@@ -401,11 +562,36 @@ class SecureShareLink(models.Model):
         """Check if the link is valid (active and not expired)"""
         return self.is_active and not self.is_expired
     
-    def record_view(self):
-        """Record a view on this share link"""
+    def record_view(self, ip_address, user_agent='', referrer=None):
+        """
+        Record a view on this share link. The ShareLinkView row and the
+        counter update are buffered; each flush writes all views with one
+        bulk insert and one UPDATE per link (see record_batch).
+        """
+        now = timezone.now()
+        share_link_view_buffer.append(ShareLinkView(
+            share_link=self,
+            ip_address=ip_address,
+            user_agent=user_agent,
+            referrer=referrer,
+            viewed_at=now,
+        ))
+        # Reflect the view on this instance for the page being rendered
         self.view_count += 1
-        self.last_accessed = timezone.now()
-        self.save(update_fields=['view_count', 'last_accessed'])
+        self.last_accessed = now
+    
+    @classmethod
+    def record_batch(cls, views):
+        """Add a batch of ShareLinkView rows to the link counters, one atomic UPDATE per link"""
+        hits = {}
+        for view in views:
+            count, last = hits.get(view.share_link_id, (0, view.viewed_at))
+            hits[view.share_link_id] = (count + 1, max(last, view.viewed_at))
+        for share_link_id, (count, last_accessed) in hits.items():
+            cls.objects.filter(pk=share_link_id).update(
+                view_count=F('view_count') + count,
+                last_accessed=Greatest(Coalesce('last_accessed', last_accessed), last_accessed),
+            )
     
     @classmethod
     def cleanup_expired(cls):
@@ -463,11 +649,15 @@ class SecureShareLink(models.Model):
 
 class ShareLinkView(models.Model):
     """Track individual views on shared links"""
-    share_link = models.ForeignKey(SecureShareLink, on_delete=models.CASCADE, related_name='views')
+    share_link = models.ForeignKey(SecureShareLink, on_delete=models.CASCADE, related_name='+')
     ip_address = models.GenericIPAddressField()
     user_agent = models.TextField()
     referrer = models.URLField(null=True, blank=True)
-    viewed_at = models.DateTimeField(auto_now_add=True)
+    viewed_at = models.DateTimeField(default=timezone.now)
+    
+    # Only rows written before partitioning; read views through
+    # share_link_view_partitions or ShareLinkViewRecord
+    legacy = models.Manager()
     
     class Meta:
         ordering = ['-viewed_at']
@@ -480,6 +670,36 @@ class ShareLinkView(models.Model):
         return f"View of {self.share_link.article.title} at {self.viewed_at}"
 
 
+class ShareLinkViewRecord(models.Model):
+    """Every share link view, partitioned or not, read-only (a database view kept by kb.partitions)"""
+    share_link = models.ForeignKey(SecureShareLink, on_delete=models.DO_NOTHING, related_name='+', db_constraint=False)
+    ip_address = models.GenericIPAddressField()
+    user_agent = models.TextField()
+    referrer = models.URLField(null=True, blank=True)
+    viewed_at = models.DateTimeField()
+    
+    class Meta:
+        managed = False
+        db_table = 'kb_sharelinkview_all'
+        ordering = ['-viewed_at']
+        verbose_name = 'share link view'
+    
+    def __str__(self):
+        return f"View of {self.share_link.article.title} at {self.viewed_at}"
+
+
+# Rows are stored in one table per month (kb_sharelinkview_YYYYMM)
+share_link_view_partitions = partitions.MonthlyPartitions(
+    ShareLinkView, 'viewed_at', index_prefix='kb_slv', union_model=ShareLinkViewRecord,
+)
+
+# Shared link hits are written in batches, coalescing the counter updates
+share_link_view_buffer = buffers.BulkBuffer(
+    'kb.ShareLinkView', flush_size=100, flush_interval=5, max_buffered=10000,
+    write=share_link_view_partitions.insert, after_write=SecureShareLink.record_batch,
+)
+
+
 class ArticleRating(models.Model):
     """User ratings for articles (1-5 stars)"""
     article = models.ForeignKey(Article, on_delete=models.CASCADE, related_name='ratings')
@@ -498,6 +718,29 @@ class ArticleRating(models.Model):
     
     def __str__(self):
         return f"{self.user.username} rated {self.article.title}: {self.rating}/5"
+    
+    @classmethod
+    def rate(cls, article, user, value):
+        """
+        Add or change a user's rating of an article and its rating counters
+        in one transaction; returns (rating, created)
+        """
+        with transaction.atomic():
+            rating = cls.objects.select_for_update().filter(article=article, user=user).first()
+            if rating is None:
+                try:
+                    with transaction.atomic():
+                        rating = cls.objects.create(article=article, user=user, rating=value)
+                except IntegrityError:
+                    # Rated in another request just now: change that rating instead
+                    return cls.rate(article, user, value)
+                Article.adjust_counters(article.pk, rating_sum=value, rating_count=1)
+                return rating, True
+            previous = rating.rating
+            rating.rating = value
+            rating.save(update_fields=['rating', 'updated_at'])
+            Article.adjust_counters(article.pk, rating_sum=value - previous)
+            return rating, False
 
 
 class ArticleComment(models.Model):
@@ -524,6 +767,27 @@ class ArticleComment(models.Model):
     def get_replies(self):
         """Get approved replies to this comment"""
         return self.replies.filter(is_approved=True).order_by('created_at')
+    
+    @property
+    def is_counted(self):
+        """Whether this comment counts towards its article's approved_comment_count"""
+        return self.is_approved and self.parent_id is None
+    
+    @classmethod
+    def set_approved(cls, queryset, approved):
+        """
+        Approve or unapprove comments, adjusting their articles' comment
+        counters in the same transaction; returns how many changed
+        """
+        with transaction.atomic():
+            ids = list(queryset.filter(is_approved=not approved).select_for_update().values_list('pk', flat=True))
+            top_level = (
+                cls.objects.filter(pk__in=ids, parent__isnull=True)
+                .order_by().values_list('article').annotate(total=Count('id'))
+            )
+            for article_id, total in top_level:
+                Article.adjust_counters(article_id, approved_comment_count=total if approved else -total)
+            return cls.objects.filter(pk__in=ids).update(is_approved=approved)
 
 
 class ParagraphLike(models.Model):
@@ -545,6 +809,38 @@ class ParagraphLike(models.Model):
     def __str__(self):
         action = "liked" if self.is_like else "disliked"
         return f"{self.user.username} {action} paragraph: {self.paragraph.title}"
+    
+    @staticmethod
+    def counter(is_like):
+        return 'likes_count' if is_like else 'dislikes_count'
+    
+    @classmethod
+    def react(cls, paragraph, user, is_like):
+        """
+        Set a user's like (True), dislike (False) or neither (None) of a
+        paragraph, and its like counters, in one transaction
+        """
+        with transaction.atomic():
+            existing = cls.objects.select_for_update().filter(paragraph=paragraph, user=user).first()
+            if existing is None:
+                if is_like is None:
+                    return
+                try:
+                    with transaction.atomic():
+                        cls.objects.create(paragraph=paragraph, user=user, is_like=is_like)
+                except IntegrityError:
+                    # Reacted in another request just now: change that reaction instead
+                    return cls.react(paragraph, user, is_like)
+                ArticleParagraph.adjust_counters(paragraph.pk, **{cls.counter(is_like): 1})
+            elif is_like is None:
+                # The post_delete receiver takes it off the counters
+                existing.delete()
+            elif existing.is_like != is_like:
+                existing.is_like = is_like
+                existing.save(update_fields=['is_like', 'updated_at'])
+                ArticleParagraph.adjust_counters(
+                    paragraph.pk, **{cls.counter(is_like): 1, cls.counter(not is_like): -1}
+                )
 
 
 class ArticleReadStatus(models.Model):
@@ -567,21 +863,55 @@ class ArticleReadStatus(models.Model):
 
     @classmethod
     def mark_as_read(cls, article, user):
-        """Mark an article as read by a user, or update read count if already read"""
+        """
+        Mark an article as read by a user, or bump its read count if already
+        read, in a single INSERT ... ON CONFLICT DO UPDATE. Re-opening the
+        article within ARTICLE_READ_COALESCE_SECONDS counts as the same read
+        and writes nothing. Returns True if a read was recorded.
+        """
         if not user.is_authenticated:
-            return None
-            
-        read_status, created = cls.objects.get_or_create(
-            article=article,
-            user=user,
-            defaults={'read_count': 1}
-        )
-        
-        if not created:
-            read_status.read_count += 1
-            read_status.save(update_fields=['last_read_at', 'read_count'])
-            
-        return read_status
+            return False
+        key = (article.pk, user.pk)
+        if article_read_coalescer.seen(key):
+            return False
+        try:
+            cls._upsert_read(article, user)
+        except Exception:
+            # Nothing was recorded, so the next read must not be coalesced into it
+            article_read_coalescer.forget(key)
+            raise
+        return True
+
+    @classmethod
+    def _upsert_read(cls, article, user):
+        now = timezone.now()
+        if connection.vendor in ('sqlite', 'postgresql'):
+            table = connection.ops.quote_name(cls._meta.db_table)
+            timestamp = connection.ops.adapt_datetimefield_value(now)
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    f"INSERT INTO {table} (article_id, user_id, first_read_at, last_read_at, read_count) "
+                    f"VALUES (%s, %s, %s, %s, 1) "
+                    f"ON CONFLICT (article_id, user_id) DO UPDATE "
+                    f"SET read_count = {table}.read_count + 1, last_read_at = excluded.last_read_at",
+                    [article.pk, user.pk, timestamp, timestamp],
+                )
+            return
+
+        # Databases without ON CONFLICT: increment in place, create on a miss
+        increment = {'read_count': F('read_count') + 1, 'last_read_at': now}
+        if not cls.objects.filter(article=article, user=user).update(**increment):
+            try:
+                with transaction.atomic():
+                    cls.objects.create(article=article, user=user, read_count=1)
+            except IntegrityError:
+                cls.objects.filter(article=article, user=user).update(**increment)
+
+
+# Repeat reads of an article by the same user within this many seconds are
+# coalesced into one; 0 records every read
+ARTICLE_READ_COALESCE_SECONDS = getattr(settings, 'ARTICLE_READ_COALESCE_SECONDS', 300)
+article_read_coalescer = coalesce.RecentlySeen(window=ARTICLE_READ_COALESCE_SECONDS)
 
 
 class ArticleFavorite(models.Model):
@@ -596,17 +926,33 @@ class ArticleFavorite(models.Model):
     
     def __str__(self):
         return f"{self.user.username} favorited '{self.article.title}'"
+    
+    @classmethod
+    def toggle(cls, article, user):
+        """Favorite an article, or unfavorite it if it already is; returns whether it is now favorited"""
+        with transaction.atomic():
+            favorite, created = cls.objects.get_or_create(article=article, user=user)
+            if created:
+                Article.adjust_counters(article.pk, favorites_count=1)
+            else:
+                # The post_delete receiver takes it off favorites_count
+                favorite.delete()
+        return created
 
 
 class ArticleView(models.Model):
     """Track article views for both registered and anonymous users"""
-    article = models.ForeignKey(Article, on_delete=models.CASCADE, related_name='views')
-    user = models.ForeignKey(User, on_delete=models.CASCADE, null=True, blank=True)  # None for anonymous users
+    article = models.ForeignKey(Article, on_delete=models.CASCADE, related_name='+')
+    user = models.ForeignKey(User, on_delete=models.CASCADE, null=True, blank=True, related_name='+')  # None for anonymous users
     ip_address = models.GenericIPAddressField()
     user_agent = models.TextField(blank=True)
     referrer = models.URLField(blank=True, null=True)
     session_key = models.CharField(max_length=40, blank=True)  # For anonymous users
-    viewed_at = models.DateTimeField(auto_now_add=True)
+    # Set when the view happens, not when its buffered row is written
+    viewed_at = models.DateTimeField(default=timezone.now)
+    
+    # Only rows written before partitioning; read views through article_view_partitions
+    legacy = models.Manager()
     
     class Meta:
         ordering = ['-viewed_at']
@@ -614,6 +960,8 @@ class ArticleView(models.Model):
             models.Index(fields=['article', '-viewed_at']),
             models.Index(fields=['user', '-viewed_at']),
             models.Index(fields=['ip_address', '-viewed_at']),
+            # Retention compaction selects the oldest views
+            models.Index(fields=['viewed_at']),
         ]
     
     def __str__(self):
@@ -621,6 +969,158 @@ class ArticleView(models.Model):
         return f"{user_info} viewed '{self.article.title}' at {self.viewed_at}"
 
 
+def visitor_key(view):
+    """What makes a view unique: the user, or the IP address of an anonymous visitor"""
+    return f"user:{view.user_id}" if view.user_id else f"ip:{view.ip_address}"
+
+
+class ArticleViewDaily(models.Model):
+    """
+    Per-article, per-day view counts, incremented from each written batch of
+    ArticleView rows so view counts never have to scan the raw view table.
+    ``unique_sketch`` is a HyperLogLog sketch of the day's visitors; sketches
+    of several days merge into the unique count of the whole range.
+    """
+    article = models.ForeignKey(Article, on_delete=models.CASCADE, related_name='daily_views')
+    day = models.DateField()
+    views = models.PositiveIntegerField(default=0)
+    authenticated_views = models.PositiveIntegerField(default=0)
+    anonymous_views = models.PositiveIntegerField(default=0)
+    unique_sketch = models.BinaryField(default=b'')
+    unique_views = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = ('article', 'day')
+        ordering = ['-day']
+        verbose_name = "Daily Article Views"
+        verbose_name_plural = "Daily Article Views"
+
+    def __str__(self):
+        return f"{self.article.title} on {self.day}: {self.views} views"
+
+    @classmethod
+    def record_batch(cls, views):
+        """Add a batch of ArticleView rows to the rollups, one UPSERT per (article, day)"""
+        totals = {}
+        visitors = {}
+        for view in views:
+            key = (view.article_id, timezone.localdate(view.viewed_at))
+            total = totals.setdefault(key, [0, 0])
+            total[0 if view.user_id else 1] += 1
+            visitors.setdefault(key, set()).add(visitor_key(view))
+
+        for (article_id, day), (authenticated, anonymous) in totals.items():
+            increments = {
+                'views': F('views') + authenticated + anonymous,
+                'authenticated_views': F('authenticated_views') + authenticated,
+                'anonymous_views': F('anonymous_views') + anonymous,
+            }
+            if not cls.objects.filter(article_id=article_id, day=day).update(**increments):
+                try:
+                    with transaction.atomic():
+                        cls.objects.create(
+                            article_id=article_id,
+                            day=day,
+                            views=authenticated + anonymous,
+                            authenticated_views=authenticated,
+                            anonymous_views=anonymous,
+                        )
+                except IntegrityError:
+                    # Another process created the row first
+                    cls.objects.filter(article_id=article_id, day=day).update(**increments)
+
+            # The row is written (and locked) above, so the sketch merge cannot race
+            row = cls.objects.select_for_update().only('unique_sketch').get(article_id=article_id, day=day)
+            sketch = HyperLogLog.from_bytes(row.unique_sketch).update(visitors[(article_id, day)])
+            cls.objects.filter(pk=row.pk).update(unique_sketch=sketch.to_bytes(), unique_views=sketch.count())
+
+        by_article = {}
+        for (article_id, _), keys in visitors.items():
+            by_article.setdefault(article_id, set()).update(keys)
+        for article_id, keys in by_article.items():
+            ArticleViewSketch.record(article_id, keys)
+
+    @classmethod
+    def unique_views_between(cls, article_id, start=None, end=None):
+        """Estimated unique visitors of an article over a date range, from the merged daily sketches"""
+        days = cls.objects.filter(article_id=article_id)
+        if start is not None:
+            days = days.filter(day__gte=start)
+        if end is not None:
+            days = days.filter(day__lte=end)
+        return merged_sketches(days.values_list('unique_sketch', flat=True)).count()
+
+
+class ArticleViewSketch(models.Model):
+    """All-time HyperLogLog sketch of an article's visitors and its current estimate"""
+    article = models.OneToOneField(Article, on_delete=models.CASCADE, primary_key=True, related_name='view_sketch')
+    sketch = models.BinaryField(default=b'')
+    unique_views = models.PositiveIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.article.title}: ~{self.unique_views} unique views"
+
+    @classmethod
+    def record(cls, article_id, keys):
+        """Add visitor keys to the article's sketch"""
+        row, _ = cls.objects.select_for_update().get_or_create(article_id=article_id)
+        sketch = HyperLogLog.from_bytes(row.sketch).update(keys)
+        row.sketch = sketch.to_bytes()
+        row.unique_views = sketch.count()
+        row.save(update_fields=['sketch', 'unique_views', 'updated_at'])
+
+
+class ArticleViewBreakdown(models.Model):
+    """
+    Per-article, per-day view counts by referrer host or user-agent family,
+    kept when raw ArticleView rows are compacted (see kb.retention)
+    """
+    KIND_REFERRER = 'referrer'
+    KIND_USER_AGENT = 'user_agent'
+    KIND_CHOICES = [
+        (KIND_REFERRER, 'Referrer'),
+        (KIND_USER_AGENT, 'User agent'),
+    ]
+
+    article = models.ForeignKey(Article, on_delete=models.CASCADE, related_name='view_breakdowns')
+    day = models.DateField()
+    kind = models.CharField(max_length=20, choices=KIND_CHOICES)
+    value = models.CharField(max_length=255)
+    views = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = ('article', 'day', 'kind', 'value')
+        ordering = ['-day', '-views']
+
+    def __str__(self):
+        return f"{self.article.title} on {self.day}: {self.value} ({self.views})"
+
+    @classmethod
+    def top(cls, article_id, kind, days=30, limit=10):
+        """[(value, views), ...] for an article over the last ``days`` days, most views first"""
+        since = timezone.localdate() - timedelta(days=days - 1)
+        rows = cls.objects.filter(article_id=article_id, kind=kind, day__gte=since).values('value').annotate(
+            total=Sum('views')
+        ).order_by('-total', 'value')[:limit]
+        return [(row['value'], row['total']) for row in rows]
+
+
+# Rows are stored in one table per month (kb_articleview_YYYYMM)
+article_view_partitions = partitions.MonthlyPartitions(ArticleView, 'viewed_at', index_prefix='kb_av')
+
+# Article views are recorded on every page read; write them in batches
+article_view_buffer = buffers.BulkBuffer(
+    'kb.ArticleView', flush_size=200, flush_interval=5, max_buffered=20000,
+    write=article_view_partitions.insert, after_write=ArticleViewDaily.record_batch,
+)
+
+# Repeat views of an article by the same visitor within this many seconds are
+# not recorded; 0 records every page read
+ARTICLE_VIEW_DEDUP_SECONDS = getattr(settings, 'ARTICLE_VIEW_DEDUP_SECONDS', 600)
+article_view_filter = bloom.RotatingBloomFilter(window=ARTICLE_VIEW_DEDUP_SECONDS, capacity=100000, error_rate=0.001)
+
+
 class ReadLater(models.Model):
     """Track articles saved for later reading by users"""
     article = models.ForeignKey(Article, on_delete=models.CASCADE, related_name='read_later')
@@ -637,3 +1137,186 @@ class ReadLater(models.Model):
 
     def __str__(self):
         return f"{self.user.username} saved {self.article.title} to read later"
+
+
+class UserArticleState:
+    """
+    A user's read, favorited and read-later article ids, limited to the
+    articles being shown and loaded with one query per relation, so that
+    per-article checks are set lookups. ``for_request`` shares one loader
+    per request; loading more articles later only queries the new ids.
+
+    Listing views pass their articles through ``annotate``: a page of any
+    length costs three queries (none for anonymous users), while view
+    counts come from ``with_stats()`` and favorites from the stored
+    ``favorites_count``.
+    """
+    RELATIONS = (
+        ('read_ids', ArticleReadStatus),
+        ('favorite_ids', ArticleFavorite),
+        ('read_later_ids', ReadLater),
+    )
+
+    def __init__(self, user):
+        self.user = user
+        self.loaded_ids = set()
+        self.read_ids = set()
+        self.favorite_ids = set()
+        self.read_later_ids = set()
+
+    @classmethod
+    def for_request(cls, request):
+        state = getattr(request, '_article_state', None)
+        if state is None:
+            state = request._article_state = cls(request.user)
+        return state
+
+    def load(self, article_ids):
+        """Fetch the state of articles not loaded yet; returns self"""
+        new_ids = set(article_ids) - self.loaded_ids
+        if new_ids and self.user.is_authenticated:
+            for attribute, model in self.RELATIONS:
+                getattr(self, attribute).update(
+                    model.objects.filter(user=self.user, article_id__in=new_ids).values_list('article_id', flat=True)
+                )
+        self.loaded_ids |= new_ids
+        return self
+
+    def is_read(self, article):
+        return article.pk in self.read_ids
+
+    def is_favorited(self, article):
+        return article.pk in self.favorite_ids
+
+    def is_read_later(self, article):
+        return article.pk in self.read_later_ids
+
+    def annotate(self, articles):
+        """Load the state of articles and set is_read, is_favorited and is_read_later on each"""
+        articles = list(articles)
+        self.load(article.pk for article in articles)
+        for article in articles:
+            article.is_read = article.pk in self.read_ids
+            article.is_favorited = article.pk in self.favorite_ids
+            article.is_read_later = article.pk in self.read_later_ids
+        return articles
+
+
+class ContentVersion(models.Model):
+    """Global counter bumped on every content write, used to invalidate cached search results"""
+    version = models.PositiveBigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name = "Content Version"
+        verbose_name_plural = "Content Version"
+
+    def __str__(self):
+        return f"Content version {self.version}"
+
+    @classmethod
+    def current(cls):
+        """Get the current version without creating the row"""
+        return cls.objects.filter(pk=1).values_list('version', flat=True).first() or 0
+
+    @classmethod
+    def bump(cls):
+        """Atomically increment the version"""
+        updated = cls.objects.filter(pk=1).update(version=F('version') + 1, updated_at=timezone.now())
+        if not updated:
+            version, created = cls.objects.get_or_create(pk=1, defaults={'version': 1})
+            if not created:
+                cls.objects.filter(pk=1).update(version=F('version') + 1, updated_at=timezone.now())
+
+
+class SearchLog(models.Model):
+    """
+    Append-only log of searches and result click-throughs. Rows are written in
+    batches by kb.analytics and folded into SearchQueryStat by the
+    rollup_search_analytics command, which then deletes them.
+    """
+    EVENT_SEARCH = 'search'
+    EVENT_CLICK = 'click'
+    EVENT_CHOICES = [
+        (EVENT_SEARCH, 'Search'),
+        (EVENT_CLICK, 'Click'),
+    ]
+
+    event = models.CharField(max_length=10, choices=EVENT_CHOICES, default=EVENT_SEARCH)
+    query = models.CharField(max_length=255)
+    result_count = models.PositiveIntegerField(default=0)
+    # Plain id rather than a foreign key so logging never waits on the article table
+    article_id = models.BigIntegerField(null=True, blank=True)
+    created_at = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return f"{self.event} '{self.query}' at {self.created_at}"
+
+
+class SearchQueryStat(models.Model):
+    """Daily rollup of searches, zero-result searches and click-throughs per normalized query"""
+    day = models.DateField()
+    query = models.CharField(max_length=255)
+    searches = models.PositiveIntegerField(default=0)
+    zero_result_searches = models.PositiveIntegerField(default=0)
+    clicks = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = ('day', 'query')
+        ordering = ['-day', '-searches']
+        indexes = [
+            models.Index(fields=['day', '-searches']),
+            models.Index(fields=['day', '-zero_result_searches']),
+        ]
+        verbose_name = "Search Query Statistic"
+        verbose_name_plural = "Search Query Statistics"
+
+    def __str__(self):
+        return f"'{self.query}' on {self.day}: {self.searches} searches"
+
+
+class SavedSearch(models.Model):
+    """A query a user wants to be notified about when new live articles match it"""
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='saved_searches')
+    name = models.CharField(max_length=200, blank=True)
+    query = models.CharField(max_length=255)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['-created_at']
+
+    def __str__(self):
+        return self.name or self.query
+
+    def unseen_match_count(self):
+        return self.matches.filter(is_seen=False).count()
+
+
+class SavedSearchAnchor(models.Model):
+    """
+    Percolator index entry: an article can only match the saved search if
+    it produces one of the search's anchor keys (see kb.percolator)
+    """
+    saved_search = models.ForeignKey(SavedSearch, on_delete=models.CASCADE, related_name='anchors')
+    key = models.CharField(max_length=100, db_index=True)
+
+    def __str__(self):
+        return f"{self.key} -> {self.saved_search}"
+
+
+class SavedSearchMatch(models.Model):
+    """An article that matched a saved search when it went live or was updated"""
+    saved_search = models.ForeignKey(SavedSearch, on_delete=models.CASCADE, related_name='matches')
+    article = models.ForeignKey(Article, on_delete=models.CASCADE, related_name='saved_search_matches')
+    matched_at = models.DateTimeField(auto_now_add=True)
+    is_seen = models.BooleanField(default=False)
+
+    class Meta:
+        unique_together = ('saved_search', 'article')
+        ordering = ['-matched_at']
+        indexes = [
+            models.Index(fields=['saved_search', 'is_seen']),
+        ]
+
+    def __str__(self):
+        return f"'{self.article.title}' matched {self.saved_search}"
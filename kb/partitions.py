@@ -0,0 +1,303 @@
+"""
+Monthly partitioning for append-only view tables.
+
+``MonthlyPartitions`` splits the rows of a model such as ``ArticleView`` into
+one physical table per calendar month, named ``<db_table>_YYYYMM``. Each
+partition has the columns and indexes of the model it is built from, which
+stays the single definition of the schema.
+
+Partitions are created on first write to a month and are accessed through
+unmanaged models generated on demand (``model_for``), so they are queried
+with the ORM like any other table. Those models are kept in a registry of
+their own rather than Django's, which they would otherwise join (and whose
+caches they would flush) at request time.
+
+Ids are unique across partitions: each partition's ids start at
+``first_id(month)``, i.e. the month as ``YYYYMM`` times ``ID_SPAN``, so ids
+also sort by month. Rows of the legacy table keep their (smaller) ids, also
+when ``absorb_legacy`` moves them into a partition.
+
+* ``insert(rows)`` routes unsaved instances of the model to their months
+* ``querysets(start, end)`` returns one queryset per partition overlapping
+  the range, so range queries never touch other months
+* ``latest(limit, **filters)`` reads newest-first, stopping as soon as
+  enough rows are found
+* ``drop(month)`` expires a whole month by dropping its table instead of
+  deleting its rows one by one
+
+Relations from partitions carry no database constraints (a dropped table
+cannot hold up deletes elsewhere); ``delete(**filters)`` removes the rows
+of a deleted article, link or user from every partition.
+
+Rows written before partitioning stay in the model's own table, which is
+treated as one more (legacy) partition until ``absorb_legacy`` has moved
+its rows into their months. The model's manager is therefore not a way to
+read its rows; read them through the partitions.
+
+Given a ``union_model`` (an unmanaged model over a database view), the
+legacy table and every partition are also kept readable as one table, for
+screens such as the admin changelist that need a single queryset.
+"""
+import re
+import threading
+from datetime import datetime
+
+from django.apps.registry import Apps
+from django.db import connection, models, transaction
+from django.utils import timezone
+
+INSERT_BATCH_SIZE = 500
+MOVE_BATCH_SIZE = 1000
+# Ids per month: partition ids are YYYYMM * ID_SPAN + n
+ID_SPAN = 10 ** 10
+
+
+def month_start(value):
+    """First day of the month a date or datetime falls in (local time)"""
+    if isinstance(value, datetime):
+        value = timezone.localtime(value) if timezone.is_aware(value) else value
+        value = value.date()
+    return value.replace(day=1)
+
+
+def next_month(month):
+    return month.replace(year=month.year + 1, month=1) if month.month == 12 else month.replace(month=month.month + 1)
+
+
+def month_bounds(month):
+    """Aware datetimes [start, end) covering a month"""
+    tz = timezone.get_current_timezone()
+    start = timezone.make_aware(datetime(month.year, month.month, 1), tz)
+    end_month = next_month(month)
+    return start, timezone.make_aware(datetime(end_month.year, end_month.month, 1), tz)
+
+
+def first_id(month):
+    """The id the partition of a month starts counting from"""
+    return (month.year * 100 + month.month) * ID_SPAN + 1
+
+
+def id_month(row_id):
+    """The month of a partition row id; None for a legacy row"""
+    key = row_id // ID_SPAN
+    if not key:
+        return None
+    return datetime(key // 100, key % 100, 1).date()
+
+
+def start_ids(table, month):
+    """Make a partition table hand out ids from first_id(month) on"""
+    quoted = connection.ops.quote_name(table)
+    start = first_id(month) - 1
+    with connection.cursor() as cursor:
+        if connection.vendor == 'sqlite':
+            # AUTOINCREMENT continues from the sequence, whichever process created the table
+            cursor.execute('UPDATE sqlite_sequence SET seq = MAX(seq, %s) WHERE name = %s', [start, table])
+            cursor.execute(
+                'INSERT INTO sqlite_sequence (name, seq) SELECT %s, %s '
+                'WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = %s)',
+                [table, start, table],
+            )
+        elif connection.vendor == 'postgresql':
+            cursor.execute(
+                f"SELECT setval(pg_get_serial_sequence(%s, 'id'), GREATEST(%s, (SELECT MAX(id) FROM {quoted})))",
+                [table, start],
+            )
+        elif connection.vendor == 'mysql':
+            cursor.execute(f'ALTER TABLE {quoted} AUTO_INCREMENT = {start + 1}')
+
+
+class MonthlyPartitions:
+
+    def __init__(self, model, date_field, index_prefix, union_model=None):
+        self.model = model
+        self.date_field = date_field
+        # Partition index names are '<prefix>_YYYYMM_<n>' and must stay unique and short
+        self.index_prefix = index_prefix
+        self.union_model = union_model
+        self.table_re = re.compile(rf'^{re.escape(model._meta.db_table)}_(\d{{4}})(\d{{2}})$')
+        self.registry = Apps(())
+        self._models = {}
+        self._lock = threading.Lock()
+        self._created = set()
+
+    def table_name(self, month):
+        return f'{self.model._meta.db_table}_{month:%Y%m}'
+
+    def model_for(self, month):
+        """The unmanaged model of a month's partition"""
+        month = month_start(month)
+        partition = self._models.get(month)
+        if partition is None:
+            with self._lock:
+                partition = self._models.get(month)
+                if partition is None:
+                    partition = self._models[month] = self._build_model(month)
+        return partition
+
+    def _build_model(self, month):
+        attrs = {
+            '__module__': self.model.__module__,
+            'id': models.BigAutoField(primary_key=True),
+        }
+        for field in self.model._meta.concrete_fields:
+            if field.primary_key:
+                continue
+            _, _, args, kwargs = field.deconstruct()
+            if field.is_relation:
+                related = field.related_model
+                # Relations resolve through the partition registry
+                if related._meta.model_name not in self.registry.all_models[related._meta.app_label]:
+                    self.registry.register_model(related._meta.app_label, related)
+                kwargs.update(to=related, related_name='+', db_constraint=False, on_delete=models.DO_NOTHING)
+            attrs[field.name] = field.__class__(*args, **kwargs)
+        attrs['Meta'] = type('Meta', (), {
+            'apps': self.registry,
+            'app_label': self.model._meta.app_label,
+            'db_table': self.table_name(month),
+            'managed': False,
+            'ordering': self.model._meta.ordering,
+            'indexes': [
+                models.Index(fields=index.fields, name=f'{self.index_prefix}_{month:%Y%m}_{number}')
+                for number, index in enumerate(self.model._meta.indexes)
+            ],
+        })
+        attrs['__str__'] = self.model.__str__
+        return type(f'{self.model.__name__}{month:%Y%m}', (models.Model,), attrs)
+
+    # Partitions
+
+    def months(self):
+        """Months that have a partition, oldest first"""
+        months = []
+        for table in connection.introspection.table_names():
+            match = self.table_re.match(table)
+            if match:
+                months.append(datetime(int(match.group(1)), int(match.group(2)), 1).date())
+        return sorted(months)
+
+    def ensure(self, month):
+        """Create a month's partition table and indexes if it does not exist yet"""
+        month = month_start(month)
+        if month in self._created:
+            return self.model_for(month)
+        partition = self.model_for(month)
+        months = self.months()
+        if month in months:
+            self._created.add(month)
+            return partition
+        # Collected rather than run through a schema editor, which SQLite
+        # refuses inside the transaction rows are written in
+        editor = connection.schema_editor(collect_sql=True)
+        editor.deferred_sql = []  # normally set up on entering the editor's context
+        editor.create_model(partition)
+        statements = editor.collected_sql + [str(statement) for statement in editor.deferred_sql]
+        with connection.cursor() as cursor:
+            for statement in statements:
+                statement = re.sub(r'^CREATE (UNIQUE )?(TABLE|INDEX) ', r'CREATE \1\2 IF NOT EXISTS ', statement)
+                cursor.execute(statement)
+        start_ids(self.table_name(month), month)
+        self._replace_union(sorted(set(months) | {month}))
+        self._created.add(month)
+        return partition
+
+    def drop(self, month):
+        """Expire a whole month at once; returns the number of rows it held"""
+        month = month_start(month)
+        months = self.months()
+        if month not in months:
+            return 0
+        count = self.model_for(month).objects.count()
+        # The union view may not outlive a table it reads
+        self._replace_union([other for other in months if other != month])
+        with connection.cursor() as cursor:
+            cursor.execute(f'DROP TABLE IF EXISTS {connection.ops.quote_name(self.table_name(month))}')
+        self._created.discard(month)
+        return count
+
+    def refresh_union(self):
+        """Recreate the union view over the legacy table and every partition"""
+        self._replace_union(self.months())
+
+    def _replace_union(self, months):
+        if self.union_model is None:
+            return
+        quote = connection.ops.quote_name
+        columns = ', '.join(quote(field.column) for field in self.model._meta.concrete_fields)
+        tables = [self.model._meta.db_table] + [self.table_name(month) for month in months]
+        view = quote(self.union_model._meta.db_table)
+        with connection.cursor() as cursor:
+            cursor.execute(f'DROP VIEW IF EXISTS {view}')
+            cursor.execute(f'CREATE VIEW {view} AS ' + ' UNION ALL '.join(
+                f'SELECT {columns} FROM {quote(table)}' for table in tables
+            ))
+
+    # Rows
+
+    def insert(self, rows):
+        """
+        Write instances of the model to the partitions of their months. New
+        rows get their partition's ids; rows from the legacy table keep theirs.
+        """
+        by_month = {}
+        for row in rows:
+            value = getattr(row, self.date_field) or timezone.now()
+            setattr(row, self.date_field, value)
+            by_month.setdefault(month_start(value), []).append(row)
+
+        fields = [field for field in self.model._meta.concrete_fields if not field.primary_key]
+        for month, month_rows in by_month.items():
+            partition = self.ensure(month)
+            partition.objects.bulk_create(
+                [partition(id=row.pk, **{field.attname: getattr(row, field.attname) for field in fields}) for row in month_rows],
+                batch_size=INSERT_BATCH_SIZE,
+            )
+
+    def querysets(self, start=None, end=None):
+        """
+        One queryset per partition overlapping [start, end), oldest first,
+        each filtered to the range. The legacy table comes first.
+        """
+        bounds = {}
+        if start is not None:
+            bounds[f'{self.date_field}__gte'] = start
+        if end is not None:
+            bounds[f'{self.date_field}__lt'] = end
+        result = [self.model._default_manager.filter(**bounds)]
+        for month in self.months():
+            month_begins, month_ends = month_bounds(month)
+            if (start is None or month_ends > start) and (end is None or month_begins < end):
+                result.append(self.model_for(month).objects.filter(**bounds))
+        return result
+
+    def latest(self, limit, **filters):
+        """Up to ``limit`` rows matching ``filters``, newest first, across partitions"""
+        rows = []
+        for queryset in reversed(self.querysets()):
+            rows.extend(queryset.filter(**filters).order_by(f'-{self.date_field}')[:limit - len(rows)])
+            if len(rows) >= limit:
+                break
+        return rows
+
+    def count(self, **filters):
+        return sum(queryset.filter(**filters).count() for queryset in self.querysets())
+
+    def delete(self, **filters):
+        """Delete matching rows from every partition; returns how many were deleted"""
+        deleted = 0
+        for queryset in self.querysets():
+            deleted += queryset.filter(**filters).delete()[0]
+        return deleted
+
+    def absorb_legacy(self, batch_size=MOVE_BATCH_SIZE):
+        """Move rows from the model's own table into their monthly partitions"""
+        moved = 0
+        while True:
+            with transaction.atomic():
+                rows = list(self.model._default_manager.order_by('pk')[:batch_size])
+                if not rows:
+                    break
+                self.insert(rows)
+                self.model._default_manager.filter(pk__in=[row.pk for row in rows]).delete()
+            moved += len(rows)
+        return moved
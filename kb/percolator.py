@@ -0,0 +1,255 @@
+"""
+Percolator for saved searches.
+
+Instead of re-running every saved search against new content, the saved
+queries themselves are indexed. Each one is reduced to a set of *anchor
+keys* such that any article matching the query must produce at least one of
+them:
+
+* ``term:<term>``   - an index term every match contains (the longest one
+  of a conjunction, one per alternative of an OR)
+* ``prefix:<abc>``  - the first ``PREFIX_KEY_LENGTH`` letters of a ``prefix*``
+* ``<facet>:<id>``  - a ``field:value`` clause, when the query has no text
+* ``*``             - queries with nothing to anchor on (checked every time)
+
+The keys are stored in ``SavedSearchAnchor``. When an article goes live,
+and when its author updates a live article (``percolate_later``, called by
+the edit views), its own keys (terms, term prefixes and facet values)
+select the candidate saved searches with one indexed lookup, and only those
+candidates are verified exactly: text through the FTS5 index restricted to
+that article's rowid, fields through ``kb.facets``. The work per article
+depends on how many saved searches could match it, not on how many exist.
+It runs once per request, after the response (``kb.deferred``), so saving
+an article's paragraphs one by one does not percolate it again each time,
+and its tags and paragraphs are saved by then.
+
+Terms are produced by the FTS tokenizer itself (``search.index_terms``),
+so stemming and accent folding agree with what the verification matches.
+Field values are resolved to ids when a search is saved; renaming a space
+or tag later does not change what an existing saved search matches.
+"""
+import re
+
+from . import deferred, facets, query_parser, search
+from .suggest import normalize
+
+ANY_KEY = '*'
+PREFIX_KEY_LENGTH = 3
+# Article keys looked up per query against the anchor index
+LOOKUP_BATCH_SIZE = 500
+
+# Letters and digits only, like the FTS5 unicode61 tokenizer
+WORD_RE = re.compile(r'[^\W_]+', re.UNICODE)
+
+
+def _words(text):
+    return WORD_RE.findall(normalize(text))
+
+
+def _terms(*texts):
+    """Index terms of plain texts; without FTS5, their normalized words"""
+    if search.fts_available():
+        return search.index_terms(*texts)
+    return {word for text in texts for word in _words(text)}
+
+
+# Indexing saved searches
+
+def _text_anchor(text, prefix=False):
+    words = _words(text)
+    if not words:
+        return None
+    exact = _terms(' '.join(words[:-1] if prefix else words))
+    if exact:
+        return {f'term:{max(exact, key=len)}'}
+    # FTS5 runs the prefix through the tokenizer as well
+    stems = _terms(words[-1])
+    if stems and len(min(stems, key=len)) >= PREFIX_KEY_LENGTH:
+        return {f'prefix:{min(stems, key=len)[:PREFIX_KEY_LENGTH]}'}
+    return None
+
+
+def _node_anchor(node):
+    """Keys one of which every article matching the node contains, or None"""
+    kind = node[0]
+    if kind == 'term':
+        return _text_anchor(node[1].rstrip('*'), prefix=node[1].endswith('*'))
+    if kind == 'phrase':
+        return _text_anchor(node[1])
+    if kind == 'field':
+        # Nested fields are searched as text (see query_parser)
+        return _text_anchor(node[1][1])
+    if kind == 'and':
+        anchors = [anchor for anchor in (_node_anchor(child) for child in node[1]) if anchor]
+        return _best(anchors)
+    if kind == 'or':
+        keys = set()
+        for child in node[1]:
+            anchor = _node_anchor(child)
+            if anchor is None:
+                return None
+            keys |= anchor
+        return keys
+    return None
+
+
+def _best(anchors):
+    """The most selective anchor: fewest keys, then longest words"""
+    if not anchors:
+        return None
+    return min(anchors, key=lambda keys: (len(keys), -min(len(key) for key in keys)))
+
+
+def anchor_keys(query):
+    """
+    Anchor keys for a saved query. An empty set means the query can never
+    match a live article (e.g. a field value that does not exist).
+    """
+    parsed = query_parser.parse(query)
+    include = query_parser.resolve(parsed.include)
+    if any(not values for values in include.values()):
+        return set()
+    if 'status' in include and 'live' not in include['status']:
+        return set()
+
+    text_anchors = []
+    for clause in query_parser.clauses(query):
+        if query_parser.field_clause(clause) or clause[0] == 'not':
+            continue
+        anchor = _node_anchor(clause)
+        if anchor:
+            text_anchors.append(anchor)
+    if text_anchors:
+        return _best(text_anchors)
+
+    field_anchors = [
+        {f'{facet}:{value}' for value in values}
+        for facet, values in include.items() if facet != 'status'
+    ]
+    if field_anchors:
+        return _best(field_anchors)
+    return {ANY_KEY}
+
+
+def index_saved_search(saved_search):
+    """Replace the anchor keys of a saved search"""
+    from .models import SavedSearchAnchor
+
+    SavedSearchAnchor.objects.filter(saved_search=saved_search).delete()
+    SavedSearchAnchor.objects.bulk_create([
+        SavedSearchAnchor(saved_search=saved_search, key=key[:100])
+        for key in sorted(anchor_keys(saved_search.query))
+    ])
+
+
+def rebuild():
+    """Re-index every saved search; returns how many were indexed"""
+    from .models import SavedSearch
+
+    count = 0
+    for saved_search in SavedSearch.objects.iterator():
+        index_saved_search(saved_search)
+        count += 1
+    return count
+
+
+# Matching articles
+
+def article_terms(article):
+    from .models import ArticleParagraph
+
+    texts = [article.title, article.summary]
+    for title, content in ArticleParagraph.objects.filter(article=article).values_list('title', 'content'):
+        texts.append(title)
+        texts.append(search.html_to_text(content))
+    return _terms(*texts)
+
+
+def article_keys(terms, facet_index):
+    keys = {ANY_KEY}
+    for term in terms:
+        keys.add(f'term:{term}')
+        if len(term) >= PREFIX_KEY_LENGTH:
+            keys.add(f'prefix:{term[:PREFIX_KEY_LENGTH]}')
+    for facet, postings in facet_index.postings.items():
+        keys.update(f'{facet}:{value}' for value in postings)
+    return keys
+
+
+def _candidate_ids(keys):
+    from .models import SavedSearchAnchor
+
+    keys = sorted(keys)
+    candidates = set()
+    for start in range(0, len(keys), LOOKUP_BATCH_SIZE):
+        candidates.update(SavedSearchAnchor.objects.filter(
+            key__in=keys[start:start + LOOKUP_BATCH_SIZE]
+        ).values_list('saved_search_id', flat=True))
+    return candidates
+
+
+def _text_matches(match, parsed_text, article_id, terms):
+    if search.fts_available():
+        return bool(search.matching_article_ids(match, [article_id]))
+    # Without FTS5, require every plain word of the query
+    return all(word in terms for word in _words(parsed_text))
+
+
+def matches(query, article_id, facet_index, terms):
+    """Whether a saved query matches one article exactly"""
+    parsed = query_parser.parse(query)
+    if parsed.is_empty:
+        return False
+    if parsed.match and not _text_matches(parsed.match, parsed.text, article_id, terms):
+        return False
+    if parsed.exclude_match and search.matching_article_ids(parsed.exclude_match, [article_id]):
+        return False
+    if parsed.include or parsed.exclude:
+        include = query_parser.resolve(parsed.include)
+        exclude = query_parser.resolve(parsed.exclude)
+        if article_id not in facet_index.select(include, exclude):
+            return False
+    return True
+
+
+def percolate(article):
+    """
+    Record a SavedSearchMatch for every saved search a live article newly
+    matches. Returns the new matches.
+    """
+    from .models import SavedSearch, SavedSearchMatch
+
+    if article.status != 'live':
+        return []
+
+    terms = article_terms(article)
+    facet_index = facets.FacetIndex([article.id])
+    candidate_ids = _candidate_ids(article_keys(terms, facet_index))
+    if not candidate_ids:
+        return []
+    candidate_ids -= set(SavedSearchMatch.objects.filter(
+        article=article, saved_search_id__in=candidate_ids
+    ).values_list('saved_search_id', flat=True))
+
+    new_matches = [
+        SavedSearchMatch(saved_search=saved_search, article=article)
+        for saved_search in SavedSearch.objects.filter(id__in=candidate_ids)
+        if matches(saved_search.query, article.id, facet_index, terms)
+    ]
+    SavedSearchMatch.objects.bulk_create(new_matches, ignore_conflicts=True)
+    return new_matches
+
+
+def percolate_article(article_id):
+    """Percolate an article by id, if it still exists"""
+    from .models import Article
+
+    article = Article.objects.filter(pk=article_id).first()
+    if article is None:
+        return []
+    return percolate(article)
+
+
+def percolate_later(article_id):
+    """Percolate an article after the current response has been sent"""
+    deferred.defer(percolate_article, article_id)
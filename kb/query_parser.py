@@ -0,0 +1,355 @@
+"""
+Structured search query language.
+
+    space:Infra tag:python status:live "exact phrase" -deprecated
+    (kubernetes OR k8s) AND helm NOT tiller
+    author:alice deploy*
+
+A query is an implicit AND of clauses:
+
+* free text - words, ``"phrases"``, ``prefix*``, ``OR``/``AND``/``NOT`` and
+  parentheses. All positive text compiles to a single FTS5 MATCH expression,
+  so unions and intersections run inside the full-text index.
+* ``-text`` / ``NOT text`` at the top level excludes every article that has
+  any match for it in the index.
+* ``field:value`` / ``field:"two words"`` - space, tag, category, group,
+  author or status. Values of the same field are OR'ed, different fields are
+  AND'ed and ``-field:value`` excludes. They are resolved to ids once and
+  restrict the articles searched inside the database query itself (see
+  ``kb.search.field_restriction``), so they apply before results are cut.
+
+A field inside a nested boolean group that cannot be expressed this way is
+searched as plain text instead.
+"""
+import re
+
+# Query field name -> facet name in kb.facets
+FIELDS = {
+    'space': 'space',
+    'tag': 'tag',
+    'category': 'tag_category',
+    'group': 'tag_group',
+    'author': 'author',
+    'status': 'status',
+}
+OPERATORS = ('AND', 'OR', 'NOT')
+
+WORD_CHAR_RE = re.compile(r'\w', re.UNICODE)
+PLAIN_WORD_RE = re.compile(r'\w+', re.UNICODE)
+FIELD_RE = re.compile(r'([A-Za-z_]+):(.*)', re.S)
+
+
+class ParsedQuery:
+    """Compiled form of a structured query"""
+
+    def __init__(self, match=None, exclude_match=None, include=None, exclude=None, text=''):
+        # FTS5 expression for the positive text clauses
+        self.match = match
+        # FTS5 expression whose matching articles are removed from the results
+        self.exclude_match = exclude_match
+        # {facet: {raw value, ...}} from field clauses
+        self.include = include or {}
+        self.exclude = exclude or {}
+        # Plain words of the positive text, used for spelling suggestions
+        self.text = text
+
+    @property
+    def is_empty(self):
+        return not (self.match or self.include)
+
+    def __repr__(self):
+        return (f'ParsedQuery(match={self.match!r}, exclude_match={self.exclude_match!r}, '
+                f'include={self.include!r}, exclude={self.exclude!r})')
+
+
+# Tokenizer
+
+def _read_quoted(query, position):
+    """Read a "quoted" string starting at ``position``; a missing closing quote ends it at the end"""
+    end = query.find('"', position + 1)
+    if end == -1:
+        return query[position + 1:], len(query)
+    return query[position + 1:end], end + 1
+
+
+def _read_bare(query, position):
+    end = position
+    while end < len(query) and not query[end].isspace() and query[end] not in '()"':
+        end += 1
+    return query[position:end], end
+
+
+def tokenize(query):
+    """Split a query into (kind, value) tokens"""
+    tokens = []
+    position = 0
+    length = len(query)
+    while position < length:
+        char = query[position]
+        if char.isspace():
+            position += 1
+        elif char == '(':
+            tokens.append(('LPAREN', None))
+            position += 1
+        elif char == ')':
+            tokens.append(('RPAREN', None))
+            position += 1
+        elif char == '-' and position + 1 < length and not query[position + 1].isspace():
+            tokens.append(('NOT', None))
+            position += 1
+        elif char == '"':
+            text, position = _read_quoted(query, position)
+            tokens.append(('PHRASE', text))
+        else:
+            word, position = _read_bare(query, position)
+            field = FIELD_RE.match(word)
+            if field and field.group(1).lower() in FIELDS:
+                name = FIELDS[field.group(1).lower()]
+                value = field.group(2)
+                if not value and position < length and query[position] == '"':
+                    value, position = _read_quoted(query, position)
+                tokens.append(('FIELD', (name, value)))
+            elif word in OPERATORS:
+                tokens.append((word, None))
+            else:
+                tokens.append(('TERM', word))
+    return tokens
+
+
+# Parser
+#
+#   expr  := and ('OR' and)*
+#   and   := unary (['AND'] unary)*
+#   unary := 'NOT' unary | atom
+#   atom  := '(' expr ')' | PHRASE | TERM | FIELD
+
+class _Parser:
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.position = 0
+
+    def peek(self):
+        if self.position < len(self.tokens):
+            return self.tokens[self.position][0]
+        return None
+
+    def next(self):
+        token = self.tokens[self.position]
+        self.position += 1
+        return token
+
+    def parse(self):
+        nodes = []
+        while self.peek() is not None:
+            if self.peek() in ('RPAREN', 'OR', 'AND'):
+                # Stray operator or parenthesis; skip it rather than fail
+                self.next()
+                continue
+            node = self.expr()
+            if node is not None:
+                nodes.append(node)
+        return ('and', nodes)
+
+    def expr(self):
+        children = [self.conjunction()]
+        while self.peek() == 'OR':
+            self.next()
+            children.append(self.conjunction())
+        children = [child for child in children if child is not None]
+        if not children:
+            return None
+        return children[0] if len(children) == 1 else ('or', children)
+
+    def conjunction(self):
+        children = []
+        while self.peek() not in (None, 'OR', 'RPAREN'):
+            if self.peek() == 'AND':
+                self.next()
+                continue
+            node = self.unary()
+            if node is not None:
+                children.append(node)
+        if not children:
+            return None
+        return children[0] if len(children) == 1 else ('and', children)
+
+    def unary(self):
+        if self.peek() == 'NOT':
+            self.next()
+            if self.peek() in (None, 'OR', 'AND', 'RPAREN'):
+                return None
+            child = self.unary()
+            return ('not', child) if child is not None else None
+        return self.atom()
+
+    def atom(self):
+        kind, value = self.next()
+        if kind == 'LPAREN':
+            node = self.expr()
+            if self.peek() == 'RPAREN':
+                self.next()
+            return node
+        if kind == 'PHRASE':
+            return ('phrase', value)
+        if kind == 'FIELD':
+            return ('field', value)
+        return ('term', value)
+
+
+# Compiler
+
+def _quote(text):
+    return '"%s"' % text.replace('"', '""')
+
+
+def _fts(node):
+    """FTS5 expression for a text node, or None if it has nothing searchable"""
+    kind = node[0]
+    if kind == 'term':
+        text = node[1]
+        prefix = text.endswith('*')
+        text = text.rstrip('*')
+        if not WORD_CHAR_RE.search(text):
+            return None
+        return _quote(text) + ('*' if prefix else '')
+    if kind == 'phrase':
+        return _quote(node[1]) if WORD_CHAR_RE.search(node[1]) else None
+    if kind == 'field':
+        # Fields nested where they cannot be applied as filters are plain text
+        return _quote(node[1][1]) if WORD_CHAR_RE.search(node[1][1]) else None
+    if kind == 'not':
+        # A bare negation has no positive side for FTS5's binary NOT
+        return None
+    if kind == 'or':
+        parts = [part for part in (_fts(child) for child in node[1]) if part]
+        if not parts:
+            return None
+        return parts[0] if len(parts) == 1 else ' OR '.join(f'({part})' for part in parts)
+    if kind == 'and':
+        positive = [_fts(child) for child in node[1] if child[0] != 'not']
+        negative = [_fts(child[1]) for child in node[1] if child[0] == 'not']
+        positive = [part for part in positive if part]
+        if not positive:
+            return None
+        expression = positive[0] if len(positive) == 1 else ' AND '.join(f'({part})' for part in positive)
+        for part in negative:
+            if part:
+                expression = f'({expression}) NOT ({part})'
+        return expression
+    return None
+
+
+def _words(node):
+    """Plain words of a text node"""
+    kind = node[0]
+    if kind in ('term', 'phrase'):
+        return PLAIN_WORD_RE.findall(node[1])
+    if kind in ('and', 'or'):
+        return [word for child in node[1] for word in _words(child)]
+    return []
+
+
+def _same_field(node):
+    """For an OR of fields of one kind, return (facet, values); otherwise None"""
+    if node[0] != 'or' or not all(child[0] == 'field' for child in node[1]):
+        return None
+    names = {child[1][0] for child in node[1]}
+    if len(names) != 1:
+        return None
+    return names.pop(), {child[1][1] for child in node[1]}
+
+
+def clauses(query):
+    """
+    Top-level clauses of a query as syntax tree nodes: ('term', text),
+    ('phrase', text), ('field', (facet, value)), ('not', node),
+    ('and', [nodes]) or ('or', [nodes])
+    """
+    root = _Parser(tokenize(query or '')).parse()
+
+    # Flatten the top-level conjunction
+    flat = []
+    pending = list(root[1])
+    while pending:
+        node = pending.pop(0)
+        if node[0] == 'and':
+            pending[:0] = node[1]
+        else:
+            flat.append(node)
+    return flat
+
+
+def field_clause(clause):
+    """(facet, values, negated) if the clause is applied as a field filter, else None"""
+    if clause[0] == 'field':
+        name, value = clause[1]
+        return name, {value}, False
+    if clause[0] == 'not' and clause[1][0] == 'field':
+        name, value = clause[1][1]
+        return name, {value}, True
+    same_field = _same_field(clause)
+    if same_field:
+        name, values = same_field
+        return name, values, False
+    return None
+
+
+def parse(query):
+    """Parse a user query into a ParsedQuery"""
+    include = {}
+    exclude = {}
+    positive = []
+    negative = []
+    for clause in clauses(query):
+        field = field_clause(clause)
+        if field:
+            name, values, negated = field
+            (exclude if negated else include).setdefault(name, set()).update(values)
+        elif clause[0] == 'not':
+            negative.append(clause[1])
+        else:
+            positive.append(clause)
+
+    positive_parts = [part for part in (_fts(node) for node in positive) if part]
+    negative_parts = [part for part in (_fts(node) for node in negative) if part]
+
+    match = None
+    if positive_parts:
+        match = positive_parts[0] if len(positive_parts) == 1 else ' AND '.join(f'({part})' for part in positive_parts)
+    exclude_match = None
+    if negative_parts:
+        exclude_match = negative_parts[0] if len(negative_parts) == 1 else ' OR '.join(f'({part})' for part in negative_parts)
+
+    text = ' '.join(word for node in positive for word in _words(node))
+    return ParsedQuery(match=match, exclude_match=exclude_match, include=include, exclude=exclude, text=text)
+
+
+def resolve(values_by_facet):
+    """
+    Map raw field values to facet values (ids, or status codes).
+    A value that matches nothing resolves to an empty set.
+    """
+    from django.contrib.auth.models import User
+    from .models import Article, Space, Tag, TagCategory, TagGroup
+
+    lookups = {
+        'space': (Space, 'name'),
+        'tag': (Tag, 'name'),
+        'tag_category': (TagCategory, 'name'),
+        'tag_group': (TagGroup, 'name'),
+        'author': (User, 'username'),
+    }
+    statuses = {code for code, _ in Article.STATUS_CHOICES}
+
+    resolved = {}
+    for facet, values in values_by_facet.items():
+        if facet == 'status':
+            resolved[facet] = {value.lower() for value in values if value.lower() in statuses}
+            continue
+        model, field = lookups[facet]
+        ids = set()
+        for value in values:
+            ids.update(model.objects.filter(**{f'{field}__iexact': value}).values_list('id', flat=True))
+        resolved[facet] = ids
+    return resolved
@@ -0,0 +1,210 @@
+"""
+Retention and compaction of raw article views.
+
+Raw ``ArticleView`` rows (IP address, full user agent, referrer, session
+key) are only needed for a while. Their counts are already folded into
+``ArticleViewDaily`` (views and unique-visitor sketches) as each buffered
+batch is written, so once a view is older than the retention window the
+only detail still worth keeping is where readers came from and what they
+read with. ``compact`` folds old views into per-article, per-day
+``ArticleViewBreakdown`` counters by referrer host and user-agent family,
+then deletes the raw rows.
+
+Views are stored in monthly partitions (see ``kb.partitions``). A month
+that lies entirely outside the window is read in batches and then expired
+by dropping its table. Older rows of the month the cutoff falls in (and of
+the legacy unpartitioned table) are deleted oldest first in batches of
+``DELETE_BATCH_SIZE``, each in its own short transaction, optionally
+pausing between batches, so the database write lock is never held for long
+and view recording carries on while a large backlog is compacted.
+
+The retention window is ``ARTICLE_VIEW_RETENTION_DAYS`` (default 90).
+"""
+import re
+import time
+from datetime import timedelta
+from urllib.parse import urlsplit
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from . import partitions
+
+DEFAULT_RETENTION_DAYS = 90
+DELETE_BATCH_SIZE = 1000
+MAX_VALUE_LENGTH = 255
+
+DIRECT = '(direct)'
+UNKNOWN = 'Unknown'
+
+# First match wins, so more specific browsers come before the ones they imitate
+USER_AGENT_FAMILIES = [
+    ('Bot', re.compile(r'bot|crawl|spider|slurp|preview|monitor', re.I)),
+    ('Edge', re.compile(r'Edg(e|A|iOS)?/')),
+    ('Opera', re.compile(r'OPR/|Opera')),
+    ('Samsung Internet', re.compile(r'SamsungBrowser/')),
+    ('Chrome', re.compile(r'Chrome/|CriOS/')),
+    ('Firefox', re.compile(r'Firefox/|FxiOS/')),
+    ('Safari', re.compile(r'Safari/')),
+    ('Internet Explorer', re.compile(r'MSIE |Trident/')),
+    ('Script', re.compile(r'curl|wget|python|java/|go-http|okhttp|libwww', re.I)),
+]
+
+
+def retention_days():
+    return getattr(settings, 'ARTICLE_VIEW_RETENTION_DAYS', DEFAULT_RETENTION_DAYS)
+
+
+def referrer_host(referrer):
+    """Host a referrer URL points at, without ``www.``; DIRECT when there is none"""
+    if not referrer:
+        return DIRECT
+    host = (urlsplit(referrer).hostname or '').lower()
+    if host.startswith('www.'):
+        host = host[4:]
+    return host[:MAX_VALUE_LENGTH] or DIRECT
+
+
+def user_agent_family(user_agent):
+    if not user_agent:
+        return UNKNOWN
+    for family, pattern in USER_AGENT_FAMILIES:
+        if pattern.search(user_agent):
+            return family
+    return 'Other'
+
+
+def _row_bytes(ip_address, user_agent, referrer, session_key):
+    # Variable-length payload plus the id, foreign keys and timestamp
+    return 32 + sum(len(value.encode('utf-8')) for value in (ip_address, user_agent, referrer, session_key) if value)
+
+
+VIEW_COLUMNS = ('id', 'article_id', 'viewed_at', 'ip_address', 'user_agent', 'referrer', 'session_key')
+
+
+def _count(rows, counts):
+    """Tally raw view rows into {(article_id, day, kind, value): views}"""
+    from .models import ArticleViewBreakdown
+
+    for _, article_id, viewed_at, _, user_agent, referrer, _ in rows:
+        day = timezone.localdate(viewed_at)
+        for kind, value in (
+            (ArticleViewBreakdown.KIND_REFERRER, referrer_host(referrer)),
+            (ArticleViewBreakdown.KIND_USER_AGENT, user_agent_family(user_agent)),
+        ):
+            key = (article_id, day, kind, value)
+            counts[key] = counts.get(key, 0) + 1
+    return counts
+
+
+def _write_counts(counts):
+    """Add tallied views to the breakdown counters"""
+    from .models import ArticleViewBreakdown
+
+    for (article_id, day, kind, value), views in counts.items():
+        updated = ArticleViewBreakdown.objects.filter(
+            article_id=article_id, day=day, kind=kind, value=value
+        ).update(views=F('views') + views)
+        if not updated:
+            ArticleViewBreakdown.objects.create(article_id=article_id, day=day, kind=kind, value=value, views=views)
+
+
+def _free_bytes():
+    """Bytes in SQLite's free page list, or None on other databases"""
+    if connection.vendor != 'sqlite':
+        return None
+    with connection.cursor() as cursor:
+        cursor.execute('PRAGMA freelist_count')
+        free_pages = cursor.fetchone()[0]
+        cursor.execute('PRAGMA page_size')
+        return free_pages * cursor.fetchone()[0]
+
+
+def _database_size():
+    if connection.vendor != 'sqlite':
+        return None
+    with connection.cursor() as cursor:
+        cursor.execute('PRAGMA page_count')
+        pages = cursor.fetchone()[0]
+        cursor.execute('PRAGMA page_size')
+        return pages * cursor.fetchone()[0]
+
+
+def _compact_partition(view_partitions, month, batch_size, pause, stats):
+    """
+    Tally a whole month's views, reading it in batches, then write the
+    counters and drop the table in one short transaction
+    """
+    queryset = view_partitions.model_for(month).objects.order_by('pk')
+    counts = {}
+    last_id = 0
+    while True:
+        rows = list(queryset.filter(pk__gt=last_id).values_list(*VIEW_COLUMNS)[:batch_size])
+        if not rows:
+            break
+        _count(rows, counts)
+        last_id = rows[-1][0]
+        stats['rows'] += len(rows)
+        stats['row_bytes'] += sum(_row_bytes(*row[3:]) for row in rows)
+        if pause:
+            time.sleep(pause)
+    with transaction.atomic():
+        _write_counts(counts)
+        view_partitions.drop(month)
+    stats['partitions'] += 1
+
+
+def _compact_rows(queryset, batch_size, pause, stats):
+    """Tally and delete the queryset's rows, oldest first, one short transaction per batch"""
+    while True:
+        with transaction.atomic():
+            rows = list(queryset.order_by('viewed_at').values_list(*VIEW_COLUMNS)[:batch_size])
+            if not rows:
+                break
+            _write_counts(_count(rows, {}))
+            queryset.model._default_manager.filter(id__in=[row[0] for row in rows]).delete()
+        stats['rows'] += len(rows)
+        stats['row_bytes'] += sum(_row_bytes(*row[3:]) for row in rows)
+        stats['batches'] += 1
+        if len(rows) < batch_size:
+            break
+        if pause:
+            time.sleep(pause)
+
+
+def compact(days=None, batch_size=DELETE_BATCH_SIZE, pause=0, vacuum=False):
+    """
+    Fold raw views older than ``days`` into breakdown counters and delete
+    them. Returns ``{'rows', 'row_bytes', 'freed_bytes', 'batches',
+    'partitions'}``:
+    ``row_bytes`` estimates the raw data removed, and ``freed_bytes`` is the
+    space SQLite released (into its free list, or to the OS with ``vacuum``).
+    """
+    from .models import article_view_partitions
+
+    days = retention_days() if days is None else days
+    cutoff = timezone.now() - timedelta(days=days)
+    free_before = _free_bytes()
+    size_before = _database_size() if vacuum else None
+
+    stats = {'rows': 0, 'row_bytes': 0, 'freed_bytes': None, 'batches': 0, 'partitions': 0}
+
+    # Months that are entirely past the window are dropped whole
+    for month in article_view_partitions.months():
+        if partitions.month_bounds(month)[1] > cutoff:
+            break
+        _compact_partition(article_view_partitions, month, batch_size, pause, stats)
+
+    # Older rows of the legacy table and the month the cutoff falls in are deleted in batches
+    for queryset in article_view_partitions.querysets(end=cutoff):
+        _compact_rows(queryset, batch_size, pause, stats)
+
+    if vacuum and connection.vendor == 'sqlite':
+        with connection.cursor() as cursor:
+            cursor.execute('VACUUM')
+        stats['freed_bytes'] = size_before - _database_size()
+    elif free_before is not None:
+        stats['freed_bytes'] = _free_bytes() - free_before
+    return stats
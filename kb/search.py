@@ -0,0 +1,799 @@
+"""
+Full-text search backed by SQLite FTS5.
+
+Two virtual tables mirror the searchable text of the knowledge base:
+
+* ``kb_article_fts``   - rowid = Article.id, columns (title, summary)
+* ``kb_paragraph_fts`` - rowid = ArticleParagraph.id, columns (title, content)
+  plus an unindexed ``article_id`` used to roll paragraph hits up to articles.
+
+A third pair of tables holds the search vocabulary used for typo tolerance:
+
+* ``kb_search_terms``         - one row per distinct word with its frequency
+* ``kb_search_terms_trigram`` - FTS5 trigram index over those words, so
+  "which known words look like this misspelling" is an index lookup.
+
+Rows are keyed by the primary key of the source row so updates and deletes
+are rowid lookups rather than scans. The tables are kept in sync by the
+signal handlers in ``kb.signals`` and can be rebuilt from scratch with the
+``rebuild_search_index`` management command.
+"""
+import html
+import re
+import threading
+from collections import Counter, OrderedDict
+
+from django.db import connection
+from django.db.models import Q
+from django.db.models.expressions import RawSQL
+from django.utils.html import escape, strip_tags
+from django.utils.safestring import mark_safe
+
+from . import facets, query_parser, semantic
+
+ARTICLE_FTS_TABLE = 'kb_article_fts'
+PARAGRAPH_FTS_TABLE = 'kb_paragraph_fts'
+VOCABULARY_TABLE = 'kb_search_terms'
+TRIGRAM_TABLE = 'kb_search_terms_trigram'
+
+# Tokenizer of both FTS tables; index_terms() reproduces it for arbitrary text
+FTS_TOKENIZER = 'porter unicode61 remove_diacritics 2'
+# Scratch table (per connection, in the temp schema) used by index_terms()
+TERMS_SCRATCH_TABLE = 'kb_terms_scratch'
+TERMS_SCRATCH_VOCABULARY = 'kb_terms_scratch_vocab'
+
+# Column weights passed to bm25(); titles count for more than body text.
+ARTICLE_WEIGHTS = (10.0, 4.0)
+PARAGRAPH_WEIGHTS = (5.0, 1.0)
+
+# Upper bound on the ranked articles a search considers. Keeps the cost of a
+# search independent of how many rows match a very common term; facets of a
+# search with more matches than this count lower bounds.
+CANDIDATE_LIMIT = 500
+
+# snippet() wraps matches in these control characters; they cannot occur in
+# indexed text, so the snippet can be HTML-escaped before they are replaced
+# with <mark> tags.
+SNIPPET_START = '\x02'
+SNIPPET_END = '\x03'
+SNIPPET_ELLIPSIS = '\u2026'
+SNIPPET_TOKENS = 24
+PARAGRAPH_HITS_PER_ARTICLE = 3
+
+# Vocabulary words outside this length range are not worth correcting.
+MIN_TERM_LENGTH = 3
+MAX_TERM_LENGTH = 40
+# How many trigram candidates are scored per misspelled word, and how close
+# (Jaccard similarity of trigram sets) a candidate must be to be suggested.
+FUZZY_CANDIDATES = 50
+FUZZY_MIN_SIMILARITY = 0.35
+
+# Number of distinct (query, filters, visibility) results kept per process
+RESULT_CACHE_SIZE = 512
+# Results returned per search; facets are counted over all the candidates
+# before the results are cut to this
+RESULT_LIMIT = 100
+
+MODE_KEYWORD = 'keyword'
+MODE_SEMANTIC = 'semantic'
+MODES = (MODE_KEYWORD, MODE_SEMANTIC)
+
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+WHITESPACE_RE = re.compile(r'\s+')
+
+
+def fts_available():
+    """FTS5 is only used on SQLite; other backends fall back to the ORM"""
+    return connection.vendor == 'sqlite'
+
+
+def html_to_text(value):
+    """Strip HTML tags and entities, collapsing whitespace"""
+    if not value:
+        return ''
+    text = html.unescape(strip_tags(value))
+    return WHITESPACE_RE.sub(' ', text).strip()
+
+
+def tokenize(query):
+    """Split a raw user query into search terms"""
+    return TOKEN_RE.findall(query or '')
+
+
+def build_match_expression(query):
+    """Turn a raw user query into a safe FTS5 MATCH expression (AND of terms)"""
+    terms = tokenize(query)
+    if not terms:
+        return None
+    return ' '.join('"%s"' % term for term in terms)
+
+
+def visibility_sql(user, alias='a'):
+    """SQL condition (and params) restricting articles to those the user may see"""
+    if user is not None and user.is_authenticated:
+        return (
+            f"({alias}.status = 'live' OR ({alias}.status = 'draft' AND {alias}.author_id = %s))",
+            [user.pk],
+        )
+    return f"{alias}.status = 'live'", []
+
+
+def visibility_q(user):
+    """ORM equivalent of visibility_sql()"""
+    if user is not None and user.is_authenticated:
+        return Q(status='live') | Q(status='draft', author=user)
+    return Q(status='live')
+
+
+# Index maintenance
+
+def create_search_tables(cursor):
+    cursor.execute(
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {ARTICLE_FTS_TABLE} USING fts5("
+        f"title, summary, tokenize = '{FTS_TOKENIZER}')"
+    )
+    cursor.execute(
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {PARAGRAPH_FTS_TABLE} USING fts5("
+        "title, content, article_id UNINDEXED, "
+        f"tokenize = '{FTS_TOKENIZER}')"
+    )
+    cursor.execute(
+        f"CREATE TABLE IF NOT EXISTS {VOCABULARY_TABLE} ("
+        "id INTEGER PRIMARY KEY, term TEXT NOT NULL UNIQUE, frequency INTEGER NOT NULL DEFAULT 0)"
+    )
+    cursor.execute(
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {TRIGRAM_TABLE} USING fts5("
+        f"term, content = '{VOCABULARY_TABLE}', content_rowid = 'id', tokenize = 'trigram')"
+    )
+    cursor.execute(
+        f"CREATE TRIGGER IF NOT EXISTS {VOCABULARY_TABLE}_ai AFTER INSERT ON {VOCABULARY_TABLE} BEGIN "
+        f"INSERT INTO {TRIGRAM_TABLE} (rowid, term) VALUES (new.id, new.term); END"
+    )
+    cursor.execute(
+        f"CREATE TRIGGER IF NOT EXISTS {VOCABULARY_TABLE}_ad AFTER DELETE ON {VOCABULARY_TABLE} BEGIN "
+        f"INSERT INTO {TRIGRAM_TABLE} ({TRIGRAM_TABLE}, rowid, term) VALUES ('delete', old.id, old.term); END"
+    )
+
+
+def drop_search_tables(cursor):
+    cursor.execute(f"DROP TABLE IF EXISTS {TRIGRAM_TABLE}")
+    cursor.execute(f"DROP TABLE IF EXISTS {VOCABULARY_TABLE}")
+    cursor.execute(f"DROP TABLE IF EXISTS {PARAGRAPH_FTS_TABLE}")
+    cursor.execute(f"DROP TABLE IF EXISTS {ARTICLE_FTS_TABLE}")
+
+
+def vocabulary_terms(*texts):
+    """Distinct lowercase words of the given texts that belong in the vocabulary"""
+    terms = set()
+    for text in texts:
+        for token in TOKEN_RE.findall((text or '').lower()):
+            if MIN_TERM_LENGTH <= len(token) <= MAX_TERM_LENGTH and not token.isdigit():
+                terms.add(token)
+    return terms
+
+
+def _update_vocabulary(cursor, old_terms, new_terms):
+    """
+    Keep document frequencies in step with an indexed row whose words went
+    from ``old_terms`` to ``new_terms``: words it gained count once more,
+    words it lost once less, and words no longer used anywhere are dropped
+    """
+    added = new_terms - old_terms
+    removed = old_terms - new_terms
+    if added:
+        cursor.executemany(
+            f"INSERT INTO {VOCABULARY_TABLE} (term, frequency) VALUES (%s, 1) "
+            "ON CONFLICT (term) DO UPDATE SET frequency = frequency + 1",
+            [(term,) for term in added],
+        )
+    if removed:
+        cursor.executemany(
+            f"UPDATE {VOCABULARY_TABLE} SET frequency = frequency - 1 WHERE term = %s",
+            [(term,) for term in removed],
+        )
+        cursor.executemany(
+            f"DELETE FROM {VOCABULARY_TABLE} WHERE term = %s AND frequency <= 0",
+            [(term,) for term in removed],
+        )
+
+
+def _indexed_terms(cursor, table, columns, rowid):
+    """Vocabulary words of the row currently indexed under ``rowid``"""
+    cursor.execute(f"SELECT {', '.join(columns)} FROM {table} WHERE rowid = %s", [rowid])
+    row = cursor.fetchone()
+    return vocabulary_terms(*row) if row else set()
+
+
+def index_vocabulary(*texts, count=True):
+    """
+    Add the words of free-standing texts (e.g. tag names) to the vocabulary.
+    With ``count`` False, words already known keep their frequency, so
+    saving the same text again does not weigh it more.
+    """
+    if not fts_available():
+        return
+    terms = vocabulary_terms(*texts)
+    if not terms:
+        return
+    conflict = "DO UPDATE SET frequency = frequency + 1" if count else "DO NOTHING"
+    with connection.cursor() as cursor:
+        cursor.executemany(
+            f"INSERT INTO {VOCABULARY_TABLE} (term, frequency) VALUES (%s, 1) ON CONFLICT (term) {conflict}",
+            [(term,) for term in terms],
+        )
+
+
+def index_article(article):
+    """Insert or replace the index row for an article"""
+    if not fts_available():
+        return
+    summary = html_to_text(article.summary)
+    with connection.cursor() as cursor:
+        old_terms = _indexed_terms(cursor, ARTICLE_FTS_TABLE, ('title', 'summary'), article.pk)
+        cursor.execute(f"DELETE FROM {ARTICLE_FTS_TABLE} WHERE rowid = %s", [article.pk])
+        cursor.execute(
+            f"INSERT INTO {ARTICLE_FTS_TABLE} (rowid, title, summary) VALUES (%s, %s, %s)",
+            [article.pk, article.title, summary],
+        )
+        _update_vocabulary(cursor, old_terms, vocabulary_terms(article.title, summary))
+
+
+def remove_article(article_id):
+    if not fts_available():
+        return
+    with connection.cursor() as cursor:
+        old_terms = _indexed_terms(cursor, ARTICLE_FTS_TABLE, ('title', 'summary'), article_id)
+        cursor.execute(f"DELETE FROM {ARTICLE_FTS_TABLE} WHERE rowid = %s", [article_id])
+        _update_vocabulary(cursor, old_terms, set())
+
+
+def index_paragraph(paragraph):
+    """Insert or replace the index row for a paragraph"""
+    if not fts_available():
+        return
+    content = html_to_text(paragraph.content)
+    with connection.cursor() as cursor:
+        old_terms = _indexed_terms(cursor, PARAGRAPH_FTS_TABLE, ('title', 'content'), paragraph.pk)
+        cursor.execute(f"DELETE FROM {PARAGRAPH_FTS_TABLE} WHERE rowid = %s", [paragraph.pk])
+        cursor.execute(
+            f"INSERT INTO {PARAGRAPH_FTS_TABLE} (rowid, title, content, article_id) "
+            "VALUES (%s, %s, %s, %s)",
+            [paragraph.pk, paragraph.title, content, paragraph.article_id],
+        )
+        _update_vocabulary(cursor, old_terms, vocabulary_terms(paragraph.title, content))
+
+
+def remove_paragraph(paragraph_id):
+    if not fts_available():
+        return
+    with connection.cursor() as cursor:
+        old_terms = _indexed_terms(cursor, PARAGRAPH_FTS_TABLE, ('title', 'content'), paragraph_id)
+        cursor.execute(f"DELETE FROM {PARAGRAPH_FTS_TABLE} WHERE rowid = %s", [paragraph_id])
+        _update_vocabulary(cursor, old_terms, set())
+
+
+def rebuild_index(batch_size=500):
+    """Drop and repopulate the search tables. Returns (articles, paragraphs) indexed."""
+    from .models import Article, ArticleParagraph, Tag, TagCategory
+
+    if not fts_available():
+        return 0, 0
+
+    article_sql = f"INSERT INTO {ARTICLE_FTS_TABLE} (rowid, title, summary) VALUES (%s, %s, %s)"
+    paragraph_sql = (
+        f"INSERT INTO {PARAGRAPH_FTS_TABLE} (rowid, title, content, article_id) VALUES (%s, %s, %s, %s)"
+    )
+    # Document frequency of every vocabulary word
+    vocabulary = Counter()
+
+    article_count = 0
+    paragraph_count = 0
+    with connection.cursor() as cursor:
+        drop_search_tables(cursor)
+        create_search_tables(cursor)
+
+        rows = []
+        for pk, title, summary in Article.objects.values_list('pk', 'title', 'summary').iterator(chunk_size=batch_size):
+            summary = html_to_text(summary)
+            rows.append((pk, title, summary))
+            vocabulary.update(vocabulary_terms(title, summary))
+            if len(rows) >= batch_size:
+                cursor.executemany(article_sql, rows)
+                article_count += len(rows)
+                rows = []
+        if rows:
+            cursor.executemany(article_sql, rows)
+            article_count += len(rows)
+
+        rows = []
+        paragraphs = ArticleParagraph.objects.values_list('pk', 'title', 'content', 'article_id')
+        for pk, title, content, article_id in paragraphs.iterator(chunk_size=batch_size):
+            content = html_to_text(content)
+            rows.append((pk, title, content, article_id))
+            vocabulary.update(vocabulary_terms(title, content))
+            if len(rows) >= batch_size:
+                cursor.executemany(paragraph_sql, rows)
+                paragraph_count += len(rows)
+                rows = []
+        if rows:
+            cursor.executemany(paragraph_sql, rows)
+            paragraph_count += len(rows)
+
+        for name in Tag.objects.values_list('name', flat=True):
+            vocabulary.update(vocabulary_terms(name))
+        for name in TagCategory.objects.values_list('name', flat=True):
+            vocabulary.update(vocabulary_terms(name))
+        cursor.executemany(
+            f"INSERT INTO {VOCABULARY_TABLE} (term, frequency) VALUES (%s, %s)",
+            list(vocabulary.items()),
+        )
+
+        cursor.execute(f"INSERT INTO {ARTICLE_FTS_TABLE} ({ARTICLE_FTS_TABLE}) VALUES ('optimize')")
+        cursor.execute(f"INSERT INTO {PARAGRAPH_FTS_TABLE} ({PARAGRAPH_FTS_TABLE}) VALUES ('optimize')")
+        cursor.execute(f"INSERT INTO {TRIGRAM_TABLE} ({TRIGRAM_TABLE}) VALUES ('optimize')")
+
+    return article_count, paragraph_count
+
+
+def index_terms(*texts):
+    """
+    Distinct terms the FTS tokenizer produces for plain texts: case-folded,
+    unaccented and stemmed exactly as they are stored in the index. The texts
+    are tokenized in a temporary FTS5 table and read back via fts5vocab.
+    """
+    texts = [text for text in texts if text]
+    if not texts:
+        return set()
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"CREATE VIRTUAL TABLE IF NOT EXISTS temp.{TERMS_SCRATCH_TABLE} "
+            f"USING fts5(text, tokenize = '{FTS_TOKENIZER}')"
+        )
+        cursor.execute(
+            f"CREATE VIRTUAL TABLE IF NOT EXISTS temp.{TERMS_SCRATCH_VOCABULARY} "
+            f"USING fts5vocab(temp, {TERMS_SCRATCH_TABLE}, 'row')"
+        )
+        cursor.executemany(
+            f"INSERT INTO temp.{TERMS_SCRATCH_TABLE} (text) VALUES (%s)",
+            [(text,) for text in texts],
+        )
+        cursor.execute(f"SELECT term FROM temp.{TERMS_SCRATCH_VOCABULARY}")
+        terms = {row[0] for row in cursor.fetchall()}
+        cursor.execute(f"DELETE FROM temp.{TERMS_SCRATCH_TABLE}")
+    return terms
+
+
+# Querying
+
+def _fts_search(match, user, limit, restrict=None):
+    """
+    The ``limit`` best (article_id, score) pairs from both FTS tables. Lower
+    score is better. Each table contributes its ``limit`` best articles, so
+    fewer than ``limit`` pairs means every match was returned.
+    ``restrict`` (an Article queryset, see ``field_restriction``) limits the
+    hits inside the query, before they are ranked and cut.
+    """
+    visibility, visibility_params = visibility_sql(user)
+    if restrict is not None:
+        restrict_sql, restrict_params = restrict.values('id').query.sql_with_params()
+        visibility = f'{visibility} AND a.id IN ({restrict_sql})'
+        visibility_params = [*visibility_params, *restrict_params]
+    # Paragraph hits are grouped per article before the limit, so one article
+    # with many matching paragraphs takes a single candidate slot. bm25()
+    # cannot run inside an aggregate; LIMIT -1 keeps SQLite from flattening
+    # the scoring subquery into the GROUP BY.
+    sql = f"""
+        SELECT hits.article_id, MIN(hits.score) AS score
+        FROM (
+            SELECT * FROM (
+                SELECT f.rowid AS article_id, bm25({ARTICLE_FTS_TABLE}, %s, %s) AS score
+                FROM {ARTICLE_FTS_TABLE} f
+                JOIN kb_article a ON a.id = f.rowid
+                WHERE {ARTICLE_FTS_TABLE} MATCH %s AND {visibility}
+                ORDER BY score LIMIT %s
+            )
+            UNION ALL
+            SELECT * FROM (
+                SELECT paragraphs.article_id, MIN(paragraphs.score) AS score
+                FROM (
+                    SELECT f.article_id AS article_id, bm25({PARAGRAPH_FTS_TABLE}, %s, %s) AS score
+                    FROM {PARAGRAPH_FTS_TABLE} f
+                    JOIN kb_article a ON a.id = f.article_id
+                    WHERE {PARAGRAPH_FTS_TABLE} MATCH %s AND {visibility}
+                    LIMIT -1
+                ) paragraphs
+                GROUP BY paragraphs.article_id
+                ORDER BY score LIMIT %s
+            )
+        ) hits
+        GROUP BY hits.article_id
+        ORDER BY score
+        LIMIT %s
+    """
+    params = [
+        *ARTICLE_WEIGHTS, match, *visibility_params, limit,
+        *PARAGRAPH_WEIGHTS, match, *visibility_params, limit,
+        limit,
+    ]
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return [(row[0], row[1]) for row in cursor.fetchall()]
+
+
+def _orm_search(query, user, limit, restrict=None):
+    """Fallback for non-SQLite databases: icontains over titles, summaries and paragraphs"""
+    from .models import Article
+
+    articles = Article.objects.all() if restrict is None else Article.objects.filter(id__in=restrict.values('id'))
+    article_ids = articles.filter(
+        Q(title__icontains=query) |
+        Q(summary__icontains=query) |
+        Q(paragraphs__title__icontains=query) |
+        Q(paragraphs__content__icontains=query)
+    ).filter(visibility_q(user)).order_by('-created_at').values_list('id', flat=True).distinct()[:limit]
+    return [(article_id, 0.0) for article_id in article_ids]
+
+
+def _field_search(restrict, user, limit):
+    """Newest visible articles matching field filters only (no free text)"""
+    articles = restrict.filter(visibility_q(user))
+    article_ids = articles.order_by('-created_at', '-id').values_list('id', flat=True).distinct()[:limit]
+    return [(article_id, 0.0) for article_id in article_ids]
+
+
+def field_restriction(include, exclude, exclude_match=None, filters=None):
+    """
+    Articles allowed by a query's field clauses and ``-text`` exclusions and
+    by the facets picked in the UI, as a queryset that searches apply inside
+    the database; None when nothing is restricted
+    """
+    if not (include or exclude or exclude_match or filters):
+        return None
+    articles = facets.field_queryset(include, exclude, filters)
+    if exclude_match and fts_available():
+        articles = articles.exclude(id__in=RawSQL(
+            f"SELECT rowid FROM {ARTICLE_FTS_TABLE} WHERE {ARTICLE_FTS_TABLE} MATCH %s "
+            f"UNION SELECT article_id FROM {PARAGRAPH_FTS_TABLE} WHERE {PARAGRAPH_FTS_TABLE} MATCH %s",
+            [exclude_match, exclude_match],
+        ))
+    return articles
+
+
+def matching_article_ids(match, article_ids):
+    """Subset of ``article_ids`` with any indexed row matching ``match``"""
+    if not match or not article_ids or not fts_available():
+        return set()
+    placeholders = ', '.join(['%s'] * len(article_ids))
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"""
+            SELECT f.rowid FROM {ARTICLE_FTS_TABLE} f
+            WHERE {ARTICLE_FTS_TABLE} MATCH %s AND f.rowid IN ({placeholders})
+            UNION
+            SELECT f.article_id FROM {PARAGRAPH_FTS_TABLE} f
+            WHERE {PARAGRAPH_FTS_TABLE} MATCH %s AND f.article_id IN ({placeholders})
+            """,
+            [match, *article_ids, match, *article_ids],
+        )
+        return {row[0] for row in cursor.fetchall()}
+
+
+def search_article_ids(query, user=None, limit=100):
+    """Return ranked (article_id, score) pairs visible to ``user``"""
+    if fts_available():
+        match = build_match_expression(query)
+        if not match:
+            return []
+        return _fts_search(match, user, limit)
+    if not query:
+        return []
+    return _orm_search(query, user, limit)
+
+
+def render_snippet(raw):
+    """Escape an FTS5 snippet and turn its match markers into <mark> tags"""
+    highlighted = escape(raw or '').replace(SNIPPET_START, '<mark>').replace(SNIPPET_END, '</mark>')
+    return mark_safe(highlighted)
+
+
+def paragraph_hits(match, article_ids, per_article=PARAGRAPH_HITS_PER_ARTICLE):
+    """
+    Best-matching paragraphs for each of ``article_ids``, with highlighted
+    snippets produced by the index. ``match`` is an FTS5 expression.
+    Returns {article_id: [hit, ...]}.
+    """
+    if not match or not article_ids or not fts_available():
+        return {}
+
+    # Rank the matching paragraphs of these articles and keep the best few
+    # per article, then ask the index for snippets of just those rows.
+    placeholders = ', '.join(['%s'] * len(article_ids))
+    ranked_sql = f"""
+        SELECT f.rowid, f.article_id
+        FROM {PARAGRAPH_FTS_TABLE} f
+        WHERE {PARAGRAPH_FTS_TABLE} MATCH %s AND f.article_id IN ({placeholders})
+        ORDER BY bm25({PARAGRAPH_FTS_TABLE}, %s, %s)
+    """
+    selected = []
+    per_article_counts = {}
+    with connection.cursor() as cursor:
+        cursor.execute(ranked_sql, [match, *article_ids, *PARAGRAPH_WEIGHTS])
+        for paragraph_id, article_id in cursor.fetchall():
+            if per_article_counts.get(article_id, 0) < per_article:
+                per_article_counts[article_id] = per_article_counts.get(article_id, 0) + 1
+                selected.append(paragraph_id)
+        if not selected:
+            return {}
+
+        placeholders = ', '.join(['%s'] * len(selected))
+        cursor.execute(
+            f"""
+            SELECT f.rowid, f.article_id, f.title,
+                   snippet({PARAGRAPH_FTS_TABLE}, 1, %s, %s, %s, %s)
+            FROM {PARAGRAPH_FTS_TABLE} f
+            WHERE {PARAGRAPH_FTS_TABLE} MATCH %s AND f.rowid IN ({placeholders})
+            """,
+            [SNIPPET_START, SNIPPET_END, SNIPPET_ELLIPSIS, SNIPPET_TOKENS, match, *selected],
+        )
+        rows = {row[0]: row for row in cursor.fetchall()}
+
+    hits = {}
+    for paragraph_id in selected:
+        _, article_id, title, snippet_text = rows[paragraph_id]
+        hits.setdefault(article_id, []).append({
+            'id': paragraph_id,
+            'title': title,
+            'snippet': render_snippet(snippet_text),
+            'anchor': f'paragraph-{paragraph_id}',
+        })
+    return hits
+
+
+# Typo tolerance
+
+def trigrams(term, padded=False):
+    """
+    Set of 3-character substrings. Padded trigrams (as in pg_trgm) also mark
+    the start and end of the word, which favours candidates of similar length.
+    """
+    if padded:
+        term = f'  {term} '
+    return {term[i:i + 3] for i in range(len(term) - 2)}
+
+
+def similar_terms(term, limit=5):
+    """
+    Vocabulary words that look like ``term``. Candidates sharing trigrams are
+    found through the trigram index, then ordered by trigram-set similarity
+    and frequency.
+    """
+    if not fts_available():
+        return []
+    term = term.lower()
+    grams = trigrams(term)
+    if not grams:
+        return []
+
+    match = ' OR '.join('"%s"' % gram for gram in sorted(grams))
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"""
+            SELECT v.term, v.frequency
+            FROM {TRIGRAM_TABLE} f
+            JOIN {VOCABULARY_TABLE} v ON v.id = f.rowid
+            WHERE {TRIGRAM_TABLE} MATCH %s
+            ORDER BY rank
+            LIMIT %s
+            """,
+            [match, FUZZY_CANDIDATES],
+        )
+        candidates = cursor.fetchall()
+
+    grams = trigrams(term, padded=True)
+    scored = []
+    for candidate, frequency in candidates:
+        if candidate == term:
+            continue
+        candidate_grams = trigrams(candidate, padded=True)
+        similarity = len(grams & candidate_grams) / len(grams | candidate_grams)
+        if similarity >= FUZZY_MIN_SIMILARITY:
+            scored.append((similarity, frequency, candidate))
+    scored.sort(key=lambda item: (-item[0], -item[1], item[2]))
+    return [candidate for _, _, candidate in scored[:limit]]
+
+
+def _is_known_term(cursor, term):
+    cursor.execute(f"SELECT 1 FROM {VOCABULARY_TABLE} WHERE term = %s", [term])
+    return cursor.fetchone() is not None
+
+
+def suggest_correction(query, user=None, text=None):
+    """
+    "Did you mean" for a query that found nothing: every word of ``text``
+    (default: the whole query) missing from the vocabulary is replaced by
+    its closest known word, in place in the original query. The suggestion
+    is only returned if the corrected words find articles visible to ``user``.
+    """
+    if not fts_available():
+        return None
+    terms = tokenize(query if text is None else text)
+    if not terms:
+        return None
+
+    corrections = {}
+    with connection.cursor() as cursor:
+        for term in terms:
+            lowered = term.lower()
+            if lowered in corrections or len(lowered) < MIN_TERM_LENGTH or lowered.isdigit():
+                continue
+            if _is_known_term(cursor, lowered):
+                continue
+            candidates = similar_terms(lowered, limit=1)
+            if candidates:
+                corrections[lowered] = candidates[0]
+
+    if not corrections:
+        return None
+    corrected_text = ' '.join(corrections.get(term.lower(), term) for term in terms)
+    if not search_article_ids(corrected_text, user, limit=1):
+        return None
+    return TOKEN_RE.sub(lambda match: corrections.get(match.group(0).lower(), match.group(0)), query)
+
+
+# Cached search pipeline
+
+class ResultCache:
+    """
+    Bounded LRU cache of search results. Every entry remembers the content
+    version it was computed at; a lookup at any other version is a miss, so
+    one bump of ContentVersion invalidates everything at once and stale
+    entries simply age out of the LRU.
+    """
+
+    def __init__(self, max_size=RESULT_CACHE_SIZE):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, version):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] != version:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, version, value):
+        with self._lock:
+            self._entries[key] = (version, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+result_cache = ResultCache()
+
+
+def normalize_query(query):
+    return ' '.join((query or '').split()).casefold()
+
+
+def visibility_class(user):
+    """
+    Users who see the same articles share cache entries: everyone sees the
+    live articles, and only authors of drafts additionally see their own
+    """
+    from .models import Article
+
+    if user is not None and user.is_authenticated and Article.objects.filter(author=user, status='draft').exists():
+        return f'author:{user.pk}'
+    return 'public'
+
+
+def cache_key(query, user, filters, mode=MODE_KEYWORD):
+    key = (normalize_query(query), tuple(sorted(filters.items())), visibility_class(user))
+    if mode == MODE_SEMANTIC:
+        # The semantic index is rebuilt offline, outside ContentVersion
+        key += (mode, semantic.index.version)
+    return key
+
+
+def run_search(query, user=None, filters=None, mode=MODE_KEYWORD):
+    """
+    Ranked hits, facet counts, paragraph snippets and spelling suggestion for
+    a query, served from the result cache while the content is unchanged.
+    In semantic mode the free text is ranked by the latent semantic index
+    instead of FTS5; field clauses and facets apply the same way.
+    The returned dict is shared between requests and must not be modified.
+    """
+    from .models import ContentVersion
+
+    filters = filters or {}
+    if mode == MODE_SEMANTIC:
+        semantic.index.open()
+    key = cache_key(query, user, filters, mode)
+    version = ContentVersion.current()
+    result = result_cache.get(key, version)
+    if result is not None:
+        return result
+
+    # Text clauses run as one FTS5 expression; field clauses, -text
+    # exclusions and selected facets restrict the articles searched, inside
+    # the same query
+    parsed = query_parser.parse(query)
+    include = query_parser.resolve(parsed.include)
+    exclude = query_parser.resolve(parsed.exclude)
+    restrict = field_restriction(include, exclude, parsed.exclude_match, filters)
+
+    # Every candidate is ranked so that facets count all of them; only the
+    # best RESULT_LIMIT are returned. One candidate more than the limit is
+    # asked for to tell whether the facets counted every match.
+    limit = CANDIDATE_LIMIT + 1
+    if any(not values for values in include.values()):
+        # A field value naming nothing that exists matches no article
+        ranked = []
+    elif mode == MODE_SEMANTIC and parsed.text:
+        allowed = None if restrict is None else set(restrict.values_list('id', flat=True))
+        ranked = semantic.index.search(parsed.text, user, limit, allowed)
+    elif parsed.match and fts_available():
+        ranked = _fts_search(parsed.match, user, limit, restrict)
+    elif parsed.text and not fts_available():
+        ranked = _orm_search(parsed.text, user, limit, restrict)
+    elif include:
+        ranked = _field_search(restrict, user, limit)
+    else:
+        ranked = []
+
+    facets_truncated = len(ranked) > CANDIDATE_LIMIT
+    counts = facets.compute_facets([article_id for article_id, _ in ranked[:CANDIDATE_LIMIT]])
+    ranked = ranked[:RESULT_LIMIT]
+    hits = paragraph_hits(parsed.match, [article_id for article_id, _ in ranked])
+
+    suggestion = None
+    if not ranked and not filters and parsed.text and mode == MODE_KEYWORD:
+        suggestion = suggest_correction(query, user, parsed.text)
+
+    result = {
+        'ranked': ranked,
+        'facets': counts,
+        # The facets counted only the first CANDIDATE_LIMIT matches
+        'facets_truncated': facets_truncated,
+        'paragraph_hits': hits,
+        'suggestion': suggestion,
+    }
+    result_cache.set(key, version, result)
+    return result
+
+
+def load_articles(result, with_stats=False):
+    """
+    Fresh Article objects for a search result, in rank order; with_stats
+    also annotates their view and favorite counts (see ArticleQuerySet)
+    """
+    from .models import Article
+
+    ranked = result['ranked']
+    if not ranked:
+        return []
+    articles = Article.objects.select_related('space')
+    if with_stats:
+        articles = articles.with_stats()
+    articles = articles.in_bulk([article_id for article_id, _ in ranked])
+    loaded = []
+    for article_id, score in ranked:
+        article = articles.get(article_id)
+        if article is not None:
+            article.search_score = score
+            article.paragraph_hits = result['paragraph_hits'].get(article_id, [])
+            loaded.append(article)
+    return loaded
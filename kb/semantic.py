@@ -0,0 +1,511 @@
+"""
+Latent semantic index for "more like this" and meaning-based search.
+
+Paragraph text is weighted with TF-IDF over a capped vocabulary and projected
+onto the top ``DIMENSIONS`` right singular vectors of the paragraph-term
+matrix (truncated SVD, computed with NumPy from the term-term Gram matrix so
+the full matrix never has to be held in memory). Each paragraph becomes a
+unit-length float32 vector, so cosine similarity is a dot product.
+
+The index lives in ``SEMANTIC_INDEX_DIR`` as raw arrays opened with
+``numpy.memmap``:
+
+* ``meta.json``      - vocabulary, idf weights, generation and build time
+* ``<generation>/components.f32`` - terms x dimensions projection
+* ``<generation>/vectors.f32``    - one row per indexed paragraph
+* ``<generation>/rows.i64``       - (paragraph_id, article_id) per row
+
+Opening the index maps the files instead of reading them, so workers start
+without copying the matrix and share its pages through the OS cache.
+
+The index is built offline by the ``build_semantic_index`` management
+command. A full build writes a new generation directory and switches
+``meta.json`` over to it; an incremental update re-embeds only articles whose
+paragraphs changed since the last run, marking their old rows as tombstones
+in place and appending the new ones. Updates reuse the existing vocabulary
+and projection, so a full rebuild is done instead once tombstones make up
+``COMPACT_RATIO`` of the rows.
+"""
+import json
+import math
+import os
+import re
+import shutil
+import threading
+from collections import Counter, OrderedDict
+from datetime import datetime
+
+import numpy as np
+from django.conf import settings
+from django.utils import timezone
+
+DIMENSIONS = 128
+MAX_TERMS = 3000
+# Corpora smaller than this keep every term; larger ones drop terms that are
+# too rare or too common to say anything about a paragraph's topic.
+MIN_CORPUS_FOR_PRUNING = 100
+MIN_DOCUMENT_FREQUENCY = 2
+MAX_DOCUMENT_RATIO = 0.5
+MIN_TERM_LENGTH = 2
+
+# Paragraphs read from the database per batch while building
+BUILD_BATCH_SIZE = 500
+# Index rows scored per matrix product while querying
+SCORE_BATCH_ROWS = 16384
+# Best-scoring articles checked against visibility rules per query (more
+# when a search asks for more results)
+CANDIDATE_LIMIT = 500
+MIN_SIMILARITY = 0.1
+COMPACT_RATIO = 0.3
+# "More like this" answers are kept per article, before visibility rules,
+# until the index changes
+SIMILAR_CANDIDATES = 50
+SIMILAR_CACHE_SIZE = 4096
+
+META_FILE = 'meta.json'
+COMPONENTS_FILE = 'components.f32'
+VECTORS_FILE = 'vectors.f32'
+ROWS_FILE = 'rows.i64'
+TOMBSTONE = -1
+
+WORD_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def index_dir():
+    return getattr(settings, 'SEMANTIC_INDEX_DIR', os.path.join(settings.BASE_DIR, 'semantic_index'))
+
+
+def terms(text):
+    """Lower-cased words of plain text worth weighting"""
+    return [
+        word for word in WORD_RE.findall(text.lower())
+        if len(word) >= MIN_TERM_LENGTH and not word.isdigit()
+    ]
+
+
+def _paragraph_terms(title, content):
+    from .search import html_to_text
+
+    return terms(f'{title} {html_to_text(content)}')
+
+
+def _paragraphs(article_ids=None):
+    """Yield (paragraph_id, article_id, terms) in primary key order"""
+    from .models import ArticleParagraph
+
+    paragraphs = ArticleParagraph.objects.order_by('id')
+    if article_ids is not None:
+        paragraphs = paragraphs.filter(article_id__in=article_ids)
+    rows = paragraphs.values_list('id', 'article_id', 'title', 'content')
+    for paragraph_id, article_id, title, content in rows.iterator(chunk_size=BUILD_BATCH_SIZE):
+        yield paragraph_id, article_id, _paragraph_terms(title, content)
+
+
+def _batches(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class Weighting:
+    """TF-IDF weighting over a fixed vocabulary"""
+
+    def __init__(self, vocabulary, idf):
+        self.vocabulary = vocabulary
+        self.columns = {term: column for column, term in enumerate(vocabulary)}
+        self.idf = np.asarray(idf, dtype=np.float32)
+
+    @classmethod
+    def fit(cls, documents):
+        """Choose the vocabulary and idf weights from an iterable of term lists"""
+        frequencies = Counter()
+        count = 0
+        for document_terms in documents:
+            frequencies.update(set(document_terms))
+            count += 1
+
+        if count >= MIN_CORPUS_FOR_PRUNING:
+            limit = MAX_DOCUMENT_RATIO * count
+            frequencies = Counter({
+                term: frequency for term, frequency in frequencies.items()
+                if MIN_DOCUMENT_FREQUENCY <= frequency <= limit
+            })
+        vocabulary = sorted(term for term, _ in frequencies.most_common(MAX_TERMS))
+        idf = [math.log((1 + count) / (1 + frequencies[term])) + 1 for term in vocabulary]
+        return cls(vocabulary, idf)
+
+    def matrix(self, documents):
+        """Dense, L2-normalized TF-IDF rows for a batch of term lists"""
+        rows = np.zeros((len(documents), len(self.vocabulary)), dtype=np.float32)
+        for row, document_terms in enumerate(documents):
+            counts = Counter(term for term in document_terms if term in self.columns)
+            for term, frequency in counts.items():
+                column = self.columns[term]
+                rows[row, column] = (1 + math.log(frequency)) * self.idf[column]
+        return _normalize(rows)
+
+
+def _normalize(rows):
+    norms = np.linalg.norm(rows, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return rows / norms
+
+
+# Building
+
+def _read_meta(directory):
+    path = os.path.join(directory, META_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding='utf-8') as handle:
+        return json.load(handle)
+
+
+def _write_meta(directory, meta):
+    path = os.path.join(directory, META_FILE)
+    temporary = path + '.tmp'
+    with open(temporary, 'w', encoding='utf-8') as handle:
+        json.dump(meta, handle)
+    os.replace(temporary, path)
+
+
+def _append(path, array):
+    with open(path, 'ab') as handle:
+        handle.write(np.ascontiguousarray(array).tobytes())
+
+
+def _embed(weighting, components, documents):
+    """Unit-length LSA vectors for a batch of term lists"""
+    return _normalize(weighting.matrix(documents) @ components).astype(np.float32)
+
+
+def _write_rows(generation_dir, weighting, components, paragraphs):
+    """Embed and append paragraphs; returns the number of rows written"""
+    written = 0
+    for batch in _batches(paragraphs, BUILD_BATCH_SIZE):
+        vectors = _embed(weighting, components, [document_terms for _, _, document_terms in batch])
+        rows = np.array([(paragraph_id, article_id) for paragraph_id, article_id, _ in batch], dtype=np.int64)
+        _append(os.path.join(generation_dir, VECTORS_FILE), vectors)
+        _append(os.path.join(generation_dir, ROWS_FILE), rows)
+        written += len(batch)
+    return written
+
+
+def build(directory=None):
+    """
+    Build a new generation of the index from every paragraph.
+    Returns (paragraphs, dimensions).
+    """
+    directory = directory or index_dir()
+    os.makedirs(directory, exist_ok=True)
+    started = timezone.now()
+
+    weighting = Weighting.fit(document_terms for _, _, document_terms in _paragraphs())
+    term_count = len(weighting.vocabulary)
+
+    # Truncated SVD: the right singular vectors of X are the eigenvectors of
+    # X^T X, which is only terms x terms and can be summed batch by batch.
+    gram = np.zeros((term_count, term_count), dtype=np.float64)
+    documents = 0
+    for batch in _batches(_paragraphs(), BUILD_BATCH_SIZE):
+        matrix = weighting.matrix([document_terms for _, _, document_terms in batch])
+        gram += matrix.T @ matrix
+        documents += len(batch)
+
+    if term_count:
+        eigenvalues, eigenvectors = np.linalg.eigh(gram)
+        order = np.argsort(eigenvalues)[::-1]
+        order = order[eigenvalues[order] > 1e-9][:DIMENSIONS]
+        components = np.ascontiguousarray(eigenvectors[:, order], dtype=np.float32)
+    else:
+        components = np.zeros((0, 0), dtype=np.float32)
+    dimensions = components.shape[1]
+
+    previous = _read_meta(directory)
+    generation = (previous['generation'] + 1) if previous else 1
+    generation_dir = os.path.join(directory, str(generation))
+    shutil.rmtree(generation_dir, ignore_errors=True)
+    os.makedirs(generation_dir)
+    with open(os.path.join(generation_dir, COMPONENTS_FILE), 'wb') as handle:
+        handle.write(components.tobytes())
+    for name in (VECTORS_FILE, ROWS_FILE):
+        open(os.path.join(generation_dir, name), 'wb').close()
+
+    rows = _write_rows(generation_dir, weighting, components, _paragraphs()) if dimensions else 0
+
+    _write_meta(directory, {
+        'generation': generation,
+        'dimensions': dimensions,
+        'vocabulary': weighting.vocabulary,
+        'idf': [float(value) for value in weighting.idf],
+        'updated_at': started.isoformat(),
+        'rows': rows,
+        'tombstones': 0,
+    })
+
+    # Readers that still map an older generation keep their open files
+    for name in os.listdir(directory):
+        if name.isdigit() and int(name) != generation:
+            shutil.rmtree(os.path.join(directory, name), ignore_errors=True)
+    return rows, dimensions
+
+
+def _changed_article_ids(rows, since):
+    """Articles whose indexed paragraphs no longer match the database"""
+    from .models import ArticleParagraph
+
+    indexed = {
+        int(paragraph_id): int(article_id)
+        for paragraph_id, article_id in rows if paragraph_id != TOMBSTONE
+    }
+    current = {}
+    changed = set()
+    for paragraph_id, article_id, updated_at in ArticleParagraph.objects.values_list(
+        'id', 'article_id', 'updated_at'
+    ).iterator(chunk_size=BUILD_BATCH_SIZE):
+        current[paragraph_id] = article_id
+        previous = indexed.get(paragraph_id)
+        if previous != article_id or updated_at >= since:
+            changed.add(article_id)
+            if previous is not None:
+                # Moved to another article
+                changed.add(previous)
+    for paragraph_id, article_id in indexed.items():
+        if paragraph_id not in current:
+            changed.add(article_id)
+    return changed
+
+
+def update(directory=None):
+    """
+    Re-embed the paragraphs of articles changed since the last build or
+    update. Returns (articles, paragraphs) re-embedded, or None if a full
+    build was needed and done instead.
+    """
+    directory = directory or index_dir()
+    meta = _read_meta(directory)
+    if meta is None or not meta['dimensions']:
+        build(directory)
+        return None
+    started = timezone.now()
+
+    generation_dir = os.path.join(directory, str(meta['generation']))
+    dimensions = meta['dimensions']
+    weighting = Weighting(meta['vocabulary'], meta['idf'])
+    components = _map(os.path.join(generation_dir, COMPONENTS_FILE), np.float32, dimensions)
+    rows_path = os.path.join(generation_dir, ROWS_FILE)
+    vectors_path = os.path.join(generation_dir, VECTORS_FILE)
+    rows = _map(rows_path, np.int64, 2, mode='r+')
+
+    changed = _changed_article_ids(rows, datetime.fromisoformat(meta['updated_at']))
+    if not changed:
+        meta['updated_at'] = started.isoformat()
+        _write_meta(directory, meta)
+        return 0, 0
+
+    stale = np.isin(rows[:, 1], list(changed)) & (rows[:, 0] != TOMBSTONE)
+    tombstones = meta['tombstones'] + int(stale.sum())
+    if tombstones > COMPACT_RATIO * max(len(rows), 1):
+        del rows
+        build(directory)
+        return None
+
+    # Tombstone the old rows in place; they score zero and map to no article
+    positions = np.flatnonzero(stale)
+    if len(positions):
+        vectors = _map(vectors_path, np.float32, dimensions, mode='r+')
+        vectors[positions] = 0
+        vectors.flush()
+        del vectors
+        rows[positions] = TOMBSTONE
+        rows.flush()
+    del rows
+
+    written = _write_rows(generation_dir, weighting, components, _paragraphs(changed))
+    meta.update({
+        'updated_at': started.isoformat(),
+        'rows': meta['rows'] + written,
+        'tombstones': tombstones,
+    })
+    _write_meta(directory, meta)
+    return len(changed), written
+
+
+# Querying
+
+def _map(path, dtype, columns, mode='r'):
+    """Memory-map a raw row-major array file; an empty file maps to an empty array"""
+    itemsize = np.dtype(dtype).itemsize
+    size = os.path.getsize(path)
+    count = size // (itemsize * columns) if columns else 0
+    if not count:
+        return np.zeros((0, columns), dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode=mode, shape=(count, columns))
+
+
+class SemanticIndex:
+    """Read-only view of the on-disk index, re-opened when ``meta.json`` changes"""
+
+    def __init__(self, directory=None):
+        self._directory = directory
+        self._lock = threading.Lock()
+        self._stamp = None
+        self._state = None
+        # {article_id: [(article_id, similarity), ...]} for the current state
+        self._similar = OrderedDict()
+
+    @property
+    def directory(self):
+        return self._directory or index_dir()
+
+    def _meta_stamp(self):
+        try:
+            stat = os.stat(os.path.join(self.directory, META_FILE))
+        except OSError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def open(self):
+        """Map the current generation; returns False if there is no usable index"""
+        with self._lock:
+            stamp = self._meta_stamp()
+            if stamp is None:
+                self._stamp, self._state = None, None
+                self._similar.clear()
+                return False
+            if stamp == self._stamp:
+                return self._state is not None
+
+            meta = _read_meta(self.directory)
+            generation_dir = os.path.join(self.directory, str(meta['generation']))
+            dimensions = meta['dimensions']
+            state = None
+            if dimensions:
+                rows = _map(os.path.join(generation_dir, ROWS_FILE), np.int64, 2)
+                vectors = _map(os.path.join(generation_dir, VECTORS_FILE), np.float32, dimensions)
+                count = min(len(rows), len(vectors))
+                # Dense article numbering for the per-article reductions
+                article_ids, article_positions = np.unique(rows[:count, 1], return_inverse=True)
+                state = {
+                    'generation': meta['generation'],
+                    'weighting': Weighting(meta['vocabulary'], meta['idf']),
+                    'components': _map(os.path.join(generation_dir, COMPONENTS_FILE), np.float32, dimensions),
+                    'vectors': vectors[:count],
+                    'rows': rows[:count],
+                    'article_ids': article_ids,
+                    'article_positions': article_positions,
+                }
+            self._stamp, self._state = stamp, state
+            self._similar.clear()
+            return state is not None
+
+    def close(self):
+        with self._lock:
+            self._stamp, self._state = None, None
+            self._similar.clear()
+
+    @property
+    def version(self):
+        """Changes whenever a build or update is picked up; part of search cache keys"""
+        return self._stamp
+
+    def _article_scores(self, state, queries):
+        """
+        Cosine similarity of every indexed article to each query vector
+        (queries x articles), taking an article's best-matching paragraph.
+        The matrix is scored in row batches so only one slice is paged in
+        and multiplied at a time.
+        """
+        vectors = state['vectors']
+        positions = state['article_positions']
+        scores = np.full((len(queries), len(state['article_ids'])), -np.inf, dtype=np.float32)
+        for start in range(0, len(vectors), SCORE_BATCH_ROWS):
+            block = vectors[start:start + SCORE_BATCH_ROWS] @ queries.T
+            block_positions = positions[start:start + SCORE_BATCH_ROWS]
+            for query in range(len(queries)):
+                np.maximum.at(scores[query], block_positions, block[:, query])
+        return scores
+
+    def _candidates(self, state, scores, limit, exclude=(), allowed=None):
+        """
+        The ``limit`` most similar (article_id, similarity) pairs, among the
+        ``allowed`` article ids if given, whoever may see them
+        """
+        article_ids = state['article_ids']
+        order = np.argsort(-scores, kind='stable')
+        candidates = []
+        for position in order:
+            if scores[position] < MIN_SIMILARITY or len(candidates) >= limit:
+                break
+            article_id = int(article_ids[position])
+            if article_id != TOMBSTONE and article_id not in exclude and (allowed is None or article_id in allowed):
+                candidates.append((article_id, float(scores[position])))
+        return candidates
+
+    @staticmethod
+    def _visible(candidates, user, limit):
+        """The first ``limit`` candidates ``user`` may see"""
+        from .models import Article
+        from .search import visibility_q
+
+        if not candidates:
+            return []
+        visible = set(Article.objects.filter(
+            visibility_q(user), id__in=[article_id for article_id, _ in candidates]
+        ).values_list('id', flat=True))
+        return [(article_id, score) for article_id, score in candidates if article_id in visible][:limit]
+
+    def search(self, text, user=None, limit=100, allowed=None):
+        """
+        Articles whose paragraphs are closest in meaning to ``text``,
+        among the ``allowed`` article ids if given
+        """
+        if not self.open():
+            return []
+        state = self._state
+        query = _embed(state['weighting'], state['components'], [terms(text)])
+        if not query.any():
+            return []
+        scores = self._article_scores(state, query)[0]
+        return self._visible(self._candidates(state, scores, max(limit, CANDIDATE_LIMIT), allowed=allowed),
+                             user, limit)
+
+    def similar_articles(self, article_id, user=None, limit=5):
+        """
+        "More like this": every paragraph of the article is scored as one
+        query in a single batch, and articles are ranked by their average
+        best-paragraph similarity across those queries. The ranking is
+        computed once per article while the index is unchanged; only the
+        visibility rules are applied per call.
+        """
+        if not self.open():
+            return []
+        state = self._state
+        with self._lock:
+            candidates = self._similar.get(article_id)
+            if candidates is not None:
+                self._similar.move_to_end(article_id)
+        if candidates is None:
+            candidates = self._similar_candidates(state, article_id)
+            with self._lock:
+                if self._state is state:
+                    self._similar[article_id] = candidates
+                    while len(self._similar) > SIMILAR_CACHE_SIZE:
+                        self._similar.popitem(last=False)
+        return self._visible(candidates, user, limit)
+
+    def _similar_candidates(self, state, article_id):
+        own = np.flatnonzero(state['rows'][:, 1] == article_id)
+        if not len(own):
+            return []
+        queries = np.asarray(state['vectors'][own])
+        scores = self._article_scores(state, queries).mean(axis=0)
+        return self._candidates(state, scores, SIMILAR_CANDIDATES, exclude={article_id})
+
+
+index = SemanticIndex()
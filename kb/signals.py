@@ -0,0 +1,180 @@
+from django.contrib.auth.models import User
+from django.db.models.signals import m2m_changed, post_save, post_delete
+from django.dispatch import receiver
+
+from . import percolator, search, suggest
+from .models import (Article, ArticleComment, ArticleFavorite, ArticleParagraph, ArticleRating, ContentVersion,
+                     ParagraphLike, SavedSearch, SecureShareLink, Space, Tag, TagCategory, TagGroup,
+                     article_view_partitions, share_link_view_partitions)
+
+
+# Full-text search index
+
+@receiver(post_save, sender=Article)
+def index_article_on_save(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    search.index_article(instance)
+
+
+@receiver(post_delete, sender=Article)
+def remove_article_on_delete(sender, instance, **kwargs):
+    search.remove_article(instance.pk)
+
+
+@receiver(post_save, sender=ArticleParagraph)
+def index_paragraph_on_save(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    search.index_paragraph(instance)
+
+
+@receiver(post_delete, sender=ArticleParagraph)
+def remove_paragraph_on_delete(sender, instance, **kwargs):
+    search.remove_paragraph(instance.pk)
+
+
+@receiver(post_save, sender=Tag)
+@receiver(post_save, sender=TagCategory)
+def index_tag_vocabulary(sender, instance, created=False, raw=False, **kwargs):
+    if raw:
+        return
+    # A name counts once, when it is created; re-saves only make sure it is known
+    search.index_vocabulary(instance.name, count=created)
+
+
+# Autocomplete suggestions
+
+@receiver(post_save, sender=Article)
+def suggest_article_on_save(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    suggest.index.update_article(instance)
+
+
+@receiver(post_delete, sender=Article)
+def suggest_article_on_delete(sender, instance, **kwargs):
+    suggest.index.remove_article(instance.pk)
+
+
+@receiver(post_save, sender=Space)
+def suggest_space_on_save(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    suggest.index.update_space(instance)
+
+
+@receiver(post_delete, sender=Space)
+def suggest_space_on_delete(sender, instance, **kwargs):
+    suggest.index.remove_space(instance.pk)
+
+
+@receiver(post_save, sender=Tag)
+def suggest_tag_on_save(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    suggest.index.update_tags([instance])
+
+
+@receiver(post_delete, sender=Tag)
+def suggest_tag_on_delete(sender, instance, **kwargs):
+    suggest.index.remove_tag(instance.pk)
+
+
+@receiver(post_save, sender=TagCategory)
+def suggest_category_tags_on_save(sender, instance, raw=False, **kwargs):
+    # Renaming a category changes the full path of every tag below it
+    if raw:
+        return
+    suggest.index.update_tags(instance.tags.select_related('category__group'))
+
+
+@receiver(post_save, sender=TagGroup)
+def suggest_group_tags_on_save(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    suggest.index.update_tags(Tag.objects.filter(category__group=instance).select_related('category__group'))
+
+
+# Search result cache invalidation
+
+@receiver(post_save, sender=Article)
+@receiver(post_delete, sender=Article)
+@receiver(post_save, sender=ArticleParagraph)
+@receiver(post_delete, sender=ArticleParagraph)
+@receiver(post_save, sender=Tag)
+@receiver(post_delete, sender=Tag)
+@receiver(post_save, sender=TagCategory)
+@receiver(post_delete, sender=TagCategory)
+@receiver(post_save, sender=TagGroup)
+@receiver(post_delete, sender=TagGroup)
+@receiver(post_save, sender=Space)
+@receiver(post_delete, sender=Space)
+def bump_content_version(sender, raw=False, **kwargs):
+    if raw:
+        return
+    ContentVersion.bump()
+
+
+@receiver(m2m_changed, sender=Article.tags.through)
+def bump_content_version_on_tagging(sender, action, **kwargs):
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        ContentVersion.bump()
+
+
+# Saved search percolation (after the FTS receivers above, which it reads)
+
+@receiver(post_save, sender=SavedSearch)
+def index_saved_search_on_save(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    percolator.index_saved_search(instance)
+
+
+@receiver(post_save, sender=Article)
+def percolate_article_on_save(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    if instance.went_live:
+        percolator.percolate_later(instance.id)
+    instance._loaded_status = instance.status
+
+
+# Partitioned view tables have no foreign key constraints to cascade through
+
+@receiver(post_delete, sender=Article)
+def delete_article_views(sender, instance, **kwargs):
+    article_view_partitions.delete(article_id=instance.pk)
+
+
+@receiver(post_delete, sender=User)
+def delete_user_article_views(sender, instance, **kwargs):
+    article_view_partitions.delete(user_id=instance.pk)
+
+
+@receiver(post_delete, sender=SecureShareLink)
+def delete_share_link_views(sender, instance, **kwargs):
+    share_link_view_partitions.delete(share_link_id=instance.pk)
+
+
+# Engagement counters (additions and changes are counted where they are written)
+
+@receiver(post_delete, sender=ArticleRating)
+def uncount_rating(sender, instance, **kwargs):
+    Article.adjust_counters(instance.article_id, rating_sum=-instance.rating, rating_count=-1)
+
+
+@receiver(post_delete, sender=ArticleComment)
+def uncount_comment(sender, instance, **kwargs):
+    if instance.is_counted:
+        Article.adjust_counters(instance.article_id, approved_comment_count=-1)
+
+
+@receiver(post_delete, sender=ArticleFavorite)
+def uncount_favorite(sender, instance, **kwargs):
+    Article.adjust_counters(instance.article_id, favorites_count=-1)
+
+
+@receiver(post_delete, sender=ParagraphLike)
+def uncount_paragraph_like(sender, instance, **kwargs):
+    ArticleParagraph.adjust_counters(instance.paragraph_id, **{ParagraphLike.counter(instance.is_like): -1})
@@ -0,0 +1,267 @@
+"""
+In-memory prefix index for search-as-you-type suggestions.
+
+Article titles, tag paths (``Tag.get_full_path``) and space names are kept
+in one sorted list of ``(key, kind, object_id)`` tuples, where ``key`` is the
+normalized label starting at each of its words. A prefix lookup is a
+``bisect`` into that list followed by a short forward scan, so answering a
+keystroke never touches the database.
+
+The index is loaded lazily on first use and updated row by row from the
+signal handlers in ``kb.signals``. Because every worker process holds its
+own copy, it is also rebuilt from the database once it is older than
+``RELOAD_INTERVAL`` seconds, to pick up writes made by other processes. The
+rebuild is deferred until after the response of the request that noticed
+(see ``kb.deferred``); lookups keep using the current index until the new
+one is swapped in, and row updates made while it was being read are
+applied again on top of it.
+"""
+import bisect
+import re
+import threading
+import time
+import unicodedata
+from urllib.parse import quote
+
+from django.urls import reverse
+
+from . import deferred
+
+RELOAD_INTERVAL = 300
+DEFAULT_LIMIT = 8
+MAX_LIMIT = 20
+# Entries scanned per lookup before giving up; bounds the cost of very short
+# prefixes that match a large part of the index.
+MAX_SCAN = 500
+
+KIND_ARTICLE = 'article'
+KIND_TAG = 'tag'
+KIND_SPACE = 'space'
+
+WORD_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def normalize(text):
+    """Case-fold, strip accents and collapse whitespace"""
+    text = unicodedata.normalize('NFKD', text or '')
+    text = ''.join(char for char in text if not unicodedata.combining(char))
+    return ' '.join(text.casefold().split())
+
+
+def _keys(label):
+    """Normalized label starting at every word, so prefixes match mid-title too"""
+    normalized = normalize(label)
+    return {normalized[match.start():] for match in WORD_RE.finditer(normalized)}
+
+
+class SuggestionIndex:
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._keys = []
+        self._entries = {}
+        self._loaded_at = None
+        self._reloading = False
+        # Row updates made while load() reads the database, applied after the swap
+        self._changes = None
+
+    # Loading
+
+    def load(self):
+        """(Re)build the whole index from the database and swap it in"""
+        with self._lock:
+            self._changes = []
+        try:
+            entries, keys = self._read()
+        except Exception:
+            with self._lock:
+                self._changes = None
+            raise
+
+        with self._lock:
+            changes, self._changes = self._changes or [], None
+            self._entries = entries
+            self._keys = keys
+            self._loaded_at = time.monotonic()
+            for kind, object_id, entry in changes:
+                if entry is None:
+                    self._remove(kind, object_id)
+                else:
+                    self._put(kind, object_id, entry)
+
+    def _read(self):
+        from .models import Article, Space, Tag
+
+        entries = {}
+        for article_id, title, status, author_id in Article.objects.values_list(
+            'id', 'title', 'status', 'author_id'
+        ):
+            entries[(KIND_ARTICLE, article_id)] = self._article_entry(article_id, title, status, author_id)
+        for space_id, name in Space.objects.values_list('id', 'name'):
+            entries[(KIND_SPACE, space_id)] = self._space_entry(space_id, name)
+        for tag in Tag.objects.select_related('category__group'):
+            entries[(KIND_TAG, tag.id)] = self._tag_entry(tag)
+
+        keys = []
+        for (kind, object_id), entry in entries.items():
+            keys.extend((key, kind, object_id) for key in _keys(entry['label']))
+        keys.sort()
+        return entries, keys
+
+    def ensure_loaded(self):
+        """
+        Load the index on first use; once it is stale, rebuild it after the
+        current response while this and later lookups use the current one
+        """
+        loaded_at = self._loaded_at
+        if loaded_at is None:
+            self.load()
+        elif time.monotonic() - loaded_at > RELOAD_INTERVAL and not self._reloading:
+            with self._lock:
+                if self._reloading:
+                    return
+                self._reloading = True
+            deferred.defer(self._reload)
+
+    def _reload(self):
+        try:
+            self.load()
+        finally:
+            self._reloading = False
+
+    def clear(self):
+        with self._lock:
+            self._keys = []
+            self._entries = {}
+            self._loaded_at = None
+            self._changes = None
+
+    # Entries
+
+    @staticmethod
+    def _article_entry(article_id, title, status, author_id):
+        return {
+            'type': KIND_ARTICLE,
+            'id': article_id,
+            'label': title,
+            'url': reverse('article_detail', args=[article_id]),
+            'status': status,
+            'author_id': author_id,
+        }
+
+    @staticmethod
+    def _space_entry(space_id, name):
+        return {
+            'type': KIND_SPACE,
+            'id': space_id,
+            'label': name,
+            'url': reverse('space_detail', args=[space_id]),
+        }
+
+    @staticmethod
+    def _tag_entry(tag):
+        return {
+            'type': KIND_TAG,
+            'id': tag.id,
+            'label': tag.get_full_path(),
+            'url': f"{reverse('search')}?q={quote(tag.name)}",
+        }
+
+    # Incremental updates
+
+    def _put(self, kind, object_id, entry):
+        with self._lock:
+            if self._changes is not None:
+                self._changes.append((kind, object_id, entry))
+            if self._loaded_at is None:
+                # Nothing loaded yet; the first lookup will read the row anyway
+                return
+            self._discard(kind, object_id)
+            self._entries[(kind, object_id)] = entry
+            for key in _keys(entry['label']):
+                bisect.insort(self._keys, (key, kind, object_id))
+
+    def _remove(self, kind, object_id):
+        with self._lock:
+            if self._changes is not None:
+                self._changes.append((kind, object_id, None))
+            self._discard(kind, object_id)
+
+    def _discard(self, kind, object_id):
+        entry = self._entries.pop((kind, object_id), None)
+        if entry is None:
+            return
+        for key in _keys(entry['label']):
+            position = bisect.bisect_left(self._keys, (key, kind, object_id))
+            if position < len(self._keys) and self._keys[position] == (key, kind, object_id):
+                del self._keys[position]
+
+    def update_article(self, article):
+        self._put(KIND_ARTICLE, article.id, self._article_entry(
+            article.id, article.title, article.status, article.author_id
+        ))
+
+    def remove_article(self, article_id):
+        self._remove(KIND_ARTICLE, article_id)
+
+    def update_space(self, space):
+        self._put(KIND_SPACE, space.id, self._space_entry(space.id, space.name))
+
+    def remove_space(self, space_id):
+        self._remove(KIND_SPACE, space_id)
+
+    def update_tags(self, tags):
+        for tag in tags:
+            self._put(KIND_TAG, tag.id, self._tag_entry(tag))
+
+    def remove_tag(self, tag_id):
+        self._remove(KIND_TAG, tag_id)
+
+    # Lookup
+
+    @staticmethod
+    def _visible(entry, user):
+        if entry['type'] != KIND_ARTICLE:
+            return True
+        if entry['status'] == 'live':
+            return True
+        return (
+            entry['status'] == 'draft'
+            and user is not None
+            and user.is_authenticated
+            and entry['author_id'] == user.pk
+        )
+
+    def suggest(self, prefix, user=None, limit=DEFAULT_LIMIT):
+        """Entries whose label has a word starting with ``prefix``"""
+        prefix = normalize(prefix)
+        if not prefix:
+            return []
+        self.ensure_loaded()
+
+        results = []
+        seen = set()
+        with self._lock:
+            keys = self._keys
+            position = bisect.bisect_left(keys, (prefix,))
+            end = min(len(keys), position + MAX_SCAN)
+            while position < end and len(results) < limit:
+                key, kind, object_id = keys[position]
+                if not key.startswith(prefix):
+                    break
+                position += 1
+                if (kind, object_id) in seen:
+                    continue
+                seen.add((kind, object_id))
+                entry = self._entries.get((kind, object_id))
+                if entry is not None and self._visible(entry, user):
+                    results.append({
+                        'type': entry['type'],
+                        'id': entry['id'],
+                        'label': entry['label'],
+                        'url': entry['url'],
+                    })
+        return results
+
+
+index = SuggestionIndex()
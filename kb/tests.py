@@ -1,3 +1,1329 @@
-from django.test import TestCase
+import json
+import os
+import shutil
+import tempfile
+from io import StringIO
+from datetime import timedelta
+from unittest import mock, skipUnless
 
-# Create your tests here.
+import numpy as np
+from django.apps import apps
+from django.contrib.auth.models import AnonymousUser, User
+from django.contrib.sessions.backends.db import SessionStore
+from django.core.management import call_command
+from django.db import DatabaseError, connection
+from django.db.models.signals import pre_save
+from django.test import RequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from . import (analytics, bloom, buffers, coalesce, comment_tree, deferred, export, hyperloglog, partitions, percolator, query_parser,
+               retention, search, semantic, suggest)
+from .models import (Article, ArticleComment, ArticleFavorite, ArticleParagraph, ArticleRating, ArticleReadStatus,
+                     ArticleView, ArticleViewBreakdown, ArticleViewDaily, ArticleViewSketch, ContentVersion, ParagraphLike,
+                     ReadLater, SavedSearch, SavedSearchMatch, SearchLog, SearchQueryStat, SecureShareLink, ShareLinkView,
+                     ShareLinkViewRecord, Space, Tag, TagCategory, TagGroup, UserArticleState, article_read_coalescer,
+                     article_view_buffer, article_view_filter, article_view_partitions, share_link_view_buffer,
+                     share_link_view_partitions)
+
+
+class KbTestCase(TestCase):
+
+    def setUp(self):
+        self.alice = User.objects.create_user('alice', password='pw12345!x')
+        self.bob = User.objects.create_user('bob', password='pw12345!x')
+        self.infra = Space.objects.create(name='Infrastructure', description='infra')
+        self.docs = Space.objects.create(name='Docs', description='docs')
+        self.article = Article.objects.create(
+            title='Kubernetes deployment guide', summary='How to deploy services',
+            space=self.infra, author=self.alice, status='live',
+        )
+        self.other = Article.objects.create(
+            title='Python packaging', summary='Wheels and sdists', space=self.docs, author=self.alice, status='live',
+        )
+        self.paragraph = ArticleParagraph.objects.create(
+            article=self.article, title='Helm charts', content='<p>Use helm to install releases.</p>', order=1,
+        )
+        self.second_paragraph = ArticleParagraph.objects.create(
+            article=self.article, title='Rollbacks', content='<p>Rolling back is easy.</p>', order=2,
+        )
+        # Partition tables created by an earlier test were rolled back with it
+        article_view_partitions._created.clear()
+        share_link_view_partitions._created.clear()
+        search.result_cache.clear()
+
+    def assertCountersExact(self, *models):
+        """Every stored engagement counter equals the count of its rows"""
+        for model in models or (Article, ArticleParagraph):
+            counters = model.ENGAGEMENT_COUNTERS
+            for row in model.objects.with_counted_engagement().values('pk', *counters,
+                                                                      *(f'counted_{name}' for name in counters)):
+                for name in counters:
+                    self.assertEqual(row[name], row[f'counted_{name}'], f'{model.__name__} {row["pk"]} {name}')
+
+    def counters(self, article):
+        article.refresh_from_db()
+        return article.rating_sum, article.rating_count, article.approved_comment_count, article.favorites_count
+
+
+class BufferedTestCase(KbTestCase):
+    """
+    Buffers are flushed explicitly and deferred tasks run as their request
+    finishes, on the test's own connection, instead of by their threads
+    """
+
+    def setUp(self):
+        super().setUp()
+        for patcher in (
+            mock.patch.object(buffers.BulkBuffer, '_ensure_thread'),
+            mock.patch.object(deferred.tasks, 'submit', self.run_deferred),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        # Rows left over would be flushed at exit, after the test database is gone
+        for buffer in buffers._buffers:
+            buffer.discard()
+            self.addCleanup(buffer.discard)
+        article_view_filter.clear()
+
+    @staticmethod
+    def run_deferred(func, args=(), kwargs=None):
+        deferred.tasks._run(func, args, kwargs or {})
+
+    def buffer(self, model='kb.Space', **kwargs):
+        buffer = buffers.BulkBuffer(model, **kwargs)
+        self.addCleanup(buffers._buffers.remove, buffer)
+        return buffer
+
+    def read(self, article, user=None, ip='10.0.0.1', user_agent='Firefox/130.0'):
+        request = RequestFactory().get('/', REMOTE_ADDR=ip, HTTP_USER_AGENT=user_agent)
+        request.user = user or AnonymousUser()
+        request.session = SessionStore()
+        article.record_view(request)
+
+
+class BulkBufferTests(BufferedTestCase):
+
+    def test_flush_writes_queued_rows(self):
+        buffer = self.buffer()
+        for number in range(3):
+            self.assertTrue(buffer.append(Space(name=f'Space {number}', description='')))
+        self.assertEqual(Space.objects.filter(name__startswith='Space ').count(), 0)
+        self.assertEqual(buffer.flush(), 3)
+        self.assertEqual(Space.objects.filter(name__startswith='Space ').count(), 3)
+        self.assertEqual(buffer.stats(), {'buffered': 0, 'written': 3, 'dropped': 0, 'failed': 0})
+        self.assertEqual(buffer.flush(), 0)
+
+    def test_full_buffer_drops_new_rows(self):
+        buffer = self.buffer(max_buffered=2)
+        results = [buffer.append(Space(name=f'Space {number}', description='')) for number in range(3)]
+        self.assertEqual(results, [True, True, False])
+        self.assertEqual(buffer.flush(), 2)
+        self.assertEqual(buffer.stats()['dropped'], 1)
+
+    def test_after_write_runs_with_the_batch(self):
+        batches = []
+        buffer = self.buffer(after_write=batches.append)
+        buffer.append(Space(name='Space 1', description=''))
+        buffer.flush()
+        self.assertEqual([[space.name for space in batch] for batch in batches], [['Space 1']])
+
+    def test_failed_batch_is_rolled_back_and_counted(self):
+        def fail(rows):
+            raise RuntimeError('rollup failed')
+
+        buffer = self.buffer(after_write=fail)
+        buffer.append(Space(name='Space 1', description=''))
+        with self.assertRaises(RuntimeError):
+            buffer.flush()
+        self.assertFalse(Space.objects.filter(name='Space 1').exists())
+        self.assertEqual(buffer.stats(), {'buffered': 0, 'written': 0, 'dropped': 0, 'failed': 1})
+
+    def test_article_views_are_written_on_flush(self):
+        self.read(self.article)
+        self.read(self.article, user=self.bob)
+        self.assertEqual(len(article_view_buffer), 2)
+        self.assertEqual(article_view_partitions.count(), 0)
+        self.assertEqual(article_view_buffer.flush(), 2)
+        self.assertEqual(article_view_partitions.count(), 2)
+
+
+@skipUnless(search.fts_available(), 'SQLite FTS5 is not available')
+class ParagraphHitTests(BufferedTestCase):
+
+    def test_hits_link_to_the_matching_paragraph(self):
+        hits = search.paragraph_hits(search.build_match_expression('helm'), [self.article.pk, self.other.pk])
+        self.assertEqual(list(hits), [self.article.pk])
+        [hit] = hits[self.article.pk]
+        self.assertEqual(hit['id'], self.paragraph.pk)
+        self.assertEqual(hit['anchor'], f'paragraph-{self.paragraph.pk}')
+        self.assertEqual(hit['snippet'], 'Use <mark>helm</mark> to install releases.')
+
+    def test_snippets_are_escaped(self):
+        ArticleParagraph.objects.create(article=self.other, title='Markup', order=1,
+                                        content='<p>Write &lt;b&gt;wheel&lt;/b&gt; tags</p>')
+        [hit] = search.paragraph_hits(search.build_match_expression('wheel'), [self.other.pk])[self.other.pk]
+        self.assertEqual(hit['snippet'], 'Write &lt;b&gt;<mark>wheel</mark>&lt;/b&gt; tags')
+
+    def test_hits_per_article_are_capped(self):
+        for number in range(search.PARAGRAPH_HITS_PER_ARTICLE + 2):
+            ArticleParagraph.objects.create(article=self.article, title=f'Helm {number}', content='helm', order=3)
+        hits = search.paragraph_hits(search.build_match_expression('helm'), [self.article.pk])
+        self.assertEqual(len(hits[self.article.pk]), search.PARAGRAPH_HITS_PER_ARTICLE)
+
+    def test_search_page_shows_snippets(self):
+        response = self.client.get('/search/', {'q': 'helm'})
+        self.assertContains(response, f'#paragraph-{self.paragraph.pk}')
+        self.assertContains(response, '<mark>helm</mark>', html=False)
+
+
+@skipUnless(search.fts_available(), 'SQLite FTS5 is not available')
+class FacetTests(BufferedTestCase):
+
+    def helm_articles(self, count):
+        for number in range(count):
+            article = Article.objects.create(title=f'Release {number}', summary='Notes', space=self.docs,
+                                             author=self.bob, status='live')
+            ArticleParagraph.objects.create(article=article, title='Upgrade', content='helm upgrade', order=1)
+
+    def test_facets_count_every_match(self):
+        self.helm_articles(2)
+        result = search.run_search('helm')
+        self.assertFalse(result['facets_truncated'])
+        self.assertEqual({value: count for value, _, count in result['facets']['space']},
+                         {self.docs.pk: 2, self.infra.pk: 1})
+        self.assertEqual({value: count for value, _, count in result['facets']['author']},
+                         {self.bob.pk: 2, self.alice.pk: 1})
+
+    def test_paragraphs_of_one_article_count_once_against_the_limit(self):
+        for number in range(5):
+            ArticleParagraph.objects.create(article=self.article, title=f'Helm {number}', content='helm', order=3)
+        self.helm_articles(2)
+        with mock.patch.object(search, 'CANDIDATE_LIMIT', 3):
+            result = search.run_search('helm')
+        self.assertEqual(len(result['ranked']), 3)
+        self.assertFalse(result['facets_truncated'])
+
+    def test_counts_beyond_the_candidate_limit_are_lower_bounds(self):
+        self.helm_articles(4)
+        with mock.patch.object(search, 'CANDIDATE_LIMIT', 3):
+            result = search.run_search('helm')
+            response = self.client.get('/search/', {'q': 'helm'})
+        self.assertTrue(result['facets_truncated'])
+        self.assertEqual(sum(count for _, _, count in result['facets']['status']), 3)
+        self.assertContains(response, '3+</span>')
+
+
+@skipUnless(search.fts_available(), 'SQLite FTS5 is not available')
+class SpellingTests(BufferedTestCase):
+
+    def test_similar_terms_come_from_the_vocabulary(self):
+        self.assertEqual(search.similar_terms('kuberntes')[0], 'kubernetes')
+        self.assertEqual(search.similar_terms('zzzzzz'), [])
+
+    def test_misspelled_words_are_corrected_in_place(self):
+        self.assertEqual(search.suggest_correction('Kuberntes deploymnt'), 'kubernetes deployment')
+        self.assertEqual(search.suggest_correction('helm releeses'), 'helm releases')
+
+    def test_known_words_and_hopeless_queries_get_no_suggestion(self):
+        self.assertIsNone(search.suggest_correction('kubernetes'))
+        self.assertIsNone(search.suggest_correction('qqqqqq'))
+
+    def test_suggestions_must_find_visible_articles(self):
+        Article.objects.create(title='Terraform modules', summary='', space=self.infra, author=self.alice,
+                               status='draft')
+        self.assertIsNone(search.suggest_correction('terraform modles', self.bob))
+        self.assertEqual(search.suggest_correction('terraform modles', self.alice), 'terraform modules')
+
+    def test_search_page_offers_the_correction(self):
+        response = self.client.get('/search/', {'q': 'kuberntes'})
+        self.assertContains(response, 'Did you mean')
+        self.assertContains(response, '?q=kubernetes')
+
+
+class SuggestTests(BufferedTestCase):
+
+    def setUp(self):
+        super().setUp()
+        suggest.index.clear()
+        self.addCleanup(suggest.index.clear)
+
+    def labels(self, prefix, user=None):
+        return [entry['label'] for entry in suggest.index.suggest(prefix, user)]
+
+    def test_prefixes_match_any_word(self):
+        self.assertEqual(self.labels('kube'), ['Kubernetes deployment guide'])
+        self.assertEqual(self.labels('DEPLOY'), ['Kubernetes deployment guide'])
+        self.assertEqual(self.labels('infra'), ['Infrastructure'])
+        self.assertEqual(self.labels('zz'), [])
+
+    def test_drafts_are_suggested_to_their_author_only(self):
+        Article.objects.create(title='Kubernetes draft', summary='', space=self.infra, author=self.alice,
+                               status='draft')
+        self.assertNotIn('Kubernetes draft', self.labels('kube', self.bob))
+        self.assertIn('Kubernetes draft', self.labels('kube', self.alice))
+
+    def test_saves_update_the_loaded_index(self):
+        self.labels('kube')
+        self.article.title = 'Helm deployment guide'
+        self.article.save()
+        self.assertEqual(self.labels('kube'), [])
+        self.assertEqual(self.labels('helm'), ['Helm deployment guide'])
+
+    def test_stale_index_is_rebuilt_after_the_response(self):
+        self.labels('kube')
+        # Written by another process: no signal reaches this index
+        Article.objects.filter(pk=self.other.pk).update(title='Kustomize overlays')
+        suggest.index._loaded_at -= suggest.RELOAD_INTERVAL + 1
+
+        deferred._request.pending = []
+        try:
+            self.assertEqual(self.labels('ku'), ['Kubernetes deployment guide'])
+            self.labels('ku')
+            pending = deferred._request.pending
+        finally:
+            deferred._request.pending = None
+        self.assertEqual(len(pending), 1)
+
+        for func, args, kwargs in pending:
+            func(*args, **kwargs)
+        self.assertEqual(self.labels('ku'), ['Kubernetes deployment guide', 'Kustomize overlays'])
+
+    def test_updates_made_during_a_rebuild_are_kept(self):
+        read = suggest.index._read
+
+        def read_then_rename():
+            loaded = read()
+            self.article.title = 'Helm deployment guide'
+            self.article.save()
+            return loaded
+
+        with mock.patch.object(suggest.index, '_read', read_then_rename):
+            suggest.index.load()
+        self.assertEqual(self.labels('kube'), [])
+        self.assertEqual(self.labels('helm'), ['Helm deployment guide'])
+
+    def test_api(self):
+        response = self.client.get('/api/suggest/', {'q': 'pyth'})
+        self.assertEqual(response.json()['suggestions'], [{
+            'type': 'article', 'id': self.other.pk, 'label': 'Python packaging', 'url': f'/article/{self.other.pk}/',
+        }])
+
+
+class SearchCacheTests(KbTestCase):
+
+    def test_results_are_cached_until_content_changes(self):
+        first = search.run_search('kubernetes')
+        self.assertIs(search.run_search('kubernetes'), first)
+
+        version = ContentVersion.current()
+        new = Article.objects.create(title='Kubernetes upgrades', summary='kubernetes', space=self.infra,
+                                     author=self.alice, status='live')
+        self.assertGreater(ContentVersion.current(), version)
+        second = search.run_search('kubernetes')
+        self.assertIsNot(second, first)
+        self.assertIn(new.pk, [article_id for article_id, _ in second['ranked']])
+
+    def test_paragraph_edits_invalidate(self):
+        self.assertEqual(search.run_search('tiller')['ranked'], [])
+        self.second_paragraph.content = '<p>Tiller is gone.</p>'
+        self.second_paragraph.save()
+        self.assertEqual([article_id for article_id, _ in search.run_search('tiller')['ranked']], [self.article.pk])
+
+    def test_explicit_bump_invalidates(self):
+        first = search.run_search('helm')
+        ContentVersion.bump()
+        self.assertIsNot(search.run_search('helm'), first)
+
+    def test_tagging_invalidates(self):
+        group = TagGroup.objects.create(name='Technology')
+        tag = Tag.objects.create(name='Python', category=TagCategory.objects.create(name='Languages', group=group))
+        first = search.run_search('tag:python')
+        self.assertEqual(first['ranked'], [])
+        self.other.tags.add(tag)
+        self.assertEqual([article_id for article_id, _ in search.run_search('tag:python')['ranked']], [self.other.pk])
+
+    def test_users_without_drafts_share_entries(self):
+        self.assertEqual(search.cache_key('Helm ', self.bob, {}), search.cache_key('helm', None, {}))
+
+
+class QueryParserTests(TestCase):
+
+    def test_text_and_fields(self):
+        parsed = query_parser.parse('space:Infra tag:python "exact phrase" -deprecated')
+        self.assertEqual(parsed.match, '"exact phrase"')
+        self.assertEqual(parsed.exclude_match, '"deprecated"')
+        self.assertEqual(parsed.include, {'space': {'Infra'}, 'tag': {'python'}})
+        self.assertEqual(parsed.exclude, {})
+
+    def test_boolean_operators(self):
+        parsed = query_parser.parse('(kubernetes OR k8s) AND helm NOT tiller')
+        self.assertEqual(parsed.match, '(("kubernetes") OR ("k8s")) AND ("helm")')
+        self.assertEqual(parsed.exclude_match, '"tiller"')
+
+    def test_prefix_and_excluded_field(self):
+        parsed = query_parser.parse('author:alice -space:Docs deploy*')
+        self.assertEqual(parsed.match, '"deploy"*')
+        self.assertEqual(parsed.include, {'author': {'alice'}})
+        self.assertEqual(parsed.exclude, {'space': {'Docs'}})
+
+    def test_empty_query(self):
+        self.assertTrue(query_parser.parse('').is_empty)
+        self.assertTrue(query_parser.parse('   ').is_empty)
+
+
+class SearchTests(KbTestCase):
+
+    def ids(self, query, **kwargs):
+        return {article_id for article_id, _ in search.run_search(query, **kwargs)['ranked']}
+
+    @skipUnless(search.fts_available(), 'SQLite FTS5 is not available')
+    def test_field_filters_apply_beyond_the_first_results(self):
+        for number in range(search.RESULT_LIMIT + 10):
+            Article.objects.create(title=f'Kubernetes kubernetes {number}', summary='kubernetes kubernetes',
+                                   space=self.infra, author=self.alice, status='live')
+        docs_ids = {
+            Article.objects.create(
+                title=f'Notes {number}', summary='A long summary that mentions kubernetes only once ' * 5,
+                space=self.docs, author=self.alice, status='live',
+            ).pk
+            for number in range(3)
+        }
+        self.assertEqual(self.ids('kubernetes space:Docs'), docs_ids)
+        self.assertNotIn(self.article.pk, self.ids('kubernetes -space:Infrastructure'))
+
+        result = search.run_search('kubernetes')
+        self.assertEqual(len(result['ranked']), search.RESULT_LIMIT)
+        space_counts = {str(value): count for value, _, count in result['facets']['space']}
+        self.assertEqual(space_counts[str(self.docs.pk)], 3)
+        self.assertEqual(space_counts[str(self.infra.pk)], search.RESULT_LIMIT + 11)
+
+    def test_drafts_are_only_found_by_their_author(self):
+        draft = Article.objects.create(title='Kubernetes draft', summary='kubernetes', space=self.infra,
+                                       author=self.alice, status='draft')
+        self.assertIn(draft.pk, self.ids('kubernetes', user=self.alice))
+        self.assertNotIn(draft.pk, self.ids('kubernetes', user=self.bob))
+        self.assertEqual(search.visibility_class(self.bob), 'public')
+
+
+class SemanticTests(BufferedTestCase):
+
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        settings = override_settings(SEMANTIC_INDEX_DIR=directory)
+        settings.enable()
+        self.addCleanup(settings.disable)
+        semantic.index.close()
+        self.addCleanup(semantic.index.close)
+
+        self.helm = Article.objects.create(title='Helm in production', summary='', space=self.infra,
+                                           author=self.bob, status='live')
+        ArticleParagraph.objects.create(article=self.helm, title='Charts',
+                                        content='<p>Helm charts install releases on a kubernetes cluster.</p>')
+        ArticleParagraph.objects.create(article=self.other, title='Wheels',
+                                        content='<p>Build wheels and sdists with pip and publish packages.</p>')
+
+    def similar(self, article, user=None):
+        return [article_id for article_id, _ in semantic.index.similar_articles(article.pk, user)]
+
+    def test_build_and_similar_articles(self):
+        rows, dimensions = semantic.build()
+        self.assertEqual(rows, 4)
+        self.assertGreater(dimensions, 0)
+        self.assertEqual(self.similar(self.article)[0], self.helm.pk)
+        self.assertNotIn(self.article.pk, self.similar(self.article))
+
+    def test_search_by_meaning(self):
+        semantic.build()
+        ranked = semantic.index.search('helm charts releases')
+        self.assertEqual({article_id for article_id, _ in ranked[:2]}, {self.article.pk, self.helm.pk})
+
+    def test_update_reembeds_changed_articles_only(self):
+        semantic.build()
+        self.assertEqual(semantic.update(), (0, 0))
+        paragraph = self.other.paragraphs.get()
+        paragraph.content = '<p>Helm charts and kubernetes releases</p>'
+        paragraph.save()
+        self.assertEqual(semantic.update(), (1, 1))
+        self.assertIn(self.other.pk, self.similar(self.article)[:2])
+
+    def test_similar_articles_are_ranked_once_per_index_version(self):
+        semantic.build()
+        with mock.patch.object(semantic.SemanticIndex, '_article_scores',
+                               autospec=True, side_effect=semantic.SemanticIndex._article_scores) as scores:
+            first = self.similar(self.article)
+            self.assertEqual(self.similar(self.article), first)
+            self.assertEqual(scores.call_count, 1)
+            semantic.build()
+            self.similar(self.article)
+            self.assertEqual(scores.call_count, 2)
+
+    def test_drafts_are_only_related_for_their_author(self):
+        semantic.build()
+        self.helm.status = 'draft'
+        self.helm.save()
+        self.assertNotIn(self.helm.pk, self.similar(self.article, self.alice))
+        self.assertIn(self.helm.pk, self.similar(self.article, self.bob))
+
+    def test_article_page_lists_related_articles(self):
+        semantic.build()
+        response = self.client.get(f'/article/{self.article.pk}/')
+        self.assertContains(response, 'Helm in production')
+        response = self.client.get(f'/api/article/{self.article.pk}/similar/')
+        self.assertEqual(response.json()['articles'][0]['id'], self.helm.pk)
+
+
+class SearchAnalyticsTests(BufferedTestCase):
+
+    def stats(self):
+        return {stat.query: (stat.searches, stat.zero_result_searches, stat.clicks)
+                for stat in SearchQueryStat.objects.all()}
+
+    def test_searches_and_clicks_are_logged_in_batches(self):
+        self.client.get('/search/', {'q': 'Helm  charts'})
+        self.client.get(f'/search/click/{self.article.pk}/', {'q': 'helm charts'})
+        self.assertEqual(len(analytics.buffer), 2)
+        self.assertEqual(SearchLog.objects.count(), 0)
+        analytics.buffer.flush()
+        self.assertEqual(
+            list(SearchLog.objects.order_by('id').values_list('event', 'query', 'article_id')),
+            [('search', 'helm charts', None), ('click', 'helm charts', self.article.pk)],
+        )
+
+    def test_rollup_folds_the_log_into_daily_stats(self):
+        for query, results in (('helm', 2), ('Helm', 1), ('tiler', 0)):
+            analytics.record_search(query, results)
+        analytics.record_click('helm', self.article.pk)
+        call_command('rollup_search_analytics', stdout=StringIO())
+        self.assertEqual(self.stats(), {'helm': (2, 0, 1), 'tiler': (1, 1, 0)})
+        self.assertEqual(SearchLog.objects.count(), 0)
+
+        analytics.record_search('tiler', 0)
+        call_command('rollup_search_analytics', stdout=StringIO())
+        self.assertEqual(self.stats()['tiler'], (2, 2, 0))
+        self.assertEqual(SearchQueryStat.objects.count(), 2)
+
+    def test_reports(self):
+        for query, results in (('helm', 2), ('helm', 2), ('tiler', 0), ('wheels', 1)):
+            analytics.record_search(query, results)
+        analytics.buffer.flush()
+        analytics.rollup()
+        self.assertEqual([row['query'] for row in analytics.top_queries()], ['helm', 'tiler', 'wheels'])
+        self.assertEqual([row['query'] for row in analytics.top_queries(zero_results=True)], ['tiler'])
+
+
+@skipUnless(search.fts_available(), 'SQLite FTS5 is not available')
+class PercolatorTests(BufferedTestCase):
+
+    def save_search(self, query, user=None):
+        return SavedSearch.objects.create(user=user or self.bob, query=query)
+
+    def matched(self, saved_search):
+        return set(saved_search.matches.values_list('article_id', flat=True))
+
+    def draft(self, title, content='', space=None):
+        article = Article.objects.create(title=title, summary='', space=space or self.infra, author=self.alice,
+                                         status='draft')
+        if content:
+            ArticleParagraph.objects.create(article=article, title='Body', content=content, order=1)
+        return article
+
+    def test_anchor_keys(self):
+        self.assertEqual(percolator.anchor_keys('kubernetes helm'), {'term:kubernet'})
+        self.assertEqual(percolator.anchor_keys('helm OR kustomize'), {'term:helm', 'term:kustom'})
+        self.assertEqual(percolator.anchor_keys('space:Docs'), {f'space:{self.docs.pk}'})
+        self.assertEqual(percolator.anchor_keys('space:Nowhere helm'), set())
+        self.assertEqual(percolator.anchor_keys('-helm'), {percolator.ANY_KEY})
+
+    def test_articles_are_matched_when_they_go_live(self):
+        helm = self.save_search('helm charts')
+        docs = self.save_search('space:Docs')
+        other = self.save_search('terraform')
+        article = self.draft('Helm tips', '<p>Write your own helm charts.</p>')
+        self.assertEqual(self.matched(helm), set())
+
+        article.status = 'live'
+        article.save()
+        self.assertEqual(self.matched(helm), {article.pk})
+        self.assertEqual(self.matched(docs), set())
+        self.assertEqual(self.matched(other), set())
+
+        # Saving a live article again does not percolate it
+        with mock.patch.object(percolator, 'percolate') as percolate:
+            article.save()
+        percolate.assert_not_called()
+        self.assertEqual(SavedSearchMatch.objects.count(), 1)
+
+    def test_field_clauses_and_exclusions_are_verified(self):
+        docs = self.save_search('space:Docs -helm')
+        helm_doc = self.draft('Helm reference', '<p>Helm</p>', space=self.docs)
+        wheels = self.draft('Wheels', '<p>Wheels and sdists</p>', space=self.docs)
+        for article in (helm_doc, wheels):
+            article.status = 'live'
+            article.save()
+        self.assertEqual(self.matched(docs), {wheels.pk})
+
+    def test_edits_of_live_articles_percolate_once_after_the_response(self):
+        terraform = self.save_search('terraform')
+        self.client.force_login(self.alice)
+        with mock.patch.object(percolator, 'percolate', wraps=percolator.percolate) as percolate:
+            self.client.post(f'/article/{self.article.pk}/paragraph/add/',
+                             {'title': 'Terraform', 'content': '<p>Provision the cluster with terraform.</p>'})
+        self.assertEqual(percolate.call_count, 1)
+        self.assertEqual(self.matched(terraform), {self.article.pk})
+
+
+class ViewTestCase(BufferedTestCase):
+
+    def view(self, days_ago=0, user=None, ip='10.0.0.1'):
+        article_view_buffer.append(ArticleView(article=self.article, user=user, ip_address=ip,
+                                               viewed_at=timezone.now() - timedelta(days=days_ago)))
+
+
+class DailyViewTests(ViewTestCase):
+
+    def days(self):
+        return {row.day: (row.views, row.authenticated_views, row.anonymous_views)
+                for row in ArticleViewDaily.objects.filter(article=self.article)}
+
+    def test_flushed_views_are_added_to_daily_rows(self):
+        today = timezone.localdate()
+        yesterday = today - timedelta(days=1)
+        self.view()
+        self.view(user=self.bob)
+        self.view(days_ago=1)
+        article_view_buffer.flush()
+        self.assertEqual(self.days(), {today: (2, 1, 1), yesterday: (1, 0, 1)})
+
+        self.view(user=self.alice)
+        article_view_buffer.flush()
+        self.assertEqual(self.days()[today], (3, 2, 1))
+        self.assertEqual(self.article.get_view_count(), 4)
+        self.assertEqual(self.other.get_view_count(), 0)
+
+    def test_article_page_shows_the_rolled_up_count(self):
+        for days_ago in (0, 1, 2):
+            self.view(days_ago=days_ago, ip=f'10.0.0.{days_ago}')
+        article_view_buffer.flush()
+        response = self.client.get(f'/article/{self.article.pk}/')
+        self.assertEqual(response.context['view_count'], 3)
+
+
+class HyperLogLogTests(TestCase):
+
+    def test_estimates_are_close(self):
+        for count in (1, 10, 1000, 20000):
+            sketch = hyperloglog.HyperLogLog().update(f'ip:{number}' for number in range(count))
+            self.assertAlmostEqual(sketch.count(), count, delta=max(1, count * 0.05))
+
+    def test_repeats_are_not_counted(self):
+        sketch = hyperloglog.HyperLogLog().update(['user:1', 'user:1', 'ip:10.0.0.1'] * 50)
+        self.assertEqual(sketch.count(), 2)
+
+    def test_merged_sketches_count_the_union(self):
+        first = hyperloglog.HyperLogLog().update(f'ip:{number}' for number in range(0, 3000))
+        second = hyperloglog.HyperLogLog().update(f'ip:{number}' for number in range(2000, 5000))
+        union = hyperloglog.merged([first.to_bytes(), b'', second.to_bytes()])
+        self.assertAlmostEqual(union.count(), 5000, delta=250)
+        self.assertEqual(hyperloglog.HyperLogLog.from_bytes(first.to_bytes()).registers, first.registers)
+
+
+class UniqueViewTests(ViewTestCase):
+
+    def test_unique_views_by_visitor(self):
+        for days_ago in (0, 0, 1, 2):
+            self.view(days_ago=days_ago)
+        self.view(user=self.bob)
+        self.view(days_ago=1, user=self.bob, ip='10.0.0.2')
+        self.view(days_ago=2, ip='10.0.0.3')
+        article_view_buffer.flush()
+
+        self.assertEqual(self.article.get_view_count(), 7)
+        self.assertEqual(self.article.get_unique_view_count(), 3)
+        self.assertEqual(ArticleViewSketch.objects.get(article=self.article).unique_views, 3)
+        today = timezone.localdate()
+        self.assertEqual(self.article.get_unique_view_count(start=today), 2)
+        self.assertEqual(self.article.get_unique_view_count(start=today - timedelta(days=2),
+                                                            end=today - timedelta(days=1)), 3)
+        self.assertEqual(ArticleViewDaily.objects.get(article=self.article, day=today).unique_views, 2)
+
+
+class CompactionTests(KbTestCase):
+
+    def view(self, days_ago, **kwargs):
+        return ArticleView(article=self.article, ip_address='10.0.0.1',
+                           viewed_at=timezone.now() - timedelta(days=days_ago), **kwargs)
+
+    def breakdown(self, kind):
+        totals = {}
+        for row in ArticleViewBreakdown.objects.filter(article=self.article, kind=kind):
+            totals[row.value] = totals.get(row.value, 0) + row.views
+        return totals
+
+    def test_referrer_and_user_agent_buckets(self):
+        self.assertEqual(retention.referrer_host('https://www.Example.com/docs?q=1'), 'example.com')
+        self.assertEqual(retention.referrer_host(''), retention.DIRECT)
+        self.assertEqual(retention.user_agent_family('Mozilla/5.0 Chrome/126.0 Safari/537.36 Edg/126.0'), 'Edge')
+        self.assertEqual(retention.user_agent_family('Mozilla/5.0 Chrome/126.0 Safari/537.36'), 'Chrome')
+        self.assertEqual(retention.user_agent_family('Googlebot/2.1'), 'Bot')
+        self.assertEqual(retention.user_agent_family(None), retention.UNKNOWN)
+
+    def test_old_views_are_folded_into_breakdowns(self):
+        article_view_partitions.insert([
+            self.view(0, user_agent='Firefox/130.0', referrer='https://example.com/'),
+            self.view(100, user_agent='Firefox/130.0', referrer='https://example.com/a'),
+            self.view(100, user_agent='Chrome/126.0', referrer=''),
+            self.view(200, user_agent='curl/8.0', referrer='https://www.example.com/b'),
+        ])
+        ArticleView.legacy.create(article=self.article, ip_address='10.0.0.9', user_agent='Firefox/130.0',
+                                  viewed_at=timezone.now() - timedelta(days=300))
+
+        stats = retention.compact(days=90, batch_size=1)
+        self.assertEqual(stats['rows'], 4)
+        self.assertEqual(article_view_partitions.count(), 1)
+        self.assertEqual(self.breakdown(ArticleViewBreakdown.KIND_USER_AGENT),
+                         {'Firefox': 2, 'Chrome': 1, 'Script': 1})
+        self.assertEqual(self.breakdown(ArticleViewBreakdown.KIND_REFERRER),
+                         {'example.com': 2, retention.DIRECT: 2})
+
+        self.assertEqual(retention.compact(days=90)['rows'], 0)
+        self.assertEqual(sum(self.breakdown(ArticleViewBreakdown.KIND_USER_AGENT).values()), 4)
+
+    def test_command_reports_compacted_rows(self):
+        article_view_partitions.insert([self.view(days) for days in (0, 120)])
+        out = StringIO()
+        call_command('compact_article_views', '--days', '30', stdout=out)
+        self.assertIn('Compacted 1 article views', out.getvalue())
+        self.assertEqual(article_view_partitions.count(), 1)
+
+
+class BloomFilterTests(TestCase):
+
+    def test_no_false_negatives_and_few_false_positives(self):
+        bloom_filter = bloom.BloomFilter(capacity=1000, error_rate=0.01)
+        for number in range(1000):
+            bloom_filter.add(f'seen:{number}')
+        self.assertTrue(all(f'seen:{number}' in bloom_filter for number in range(1000)))
+        self.assertTrue(bloom_filter.add('seen:0'))
+        false_positives = sum(f'new:{number}' in bloom_filter for number in range(10000))
+        self.assertLess(false_positives, 300)
+
+    def test_items_are_forgotten_after_two_windows(self):
+        clock = mock.Mock(return_value=0)
+        with mock.patch.object(bloom.time, 'monotonic', clock):
+            bloom_filter = bloom.RotatingBloomFilter(window=60, capacity=100)
+            self.assertFalse(bloom_filter.seen('a'))
+            self.assertTrue(bloom_filter.seen('a'))
+            clock.return_value = 70
+            self.assertTrue(bloom_filter.seen('a'))
+            clock.return_value = 125
+            self.assertTrue(bloom_filter.seen('a'))
+            clock.return_value = 300
+            self.assertFalse(bloom_filter.seen('a'))
+
+    def test_zero_window_disables_dedup(self):
+        bloom_filter = bloom.RotatingBloomFilter(window=0, capacity=100)
+        self.assertFalse(bloom_filter.seen('a'))
+        self.assertFalse(bloom_filter.seen('a'))
+
+
+class ViewDedupTests(BufferedTestCase):
+
+    def test_repeat_views_are_recorded_once(self):
+        self.read(self.article)
+        self.read(self.article)
+        self.read(self.article, user=self.bob)
+        self.read(self.article, user=self.bob, ip='10.0.0.2')
+        self.read(self.article, ip='10.0.0.2')
+        self.read(self.article, user_agent='curl/8.0')
+        self.read(self.other)
+        article_view_buffer.flush()
+        self.assertEqual(self.article.get_view_count(), 4)
+        self.assertEqual(self.other.get_view_count(), 1)
+
+        article_view_filter.clear()
+        self.read(self.article)
+        article_view_buffer.flush()
+        self.assertEqual(self.article.get_view_count(), 5)
+
+
+class PartitionTests(KbTestCase):
+
+    def view(self, days_ago, ip='10.0.0.1', **kwargs):
+        return ArticleView(article=self.article, ip_address=ip, user_agent='Firefox/130.0',
+                           viewed_at=timezone.now() - timedelta(days=days_ago), **kwargs)
+
+    def test_insert_routes_rows_to_their_month(self):
+        views = [self.view(days) for days in (0, 0, 40, 75)]
+        article_view_partitions.insert(views)
+        months = {partitions.month_start(view.viewed_at) for view in views}
+        self.assertEqual(set(article_view_partitions.months()), months)
+        for month in months:
+            rows = article_view_partitions.model_for(month).objects.all()
+            self.assertTrue(all(partitions.id_month(row.id) == month for row in rows))
+        self.assertEqual(article_view_partitions.count(), 4)
+        self.assertEqual(ArticleView.legacy.count(), 0)
+
+    def test_ids_are_unique_across_partitions(self):
+        article_view_partitions.insert([self.view(days) for days in (0, 40, 75)])
+        ArticleView.legacy.create(article=self.article, ip_address='10.0.0.9')
+        ids = [row.id for queryset in article_view_partitions.querysets() for row in queryset]
+        self.assertEqual(len(ids), 4)
+        self.assertEqual(len(set(ids)), 4)
+        self.assertEqual(ids, sorted(ids))
+
+    def test_partition_models_stay_out_of_the_app_registry(self):
+        registered = len(apps.get_models())
+        article_view_partitions.insert([self.view(0)])
+        self.assertEqual(len(apps.get_models()), registered)
+        self.assertFalse(hasattr(self.article, 'views'))
+
+    def test_range_queries_read_overlapping_months_only(self):
+        article_view_partitions.insert([self.view(days) for days in (0, 40, 75)])
+        now = timezone.now()
+        querysets = article_view_partitions.querysets(start=now - timedelta(days=45), end=now - timedelta(days=35))
+        tables = [queryset.model._meta.db_table for queryset in querysets]
+        self.assertEqual(tables[0], ArticleView._meta.db_table)
+        self.assertEqual(len(tables), 2)
+        self.assertEqual(sum(queryset.count() for queryset in querysets), 1)
+
+    def test_absorb_legacy_keeps_ids(self):
+        legacy = ArticleView.legacy.create(article=self.article, ip_address='10.0.0.9')
+        self.assertEqual(article_view_partitions.absorb_legacy(), 1)
+        month = partitions.month_start(legacy.viewed_at)
+        self.assertTrue(article_view_partitions.model_for(month).objects.filter(pk=legacy.pk).exists())
+        self.assertEqual(ArticleView.legacy.count(), 0)
+
+    def test_deleting_an_article_deletes_its_views(self):
+        article_view_partitions.insert([self.view(0), self.view(40)])
+        self.article.delete()
+        self.assertEqual(article_view_partitions.count(), 0)
+
+    def test_share_link_views_read_through_the_union(self):
+        link = SecureShareLink.create_for_article(self.article, self.alice)
+        share_link_view_partitions.insert([
+            ShareLinkView(share_link=link, ip_address='10.1.0.1', user_agent='x',
+                          viewed_at=timezone.now() - timedelta(days=days))
+            for days in (0, 40)
+        ])
+        ShareLinkView.legacy.create(share_link=link, ip_address='10.1.0.2', user_agent='x')
+        self.assertEqual(ShareLinkViewRecord.objects.count(), 3)
+        share_link_view_partitions.drop(share_link_view_partitions.months()[0])
+        self.assertEqual(ShareLinkViewRecord.objects.count(), 2)
+
+        self.client.force_login(User.objects.create_superuser('root', password='pw12345!x'))
+        response = self.client.get('/admin/kb/sharelinkviewrecord/', {'q': '10.1.0.2'})
+        self.assertContains(response, '10.1.0.2')
+
+
+class ReadStatusTests(KbTestCase):
+
+    def setUp(self):
+        super().setUp()
+        article_read_coalescer.clear()
+        self.addCleanup(article_read_coalescer.clear)
+
+    def read_status(self):
+        return ArticleReadStatus.objects.get(article=self.article, user=self.bob)
+
+    def test_repeat_reads_update_one_row(self):
+        self.assertTrue(ArticleReadStatus.mark_as_read(self.article, self.bob))
+        first = self.read_status()
+        self.assertEqual(first.read_count, 1)
+
+        article_read_coalescer.clear()
+        self.assertTrue(ArticleReadStatus.mark_as_read(self.article, self.bob))
+        second = self.read_status()
+        self.assertEqual(ArticleReadStatus.objects.filter(user=self.bob).count(), 1)
+        self.assertEqual(second.read_count, 2)
+        self.assertEqual(second.first_read_at, first.first_read_at)
+        self.assertGreaterEqual(second.last_read_at, first.last_read_at)
+
+    def test_upsert_without_on_conflict(self):
+        with mock.patch.object(connection, 'vendor', 'mysql'):
+            ArticleReadStatus.mark_as_read(self.article, self.bob)
+            article_read_coalescer.clear()
+            ArticleReadStatus.mark_as_read(self.article, self.bob)
+        self.assertEqual(self.read_status().read_count, 2)
+
+    def test_reads_within_the_window_are_coalesced(self):
+        self.assertTrue(ArticleReadStatus.mark_as_read(self.article, self.bob))
+        with self.assertNumQueries(0):
+            self.assertFalse(ArticleReadStatus.mark_as_read(self.article, self.bob))
+        self.assertTrue(ArticleReadStatus.mark_as_read(self.other, self.bob))
+        self.assertFalse(ArticleReadStatus.mark_as_read(self.article, AnonymousUser()))
+        self.assertEqual(self.read_status().read_count, 1)
+
+    def test_failed_write_is_not_coalesced(self):
+        with mock.patch.object(ArticleReadStatus, '_upsert_read', side_effect=DatabaseError):
+            with self.assertRaises(DatabaseError):
+                ArticleReadStatus.mark_as_read(self.article, self.bob)
+        self.assertTrue(ArticleReadStatus.mark_as_read(self.article, self.bob))
+        self.assertEqual(self.read_status().read_count, 1)
+
+    def test_recently_seen_is_bounded(self):
+        recent = coalesce.RecentlySeen(window=60, max_entries=2)
+        for key in ('a', 'b', 'c'):
+            self.assertFalse(recent.seen(key))
+        self.assertTrue(recent.seen('c'))
+        self.assertFalse(recent.seen('a'))
+        self.assertFalse(coalesce.RecentlySeen(window=0).seen('a'))
+
+
+class ShareLinkViewTests(BufferedTestCase):
+
+    def test_views_update_the_link_on_flush(self):
+        link = SecureShareLink.create_for_article(self.article, self.alice)
+        link.record_view('10.1.0.1', 'Firefox/130.0')
+        link.record_view('10.1.0.2')
+        self.assertEqual(link.view_count, 2)
+        self.assertEqual(len(share_link_view_buffer), 2)
+        link.refresh_from_db()
+        self.assertEqual(link.view_count, 0)
+
+        self.assertEqual(share_link_view_buffer.flush(), 2)
+        link.refresh_from_db()
+        self.assertEqual(link.view_count, 2)
+        self.assertIsNotNone(link.last_accessed)
+        self.assertEqual(share_link_view_partitions.count(), 2)
+        self.assertEqual(sorted(ShareLinkViewRecord.objects.values_list('ip_address', flat=True)), ['10.1.0.1', '10.1.0.2'])
+
+    def test_batches_add_to_concurrent_counts(self):
+        link = SecureShareLink.create_for_article(self.article, self.alice)
+        earlier = timezone.now() - timedelta(hours=1)
+        link.record_view('10.1.0.1')
+        link.record_view('10.1.0.2')
+        SecureShareLink.objects.filter(pk=link.pk).update(view_count=5, last_accessed=timezone.now() + timedelta(hours=1))
+        share_link_view_buffer.flush()
+        link.refresh_from_db()
+        self.assertEqual(link.view_count, 7)
+        self.assertGreater(link.last_accessed, earlier + timedelta(hours=1))
+
+
+class DeferredTests(BufferedTestCase):
+
+    def queue(self, **kwargs):
+        tasks = deferred.DeferredQueue(**kwargs)
+        patcher = mock.patch.object(tasks, '_ensure_threads')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return tasks
+
+    def test_queued_tasks_run_on_drain(self):
+        tasks = self.queue(max_queued=2)
+        ran = []
+        for number in range(3):
+            tasks.submit(ran.append, (number,))
+        self.assertEqual(ran, [2])
+        self.assertEqual(tasks.stats()['queued'], 2)
+        self.assertEqual(tasks.drain(), 2)
+        self.assertEqual(ran, [2, 0, 1])
+        self.assertEqual(tasks.stats(), {'queued': 0, 'max_queued': 2, 'completed': 3, 'failed': 0,
+                                         'ran_inline': 1, 'workers': deferred.WORKERS})
+
+    def test_failed_tasks_are_counted(self):
+        tasks = self.queue()
+        ran = []
+        tasks.submit(int, ('not a number',))
+        tasks.submit(ran.append, (1,))
+        with self.assertLogs('kb.deferred', 'ERROR'):
+            tasks.drain()
+        self.assertEqual(ran, [1])
+        self.assertEqual((tasks.completed, tasks.failed), (1, 1))
+
+    def test_calls_outside_a_request_run_now(self):
+        ran = []
+        deferred.defer(ran.append, 1)
+        self.assertEqual(ran, [1])
+
+    def test_article_page_writes_after_the_response(self):
+        submitted = []
+        article_read_coalescer.clear()
+        self.client.force_login(self.bob)
+        with mock.patch.object(deferred.tasks, 'submit', lambda *task: submitted.append(task)):
+            response = self.client.get(f'/article/{self.article.pk}/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(article_view_buffer), 0)
+        self.assertFalse(ArticleReadStatus.objects.filter(user=self.bob).exists())
+
+        self.assertEqual(len(submitted), 2)
+        for task in submitted:
+            self.run_deferred(*task)
+        self.assertEqual(len(article_view_buffer), 1)
+        self.assertTrue(ArticleReadStatus.objects.filter(article=self.article, user=self.bob).exists())
+
+
+class ExportTests(KbTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.out = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.out)
+
+    def export_views(self):
+        rows, run_dir = export.export_dataset('article_views', self.out)
+        if run_dir is None:
+            return []
+        return np.load(os.path.join(run_dir, 'id.npy')).tolist()
+
+    def view(self, days_ago):
+        return ArticleView(article=self.article, ip_address='10.0.0.1',
+                           viewed_at=timezone.now() - timedelta(days=days_ago))
+
+    def test_view_ids_are_unique_and_watermarked_per_partition(self):
+        article_view_partitions.insert([self.view(40), self.view(40), self.view(0), self.view(0)])
+        ids = self.export_views()
+        self.assertEqual(len(set(ids)), 4)
+
+        # A view written late into the previous month is still exported
+        late = self.view(40)
+        article_view_partitions.insert([late, self.view(0)])
+        self.assertEqual(len(self.export_views()), 2)
+        self.assertEqual(self.export_views(), [])
+
+        with open(os.path.join(self.out, 'watermarks.json')) as handle:
+            marks = json.load(handle)['article_views']
+        month = partitions.month_start(late.viewed_at)
+        self.assertEqual(partitions.id_month(marks[article_view_partitions.table_name(month)]), month)
+
+    def test_meta_describes_the_key(self):
+        article_view_partitions.insert([self.view(0)])
+        rows, run_dir = export.export_dataset('article_views', self.out)
+        with open(os.path.join(run_dir, 'meta.json')) as handle:
+            self.assertEqual(json.load(handle)['key']['column'], 'id')
+
+
+class ListingQueryTests(BufferedTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.client.force_login(self.bob)
+        self.add_articles(2)
+
+    def add_articles(self, count):
+        for number in range(count):
+            article = Article.objects.create(title=f'Helm notes {number}', summary='helm', space=self.infra,
+                                             author=self.alice, status='live')
+            ArticleFavorite.objects.create(article=article, user=self.bob)
+            ArticleReadStatus.objects.create(article=article, user=self.bob)
+            article_view_buffer.append(ArticleView(article=article, ip_address=f'10.0.0.{number}'))
+        article_view_buffer.flush()
+
+    def queries(self, url):
+        search.result_cache.clear()
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.client.get(url).status_code, 200)
+        return len(queries)
+
+    def test_with_stats_loads_counters_in_one_query(self):
+        with self.assertNumQueries(1):
+            articles = {article.title: article for article in Article.objects.with_stats().filter(space=self.infra)}
+            self.assertEqual(articles['Helm notes 0'].view_count, 1)
+            self.assertEqual(articles['Helm notes 1'].unique_view_count, 1)
+            self.assertEqual(articles[self.article.title].view_count, 0)
+
+    def test_listing_queries_do_not_grow_with_the_page(self):
+        for url in ('/', f'/space/{self.infra.pk}/', '/search/?q=helm', '/my-favorites/'):
+            with self.subTest(url=url):
+                self.queries(url)
+                expected = self.queries(url)
+                self.add_articles(3)
+                search.result_cache.clear()
+                with self.assertNumQueries(expected):
+                    self.client.get(url)
+
+
+class UserArticleStateTests(KbTestCase):
+
+    def test_state_is_loaded_once_per_relation(self):
+        ArticleReadStatus.objects.create(article=self.article, user=self.bob)
+        ArticleFavorite.objects.create(article=self.other, user=self.bob)
+        ReadLater.objects.create(article=self.other, user=self.bob)
+        ArticleFavorite.objects.create(article=self.article, user=self.alice)
+        state = UserArticleState(self.bob)
+        articles = list(Article.objects.order_by('pk'))
+        with self.assertNumQueries(3):
+            articles = state.annotate(articles)
+        self.assertEqual([(article.is_read, article.is_favorited, article.is_read_later) for article in articles],
+                         [(True, False, False), (False, True, True)])
+        with self.assertNumQueries(0):
+            state.annotate(articles)
+            self.assertTrue(state.is_read(self.article))
+            self.assertTrue(state.is_favorited(self.other))
+
+    def test_only_new_articles_are_queried(self):
+        state = UserArticleState(self.bob).load([self.article.pk])
+        with self.assertNumQueries(3) as queries:
+            state.load([self.article.pk, self.other.pk])
+        self.assertTrue(all(f'IN ({self.other.pk})' in query['sql'] for query in queries.captured_queries))
+
+    def test_anonymous_users_cost_no_queries(self):
+        with self.assertNumQueries(0):
+            articles = UserArticleState(AnonymousUser()).annotate([self.article, self.other])
+        self.assertFalse(any(article.is_read or article.is_favorited for article in articles))
+
+    def test_one_loader_per_request(self):
+        request = RequestFactory().get('/')
+        request.user = self.bob
+        self.assertIs(UserArticleState.for_request(request), UserArticleState.for_request(request))
+
+
+class EngagementCounterTests(KbTestCase):
+
+    def test_rating_counters(self):
+        ArticleRating.rate(self.article, self.alice, 4)
+        ArticleRating.rate(self.article, self.bob, 2)
+        self.assertEqual(self.counters(self.article)[:2], (6, 2))
+        self.assertEqual(self.article.average_rating(), 3)
+
+        ArticleRating.rate(self.article, self.bob, 5)
+        self.assertEqual(self.counters(self.article)[:2], (9, 2))
+
+        ArticleRating.objects.get(user=self.alice).delete()
+        self.assertEqual(self.counters(self.article)[:2], (5, 1))
+        self.assertCountersExact()
+
+    def test_comment_counters(self):
+        self.client.force_login(self.bob)
+        response = self.client.post(f'/article/{self.article.pk}/comment/', {'content': 'Nice'})
+        self.assertEqual(response.status_code, 200)
+        comment = ArticleComment.objects.get()
+        self.client.post(f'/article/{self.article.pk}/comment/', {'content': 'Agreed', 'parent_id': comment.pk})
+        # Replies are not counted
+        self.assertEqual(self.counters(self.article)[2], 1)
+
+        ArticleComment.set_approved(ArticleComment.objects.filter(pk=comment.pk), False)
+        self.assertEqual(self.counters(self.article)[2], 0)
+        ArticleComment.set_approved(ArticleComment.objects.all(), True)
+        self.assertEqual(self.counters(self.article)[2], 1)
+
+        comment.delete()
+        self.assertEqual(self.counters(self.article)[2], 0)
+        self.assertCountersExact()
+
+    def test_favorite_counters(self):
+        self.assertTrue(ArticleFavorite.toggle(self.article, self.alice))
+        self.assertTrue(ArticleFavorite.toggle(self.article, self.bob))
+        self.assertEqual(self.counters(self.article)[3], 2)
+        self.assertFalse(ArticleFavorite.toggle(self.article, self.bob))
+        self.assertEqual(self.counters(self.article)[3], 1)
+        ArticleFavorite.objects.all().delete()
+        self.assertEqual(self.counters(self.article)[3], 0)
+        self.assertCountersExact()
+
+    def test_paragraph_like_counters(self):
+        ParagraphLike.react(self.paragraph, self.alice, True)
+        ParagraphLike.react(self.paragraph, self.bob, True)
+        ParagraphLike.react(self.paragraph, self.bob, False)
+        self.paragraph.refresh_from_db()
+        self.assertEqual((self.paragraph.likes_count, self.paragraph.dislikes_count), (1, 1))
+
+        ParagraphLike.react(self.paragraph, self.alice, None)
+        ParagraphLike.objects.filter(user=self.bob).delete()
+        self.paragraph.refresh_from_db()
+        self.assertEqual((self.paragraph.likes_count, self.paragraph.dislikes_count), (0, 0))
+        self.assertCountersExact()
+
+    def test_counters_never_go_negative(self):
+        Article.adjust_counters(self.article.pk, favorites_count=-3)
+        self.assertEqual(self.counters(self.article)[3], 0)
+
+    def test_repair_command(self):
+        ArticleRating.rate(self.article, self.alice, 4)
+        Article.objects.filter(pk=self.article.pk).update(rating_sum=40, favorites_count=7)
+        ArticleParagraph.objects.filter(pk=self.paragraph.pk).update(likes_count=3)
+        call_command('repair_engagement_counters', '--check', stdout=StringIO())
+        self.assertEqual(self.counters(self.article)[0], 40)
+        call_command('repair_engagement_counters', stdout=StringIO())
+        self.assertCountersExact()
+
+
+class AdminCounterTests(KbTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.client.force_login(User.objects.create_superuser('root', password='pw12345!x'))
+
+    def test_rating_admin(self):
+        self.client.post('/admin/kb/articlerating/add/', {'article': self.article.pk, 'user': self.bob.pk, 'rating': 4})
+        self.assertEqual(self.counters(self.article)[:2], (4, 1))
+        rating = ArticleRating.objects.get()
+        self.client.post(f'/admin/kb/articlerating/{rating.pk}/change/',
+                         {'article': self.article.pk, 'user': self.bob.pk, 'rating': 2})
+        self.assertEqual(self.counters(self.article)[:2], (2, 1))
+        self.client.post(f'/admin/kb/articlerating/{rating.pk}/change/',
+                         {'article': self.other.pk, 'user': self.bob.pk, 'rating': 5})
+        self.assertEqual(self.counters(self.article)[:2], (0, 0))
+        self.assertEqual(self.counters(self.other)[:2], (5, 1))
+        self.assertCountersExact()
+
+    def test_comment_admin(self):
+        self.client.post('/admin/kb/articlecomment/add/',
+                         {'article': self.article.pk, 'user': self.bob.pk, 'content': 'Hi', 'is_approved': 'on'})
+        self.assertEqual(self.counters(self.article)[2], 1)
+        comment = ArticleComment.objects.get()
+        self.client.post(f'/admin/kb/articlecomment/{comment.pk}/change/',
+                         {'article': self.article.pk, 'user': self.bob.pk, 'content': 'Hi'})
+        self.assertEqual(self.counters(self.article)[2], 0)
+        self.client.post(f'/admin/kb/articlecomment/{comment.pk}/change/',
+                         {'article': self.other.pk, 'user': self.bob.pk, 'content': 'Hi', 'is_approved': 'on'})
+        self.assertEqual(self.counters(self.other)[2], 1)
+        self.client.post('/admin/kb/articlecomment/',
+                         {'action': 'unapprove_comments', '_selected_action': [comment.pk]})
+        self.assertEqual(self.counters(self.other)[2], 0)
+        self.assertCountersExact()
+
+    def test_paragraph_like_admin(self):
+        self.client.post('/admin/kb/paragraphlike/add/',
+                         {'paragraph': self.paragraph.pk, 'user': self.bob.pk, 'is_like': 'on'})
+        like = ParagraphLike.objects.get()
+        self.client.post(f'/admin/kb/paragraphlike/{like.pk}/change/',
+                         {'paragraph': self.paragraph.pk, 'user': self.bob.pk})
+        self.paragraph.refresh_from_db()
+        self.assertEqual((self.paragraph.likes_count, self.paragraph.dislikes_count), (0, 1))
+        self.client.post(f'/admin/kb/paragraphlike/{like.pk}/change/',
+                         {'paragraph': self.second_paragraph.pk, 'user': self.bob.pk, 'is_like': 'on'})
+        self.assertCountersExact(ArticleParagraph)
+
+
+class CounterSaveTests(BufferedTestCase):
+    """Saving an article in full must not write back counters changed since it was loaded"""
+
+    def setUp(self):
+        super().setUp()
+        ArticleFavorite.toggle(self.article, self.bob)
+        self.article.refresh_from_db()
+
+    def favorite_concurrently(self):
+        def favorite(sender, instance, **kwargs):
+            if instance.pk == self.article.pk:
+                ArticleFavorite.toggle(self.article, self.alice)
+
+        pre_save.connect(favorite, sender=Article)
+        self.addCleanup(pre_save.disconnect, favorite, sender=Article)
+
+    def test_save_keeps_counters(self):
+        self.favorite_concurrently()
+        self.article.title = 'Kubernetes deployments'
+        self.article.save()
+        self.assertEqual(self.counters(self.article)[3], 2)
+        self.assertEqual(self.article.title, 'Kubernetes deployments')
+        self.assertCountersExact()
+
+    def test_edit_view_keeps_counters(self):
+        self.favorite_concurrently()
+        self.client.force_login(self.alice)
+        response = self.client.post(f'/article/{self.article.pk}/edit/', {
+            'title': 'Kubernetes deployments', 'summary': 'How to deploy', 'space': self.infra.pk, 'status': 'live',
+        })
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(self.counters(self.article)[3], 2)
+        self.assertEqual(self.article.title, 'Kubernetes deployments')
+
+    def test_admin_keeps_counters(self):
+        self.favorite_concurrently()
+        self.client.force_login(User.objects.create_superuser('root', password='pw12345!x'))
+        data = {'title': 'Kubernetes deployments', 'summary': 'How to deploy', 'space': self.infra.pk,
+                'author': self.alice.pk, 'status': 'live'}
+        for prefix in ('paragraphs', 'attachments'):
+            data.update({f'{prefix}-TOTAL_FORMS': 0, f'{prefix}-INITIAL_FORMS': 0})
+        response = self.client.post(f'/admin/kb/article/{self.article.pk}/change/', data)
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(self.counters(self.article)[3], 2)
+        self.assertEqual(self.article.title, 'Kubernetes deployments')
+
+    def test_new_and_explicit_saves_are_unchanged(self):
+        article = Article(title='New', summary='new', space=self.docs, author=self.alice, favorites_count=0)
+        article.save()
+        Article.objects.filter(pk=article.pk).update(favorites_count=5)
+        article.favorites_count = 1
+        article.save(update_fields=['favorites_count'])
+        self.assertEqual(self.counters(article)[3], 1)
+
+    def test_paragraph_saves_keep_like_counters(self):
+        ParagraphLike.react(self.paragraph, self.bob, True)
+        self.client.force_login(self.alice)
+        stale = ArticleParagraph.objects.get(pk=self.paragraph.pk)
+        ParagraphLike.react(self.paragraph, self.alice, True)
+        stale.title = 'Helm'
+        stale.save()
+
+        self.client.post(f'/paragraph/{self.paragraph.pk}/edit/', {'title': 'Helm charts', 'content': '<p>Use helm.</p>'})
+        self.client.post(f'/article/{self.article.pk}/reorder-paragraphs/',
+                         '{"paragraph_orders": [{"id": %d, "order": 3}]}' % self.paragraph.pk,
+                         content_type='application/json')
+        self.client.force_login(User.objects.create_superuser('root', password='pw12345!x'))
+        self.client.post(f'/admin/kb/articleparagraph/{self.paragraph.pk}/change/', {
+            'article': self.article.pk, 'title': 'Helm charts', 'content': '<p>Use helm.</p>', 'order': 3,
+            'attachments-TOTAL_FORMS': 0, 'attachments-INITIAL_FORMS': 0,
+        })
+        self.paragraph.refresh_from_db()
+        self.assertEqual((self.paragraph.title, self.paragraph.order, self.paragraph.likes_count), ('Helm charts', 3, 2))
+        self.assertCountersExact(ArticleParagraph)
+
+
+class CommentTreeTests(KbTestCase):
+
+    def comment(self, minutes_ago=0, parent=None, **kwargs):
+        comment = ArticleComment.objects.create(article=self.article, user=self.bob, parent=parent,
+                                                content=kwargs.pop('content', 'Nice'), **kwargs)
+        created_at = timezone.now() - timedelta(minutes=minutes_ago)
+        ArticleComment.objects.filter(pk=comment.pk).update(created_at=created_at)
+        comment.created_at = created_at
+        return comment
+
+    def test_threads_are_paged_newest_first(self):
+        threads = [self.comment(minutes_ago=minutes) for minutes in (50, 40, 30, 30, 10)]
+        with self.assertNumQueries(1):
+            tree = comment_tree.CommentTree(self.article)
+        page, cursor = tree.page(limit=2)
+        self.assertEqual(page, [threads[4], threads[3]])
+
+        # A comment posted meanwhile does not shift the next page
+        self.comment()
+        tree = comment_tree.CommentTree(self.article)
+        page, cursor = tree.page(cursor, limit=2)
+        self.assertEqual(page, [threads[2], threads[1]])
+        page, cursor = tree.page(cursor, limit=2)
+        self.assertEqual((page, cursor), ([threads[0]], None))
+        with self.assertRaises(ValueError):
+            tree.page('yesterday')
+
+    def test_replies_beyond_the_depth_load_on_demand(self):
+        thread = self.comment(minutes_ago=10)
+        first = self.comment(minutes_ago=9, parent=thread)
+        second = self.comment(minutes_ago=8, parent=first)
+        third = self.comment(minutes_ago=7, parent=second)
+        hidden = self.comment(minutes_ago=6, parent=thread, is_approved=False)
+        self.comment(minutes_ago=5, parent=hidden)
+
+        tree = comment_tree.CommentTree(self.article)
+        [shown], _ = tree.page(depth=3)
+        [shown_first] = shown.thread_replies
+        [shown_second] = shown_first.thread_replies
+        self.assertEqual((shown_first, shown_second), (first, second))
+        self.assertEqual((shown_second.thread_replies, shown_second.more_replies), ([], 1))
+        self.assertEqual(tree.replies(second.id), [third])
+        with self.assertRaises(KeyError):
+            tree.replies(hidden.id)
+
+    def test_comment_endpoints(self):
+        threads = [self.comment(minutes_ago=minutes) for minutes in (30, 20, 10)]
+        reply = self.comment(minutes_ago=5, parent=threads[0])
+        url = f'/api/article/{self.article.pk}/comments/'
+        data = self.client.get(url, {'limit': 2}).json()
+        self.assertEqual([comment['id'] for comment in data['comments']], [threads[2].pk, threads[1].pk])
+        data = self.client.get(url, {'limit': 2, 'cursor': data['next_cursor']}).json()
+        self.assertEqual(data['comments'][0]['replies'][0]['id'], reply.pk)
+        self.assertIsNone(data['next_cursor'])
+        self.assertEqual(self.client.get(url, {'cursor': 'x_y'}).status_code, 400)
+
+        response = self.client.get(f'/api/comment/{threads[0].pk}/replies/')
+        self.assertEqual([comment['id'] for comment in response.json()['comments']], [reply.pk])
+
+        self.article.status = 'draft'
+        self.article.save()
+        self.assertEqual(self.client.get(url).status_code, 404)
+        self.assertEqual(self.client.get(f'/api/comment/{threads[0].pk}/replies/').status_code, 404)
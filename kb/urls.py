@@ -8,6 +8,7 @@ urlpatterns = [
     path('article/<int:article_id>/', views.article_detail, name='article_detail'),
     path('space/<int:space_id>/', views.space_detail, name='space_detail'),
     path('search/', views.search_view, name='search'),
+    path('search/click/<int:article_id>/', views.search_click, name='search_click'),
     
     # Authentication URLs
     path('login/', views.login_view, name='login'),
@@ -52,9 +53,19 @@ urlpatterns = [
     path('article/<int:article_id>/toggle-read-later/', views.toggle_read_later, name='toggle_read_later'),
     path('my-read-later/', views.my_read_later, name='my_read_later'),
     
+    # Saved searches
+    path('saved-searches/', views.my_saved_searches, name='my_saved_searches'),
+    path('saved-searches/save/', views.save_search, name='save_search'),
+    path('saved-searches/<int:saved_search_id>/delete/', views.delete_saved_search, name='delete_saved_search'),
+    
     # API endpoints
     path('api/search/', views.api_search, name='api_search'),
+    path('api/suggest/', views.api_suggest, name='api_suggest'),
     path('api/articles/', views.api_articles, name='api_articles'),
     path('api/article/<int:article_id>/', views.api_article, name='api_article'),
+    path('api/article/<int:article_id>/similar/', views.api_similar_articles, name='api_similar_articles'),
+    path('api/article/<int:article_id>/comments/', views.api_article_comments, name='api_article_comments'),
+    path('api/comment/<int:comment_id>/replies/', views.api_comment_replies, name='api_comment_replies'),
     path('api/spaces/', views.api_spaces, name='api_spaces'),
+    path('api/runtime-stats/', views.api_runtime_stats, name='api_runtime_stats'),
 ]
\ No newline at end of file
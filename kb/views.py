@@ -2,6 +2,7 @@ from django.shortcuts import render, get_object_or_404, redirect
 from django.http import JsonResponse, HttpResponseForbidden, HttpResponse
 from django.contrib.auth import authenticate, login, logout
 from django.contrib.auth.decorators import login_required
+from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib import messages
 from django.utils import timezone
 from django.template.loader import render_to_string
@@ -10,11 +11,14 @@ from django.utils.html import strip_tags
 from django.conf import settings
 from django.views.decorators.csrf import csrf_exempt
 from django.middleware.csrf import get_token
-from django.db.models import Q
+from django.db import transaction
+from django.db.models import Prefetch, Q, prefetch_related_objects
 from .models import (Label, Article, Space, ArticleAttachment, ArticleParagraph, 
-                     ParagraphAttachment, ShareSettings, SecureShareLink, ShareLinkView,
-                     ArticleRating, ArticleComment, ParagraphLike, ArticleReadStatus, ArticleFavorite, ReadLater)
+                     ParagraphAttachment, ShareSettings, SecureShareLink,
+                     ArticleRating, ArticleComment, ParagraphLike, ArticleReadStatus, ArticleFavorite, ReadLater,
+                     SavedSearch, SavedSearchMatch, UserArticleState)
 from .forms import LoginForm, RegistrationForm, ArticleForm, ParagraphForm, FileUploadForm
+from . import analytics, buffers, comment_tree, deferred, facets, percolator, search, semantic, suggest
 from django.db.models import Q
 import json
 import markdown
@@ -40,23 +44,15 @@ def index(request):
     # Filter articles based on status and user permissions
     if request.user.is_authenticated:
         # Authenticated users see Live articles + their own Draft articles
-        latest_articles = Article.objects.filter(
+        latest_articles = Article.objects.with_stats().prefetch_related('tags').filter(
             Q(status='live') | 
             Q(status='draft', author=request.user)
         ).order_by('-created_at')[:5]
     else:
         # Anonymous users see only Live articles
-        latest_articles = Article.objects.filter(status='live').order_by('-created_at')[:5]
-    
-    # Add read, favorite status, and view counts for all users
-    for article in latest_articles:
-        article.view_count = article.get_view_count()
-        article.unique_view_count = article.get_unique_view_count()
-        article.favorites_count = article.get_favorites_count()
-        if request.user.is_authenticated:
-            article.is_read = article.is_read_by_user(request.user)
-            article.is_favorited = article.is_favorited_by_user(request.user)
-            article.is_read_later = article.is_read_later_by_user(request.user)
+        latest_articles = Article.objects.with_stats().prefetch_related('tags').filter(status='live').order_by('-created_at')[:5]
+    
+    latest_articles = UserArticleState.for_request(request).annotate(latest_articles)
     
     context = {
         'spaces': spaces,
@@ -70,40 +66,56 @@ def article_detail(request, article_id):
     """Display a single article"""
     article = get_object_or_404(Article, id=article_id)
     
-    # Record view for both authenticated and anonymous users
-    article.record_view(request)
-    
-    # Mark article as read for authenticated users
+    # Bookkeeping writes run after the response has been sent:
+    # record the view for both authenticated and anonymous users,
+    # and mark the article as read for authenticated users
+    deferred.defer(article.record_view, request)
     if request.user.is_authenticated:
-        ArticleReadStatus.mark_as_read(article, request.user)
+        deferred.defer(ArticleReadStatus.mark_as_read, article, request.user)
     
     # Get rating and comment data
     user_rating = None
     if request.user.is_authenticated:
         user_rating = article.get_user_rating(request.user)
     
-    # Get approved comments (only top-level comments, replies are loaded via model method)
-    comments = article.comments.filter(is_approved=True, parent__isnull=True).order_by('-created_at')
+    # Approved comments in one query, threaded in memory: the first page of
+    # threads, with older threads and deeper replies loaded on demand
+    comments, comments_next_cursor = comment_tree.CommentTree(article).page()
     
     # Add read and favorite status for the current article
     if request.user.is_authenticated:
-        article.is_read = article.is_read_by_user(request.user)
+        # Being read right now, though the read status is written afterwards
+        article.is_read = True
         article.is_favorited = article.is_favorited_by_user(request.user)
     
+    # Like counters are columns and the user's likes come in one query for all paragraphs
+    paragraphs = article.paragraphs.with_user_likes(request.user).prefetch_related('attachments')
+    
     context = {
         'article': article,
+        'paragraphs': paragraphs,
         'title': article.title,
         'user_rating': user_rating,
         'comments': comments,
+        'comments_next_cursor': comments_next_cursor,
         'average_rating': article.average_rating(),
-        'rating_count': article.rating_count(),
+        'rating_count': article.rating_count,
         'comment_count': article.comment_count(),
         'view_count': article.get_view_count(),
         'unique_view_count': article.get_unique_view_count(),
         'favorites_count': article.get_favorites_count(),
+        'related_articles': related_articles(article, request.user),
     }
     return render(request, 'article.html', context)
 
+def related_articles(article, user, limit=5):
+    """Visible articles closest in meaning to ``article``, from the semantic index"""
+    ranked = semantic.index.similar_articles(article.id, user, limit)
+    if not ranked:
+        return []
+    articles = Article.objects.select_related('space').in_bulk([article_id for article_id, _ in ranked])
+    return [articles[article_id] for article_id, _ in ranked if article_id in articles]
+
 def space_detail(request, space_id):
     """Display articles in a space"""
     space = get_object_or_404(Space, id=space_id)
@@ -111,7 +123,7 @@ def space_detail(request, space_id):
     # Filter articles based on status and user permissions
     if request.user.is_authenticated:
         # Authenticated users see Live articles + their own Draft articles
-        articles = Article.objects.filter(
+        articles = Article.objects.with_stats().prefetch_related('tags').filter(
             space=space
         ).filter(
             Q(status='live') | 
@@ -119,17 +131,9 @@ def space_detail(request, space_id):
         )
     else:
         # Anonymous users see only Live articles
-        articles = Article.objects.filter(space=space, status='live')
+        articles = Article.objects.with_stats().prefetch_related('tags').filter(space=space, status='live')
     
-    # Add read, favorite status, and view counts for all users
-    for article in articles:
-        article.view_count = article.get_view_count()
-        article.unique_view_count = article.get_unique_view_count()
-        article.favorites_count = article.get_favorites_count()
-        if request.user.is_authenticated:
-            article.is_read = article.is_read_by_user(request.user)
-            article.is_favorited = article.is_favorited_by_user(request.user)
-            article.is_read_later = article.is_read_later_by_user(request.user)
+    articles = UserArticleState.for_request(request).annotate(articles)
     
     context = {
         'space': space,
@@ -141,74 +145,164 @@ def space_detail(request, space_id):
 def search_view(request):
     """Search page"""
     query = request.GET.get('q', '')
+    filters = facets.parse_filters(request.GET)
+    mode = search_mode(request)
+    facet_groups = []
+    facets_truncated = False
+    suggestion = None
     
     if query:
-        # Filter articles based on status and user permissions
-        if request.user.is_authenticated:
-            # Authenticated users see Live articles + their own Draft articles
-            articles = Article.objects.filter(
-                Q(title__icontains=query) | 
-                Q(content__icontains=query) |
-                Q(summary__icontains=query) |
-                Q(tags__contains=query)
-            ).filter(
-                Q(status='live') | 
-                Q(status='draft', author=request.user)
-            )
-        else:
-            # Anonymous users see only Live articles
-            articles = Article.objects.filter(
-                Q(title__icontains=query) | 
-                Q(content__icontains=query) |
-                Q(summary__icontains=query) |
-                Q(tags__contains=query)
-            ).filter(status='live')
+        # Ranked full-text search, restricted to Live articles + the user's own Drafts,
+        # narrowed by the selected facets. Served from cache while content is unchanged.
+        result = search.run_search(query, request.user, filters, mode)
+        articles = search.load_articles(result, with_stats=True)
+        prefetch_related_objects(articles, 'tags')
+        analytics.record_search(query, len(articles))
+        facet_groups = facets.facet_links(result['facets'], filters, request.GET)
+        facets_truncated = result['facets_truncated']
+        suggestion = result['suggestion']
         
-        # Add read, favorite status, and view counts for all users
-        for article in articles:
-            article.view_count = article.get_view_count()
-            article.unique_view_count = article.get_unique_view_count()
-            article.favorites_count = article.get_favorites_count()
-            if request.user.is_authenticated:
-                article.is_read = article.is_read_by_user(request.user)
-                article.is_favorited = article.is_favorited_by_user(request.user)
-                article.is_read_later = article.is_read_later_by_user(request.user)
+        articles = UserArticleState.for_request(request).annotate(articles)
     else:
         articles = []
     
     context = {
         'query': query,
         'articles': articles,
+        'facet_groups': facet_groups,
+        'facets_truncated': facets_truncated,
+        'active_filters': filters,
+        'mode': mode,
+        'suggestion': suggestion,
         'title': 'Search Results'
     }
     return render(request, 'search.html', context)
 
+def search_click(request, article_id):
+    """Record a click on a search result, then continue to the article"""
+    analytics.record_click(request.GET.get('q', ''), article_id)
+    return redirect('article_detail', article_id=article_id)
+
+def search_mode(request):
+    """?mode=semantic ranks by meaning when the semantic index is available"""
+    mode = request.GET.get('mode', search.MODE_KEYWORD)
+    return mode if mode in search.MODES else search.MODE_KEYWORD
+
 # API endpoints
 def api_search(request):
     """API endpoint for search functionality"""
     query = request.GET.get('q', '')
     if not query:
-        return JsonResponse({'articles': []})
+        return JsonResponse({'articles': [], 'facets': {}, 'facets_truncated': False, 'suggestion': None})
     
-    articles = Article.objects.filter(
-        Q(title__icontains=query) | 
-        Q(content__icontains=query) |
-        Q(summary__icontains=query) |
-        Q(tags__contains=query)
-    )
+    result = search.run_search(query, request.user, facets.parse_filters(request.GET), search_mode(request))
+    articles = search.load_articles(result)
+    analytics.record_search(query, len(articles))
     
     results = []
     for article in articles:
+        article_url = reverse('article_detail', args=[article.id])
         results.append({
             'id': article.id,
             'title': article.title,
             'summary': article.summary,
-            'category_id': article.category.id,
-            'category_name': article.category.name
+            'space_id': article.space.id,
+            'space_name': article.space.name,
+            'paragraphs': [
+                {
+                    'id': hit['id'],
+                    'title': hit['title'],
+                    'snippet': hit['snippet'],
+                    'url': f"{article_url}#{hit['anchor']}"
+                }
+                for hit in article.paragraph_hits
+            ]
+        })
+    
+    return JsonResponse({
+        'articles': results,
+        'facets': facets.facets_as_json(result['facets']),
+        'facets_truncated': result['facets_truncated'],
+        'suggestion': result['suggestion']
+    })
+
+def api_suggest(request):
+    """API endpoint for search-as-you-type suggestions, served from memory"""
+    query = request.GET.get('q', '')
+    try:
+        limit = min(int(request.GET.get('limit', suggest.DEFAULT_LIMIT)), suggest.MAX_LIMIT)
+    except ValueError:
+        limit = suggest.DEFAULT_LIMIT
+    
+    suggestions = suggest.index.suggest(query, request.user, limit=max(limit, 1))
+    return JsonResponse({'suggestions': suggestions})
+
+def api_similar_articles(request, article_id):
+    """API endpoint for "more like this", ranked by the semantic index"""
+    article = get_object_or_404(Article.objects.filter(search.visibility_q(request.user)), id=article_id)
+    try:
+        limit = min(int(request.GET.get('limit', 5)), 20)
+    except ValueError:
+        limit = 5
+    
+    results = []
+    for related in related_articles(article, request.user, max(limit, 1)):
+        results.append({
+            'id': related.id,
+            'title': related.title,
+            'summary': related.summary,
+            'space_id': related.space.id,
+            'space_name': related.space.name,
+            'url': reverse('article_detail', args=[related.id])
         })
     
     return JsonResponse({'articles': results})
 
+def api_article_comments(request, article_id):
+    """API endpoint for a page of an article's comment threads, newest first"""
+    article = get_object_or_404(Article.objects.filter(search.visibility_q(request.user)), id=article_id)
+    try:
+        limit = min(int(request.GET.get('limit', comment_tree.PAGE_SIZE)), comment_tree.MAX_PAGE_SIZE)
+        threads, next_cursor = comment_tree.CommentTree(article).page(request.GET.get('cursor'), max(limit, 1))
+    except ValueError:
+        return JsonResponse({'error': 'Invalid cursor or limit'}, status=400)
+    
+    return JsonResponse({
+        'comments': [comment_tree.as_json(comment) for comment in threads],
+        'html': render_comments(request, threads),
+        'next_cursor': next_cursor
+    })
+
+def api_comment_replies(request, comment_id):
+    """API endpoint for the replies to a comment that were left out of its thread"""
+    visible = Article.objects.filter(search.visibility_q(request.user))
+    comment = get_object_or_404(
+        ArticleComment.objects.select_related('article'), id=comment_id, is_approved=True, article__in=visible
+    )
+    try:
+        replies = comment_tree.CommentTree(comment.article).replies(comment.id)
+    except KeyError:
+        # A reply to a comment that is not approved
+        return JsonResponse({'error': 'Not found'}, status=404)
+    
+    return JsonResponse({
+        'comments': [comment_tree.as_json(reply) for reply in replies],
+        'html': render_comments(request, replies)
+    })
+
+def render_comments(request, comments):
+    return ''.join(
+        render_to_string('partials/comment.html', {'comment': comment}, request=request) for comment in comments
+    )
+
+@staff_member_required
+def api_runtime_stats(request):
+    """API endpoint for the depth of the deferred task queue and the write buffers"""
+    return JsonResponse({
+        'deferred': deferred.stats(),
+        'buffers': buffers.stats(),
+    })
+
 def api_articles(request):
     """API endpoint to get all articles"""
     articles = Article.objects.all()
@@ -347,6 +441,7 @@ def edit_article(request, article_id):
         return redirect('article_detail', article_id=article.id)
     
     if request.method == 'POST':
+        was_live = article.status == 'live'
         form = ArticleForm(request.POST, request.FILES, instance=article)
         print(f"Edit form is valid: {form.is_valid()}")
         if form.is_valid():
@@ -354,6 +449,9 @@ def edit_article(request, article_id):
             article.updated_at = timezone.now()
             article.save()
             form.save_m2m()  # Save many-to-many relationships (tags)
+            if was_live and article.status == 'live':
+                # Articles going live are percolated on save (kb.signals)
+                percolator.percolate_later(article.id)
             
             # Handle multiple file uploads
             files = request.FILES.getlist('attachments')
@@ -425,6 +523,8 @@ def add_paragraph(request, article_id):
             last_paragraph = article.paragraphs.order_by('-order').first()
             paragraph.order = (last_paragraph.order + 1) if last_paragraph else 1
             paragraph.save()
+            if article.status == 'live':
+                percolator.percolate_later(article.id)
             
             # Handle file attachments
             files = request.FILES.getlist('attachments')
@@ -463,6 +563,8 @@ def edit_paragraph(request, paragraph_id):
         form = ParagraphForm(request.POST, instance=paragraph)
         if form.is_valid():
             form.save()
+            if article.status == 'live':
+                percolator.percolate_later(article.id)
             
             # Handle file attachments
             files = request.FILES.getlist('attachments')
@@ -839,11 +941,7 @@ def shared_article(request, token):
         
         # Record the view if tracking is enabled
         if settings.track_views:
-            share_link.record_view()
-            
-            # Create detailed view record
-            ShareLinkView.objects.create(
-                share_link=share_link,
+            share_link.record_view(
                 ip_address=get_client_ip(request),
                 user_agent=request.META.get('HTTP_USER_AGENT', '')[:500],
                 referrer=request.META.get('HTTP_REFERER')
@@ -1004,17 +1102,14 @@ def rate_article(request, article_id):
         rating_value = int(request.POST.get('rating', 0))
         
         if 1 <= rating_value <= 5:
-            rating, created = ArticleRating.objects.update_or_create(
-                article=article,
-                user=request.user,
-                defaults={'rating': rating_value}
-            )
+            rating, created = ArticleRating.rate(article, request.user, rating_value)
+            article.refresh_from_db(fields=['rating_sum', 'rating_count'])
             
             return JsonResponse({
                 'success': True,
                 'rating': rating.rating,
                 'average_rating': round(article.average_rating(), 1),
-                'rating_count': article.rating_count(),
+                'rating_count': article.rating_count,
                 'message': 'Rating updated' if not created else 'Rating added'
             })
         else:
@@ -1039,12 +1134,16 @@ def comment_article(request, article_id):
                 except ArticleComment.DoesNotExist:
                     pass
             
-            comment = ArticleComment.objects.create(
-                article=article,
-                user=request.user,
-                content=content,
-                parent=parent
-            )
+            with transaction.atomic():
+                comment = ArticleComment.objects.create(
+                    article=article,
+                    user=request.user,
+                    content=content,
+                    parent=parent
+                )
+                if comment.is_counted:
+                    Article.adjust_counters(article.pk, approved_comment_count=1)
+            article.refresh_from_db(fields=['approved_comment_count'])
             
             # Render the comment HTML
             comment_html = render_to_string('partials/comment.html', {
@@ -1074,33 +1173,14 @@ def like_paragraph(request, paragraph_id):
     
     paragraph = get_object_or_404(ArticleParagraph, pk=paragraph_id)
     action = request.POST.get('action')  # 'like', 'dislike', or 'remove'
+    actions = {'like': True, 'dislike': False, 'remove': None}
+    if action not in actions:
+        return JsonResponse({'success': False, 'error': 'Invalid action'})
     
-    try:
-        existing_like = ParagraphLike.objects.get(paragraph=paragraph, user=request.user)
-        
-        if action == 'remove':
-            existing_like.delete()
-            user_action = None
-        elif action == 'like':
-            existing_like.is_like = True
-            existing_like.save()
-            user_action = True
-        elif action == 'dislike':
-            existing_like.is_like = False
-            existing_like.save()
-            user_action = False
-        else:
-            return JsonResponse({'success': False, 'error': 'Invalid action'})
-            
-    except ParagraphLike.DoesNotExist:
-        if action == 'like':
-            ParagraphLike.objects.create(paragraph=paragraph, user=request.user, is_like=True)
-            user_action = True
-        elif action == 'dislike':
-            ParagraphLike.objects.create(paragraph=paragraph, user=request.user, is_like=False)
-            user_action = False
-        else:
-            user_action = None
+    # Updates the paragraph's like counters along with the like itself
+    user_action = actions[action]
+    ParagraphLike.react(paragraph, request.user, user_action)
+    paragraph.refresh_from_db(fields=['likes_count', 'dislikes_count'])
     
     return JsonResponse({
         'success': True,
@@ -1118,18 +1198,8 @@ def toggle_favorite(request, article_id):
     
     article = get_object_or_404(Article, id=article_id)
     
-    favorite, created = ArticleFavorite.objects.get_or_create(
-        article=article,
-        user=request.user
-    )
-    
-    if not created:
-        # If favorite exists, remove it (unfavorite)
-        favorite.delete()
-        is_favorited = False
-    else:
-        # New favorite was created
-        is_favorited = True
+    # Adds the favorite, or removes it if it exists, along with the article's favorites_count
+    is_favorited = ArticleFavorite.toggle(article, request.user)
     
     return JsonResponse({
         'success': True,
@@ -1140,17 +1210,11 @@ def toggle_favorite(request, article_id):
 @login_required
 def my_favorites(request):
     """Display user's favorite articles"""
-    favorites = ArticleFavorite.objects.filter(user=request.user).select_related('article', 'article__space')
-    articles = [favorite.article for favorite in favorites]
+    articles = Article.objects.with_stats().select_related('space').prefetch_related('tags').filter(
+        favorites__user=request.user
+    ).order_by('-favorites__created_at')
     
-    # Add favorite status, view counts, and favorites count for each article
-    for article in articles:
-        article.is_favorited = True  # All articles in this view are favorited
-        article.view_count = article.get_view_count()
-        article.unique_view_count = article.get_unique_view_count()
-        article.favorites_count = article.get_favorites_count()
-        if request.user.is_authenticated:
-            article.is_read = article.is_read_by_user(request.user)
+    articles = UserArticleState.for_request(request).annotate(articles)
     
     context = {
         'articles': articles,
@@ -1191,7 +1255,10 @@ def toggle_read_later(request, article_id):
 def my_read_later(request):
     """Display user's read later articles"""
     # Get read later articles for the current user
-    read_later_articles = ReadLater.objects.filter(user=request.user).select_related('article__space').order_by('-created_at')
+    # Articles come with their view counts (with_stats) in one query
+    read_later_articles = ReadLater.objects.filter(user=request.user).prefetch_related(
+        Prefetch('article', queryset=Article.objects.with_stats().select_related('space'))
+    ).order_by('-created_at')
     
     # Get spaces and labels for filtering
     spaces = Space.objects.all()
@@ -1304,3 +1371,58 @@ def convert_docx_to_html(uploaded_file):
         
     except Exception as e:
         raise Exception(f"Failed to convert document: {str(e)}")
+
+
+@login_required
+def save_search(request):
+    """Save the current search query so new matching articles are collected"""
+    if request.method != 'POST':
+        return redirect('my_saved_searches')
+    
+    query = ' '.join(request.POST.get('q', '').split())[:255]
+    if not query:
+        messages.error(request, "Cannot save an empty search.")
+        return redirect('search')
+    
+    saved_search, created = SavedSearch.objects.get_or_create(
+        user=request.user,
+        query=query,
+        defaults={'name': request.POST.get('name', '')[:200]}
+    )
+    if created:
+        messages.success(request, f'Saved search "{query}". New matching articles will appear in Saved Searches.')
+    else:
+        messages.info(request, f'You already saved "{query}".')
+    return redirect(f"{reverse('search')}?{urllib.parse.urlencode({'q': query})}")
+
+
+@login_required
+def delete_saved_search(request, saved_search_id):
+    """Remove a saved search and its matches"""
+    saved_search = get_object_or_404(SavedSearch, id=saved_search_id, user=request.user)
+    if request.method == 'POST':
+        saved_search.delete()
+        messages.success(request, "Saved search removed.")
+    return redirect('my_saved_searches')
+
+
+@login_required
+def my_saved_searches(request):
+    """Display user's saved searches with the articles that matched them"""
+    saved_searches = list(SavedSearch.objects.filter(user=request.user).prefetch_related('matches__article__space'))
+    
+    for saved_search in saved_searches:
+        saved_search.match_list = list(saved_search.matches.all())
+        saved_search.unseen_count = sum(1 for match in saved_search.match_list if not match.is_seen)
+    
+    context = {
+        'saved_searches': saved_searches,
+        'title': 'Saved Searches',
+    }
+    response = render(request, 'my_saved_searches.html', context)
+    
+    # Matches shown once are no longer new
+    SavedSearchMatch.objects.filter(
+        saved_search__user=request.user, is_seen=False
+    ).update(is_seen=True)
+    return response
@@ -20,11 +20,13 @@ document.addEventListener('DOMContentLoaded', function() {
                 return;
             }
             
-            // Set a timeout to avoid making too many requests
+            // Suggestions are served from memory, so a short debounce is enough
             searchTimeout = setTimeout(() => {
-                fetch(`/api/search?q=${encodeURIComponent(query)}`)
+                fetch(`/api/suggest/?q=${encodeURIComponent(query)}`)
                     .then(response => response.json())
-                    .then(data => {
+                    .then(payload => {
+                        const data = payload.suggestions || [];
+                        
                         // Clear previous results
                         searchResults.innerHTML = '';
                         
@@ -36,37 +38,43 @@ document.addEventListener('DOMContentLoaded', function() {
                         // Display results
                         searchResults.style.display = 'block';
                         
-                        // Take only first 5 results
-                        const topResults = data.slice(0, 5);
+                        const icons = {
+                            article: 'fas fa-file-alt',
+                            space: 'fas fa-folder',
+                            tag: 'fas fa-tag'
+                        };
                         
-                        topResults.forEach(article => {
+                        data.forEach(suggestion => {
                             const resultItem = document.createElement('div');
                             resultItem.className = 'search-result-item';
-                            resultItem.innerHTML = `
-                                <a href="/article/${article.id}" class="d-block p-2 text-decoration-none">
-                                    <div class="fw-bold">${article.title}</div>
-                                    <div class="small text-muted">${article.summary}</div>
-                                </a>
-                            `;
+                            
+                            const link = document.createElement('a');
+                            link.href = suggestion.url;
+                            link.className = 'd-block p-2 text-decoration-none';
+                            
+                            const icon = document.createElement('i');
+                            icon.className = `${icons[suggestion.type] || 'fas fa-search'} me-2 text-muted`;
+                            link.appendChild(icon);
+                            link.appendChild(document.createTextNode(suggestion.label));
+                            
+                            resultItem.appendChild(link);
                             searchResults.appendChild(resultItem);
                         });
                         
-                        // Add "View all results" link if there are more results
-                        if (data.length > 5) {
-                            const viewAll = document.createElement('div');
-                            viewAll.className = 'search-view-all p-2 text-center bg-light';
-                            viewAll.innerHTML = `
-                                <a href="/search?q=${encodeURIComponent(query)}" class="text-decoration-none">
-                                    View all ${data.length} results
-                                </a>
-                            `;
-                            searchResults.appendChild(viewAll);
-                        }
+                        // Full-text search for everything else
+                        const viewAll = document.createElement('div');
+                        viewAll.className = 'search-view-all p-2 text-center bg-light';
+                        viewAll.innerHTML = `
+                            <a href="/search/?q=${encodeURIComponent(query)}" class="text-decoration-none">
+                                Search all articles
+                            </a>
+                        `;
+                        searchResults.appendChild(viewAll);
                     })
                     .catch(error => {
-                        console.error('Error performing search:', error);
+                        console.error('Error fetching suggestions:', error);
                     });
-            }, 300);
+            }, 150);
         });
         
         // Close search results when clicking outside